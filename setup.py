@@ -38,11 +38,11 @@ setuptools.setup(
     ],
     install_requires=[
         'numpy>=1.19.1',
-        'scipy>=1.4.1',
-        'bokeh>=2.0.1',
+        'scipy>=1.15.0',
+        'bokeh>=2.4.0',
         'nibabel>=3.0.2',
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.10',
 )
 
 # Done
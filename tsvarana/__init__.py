@@ -4,11 +4,25 @@
 # University of California, Berkeley
 
 # Import tsvarana objects
+from .aio import *
+from .cache import *
 from .classes import *
 from .command import *
 from .core import *
+from .engine import *
+from .index import *
+from .pipeline import *
+from .planner import *
 from .plot import *
+from .pyramid import *
+from .review import *
+from .segment import *
+from .service import *
+from .session import *
+from .shard import *
+from .triage import *
 from .utils import *
+from .view import *
 
 # Version information
 __version__ = '0.2.1'
@@ -3,10 +3,40 @@
 # Basic usage
 #   python -m tsvarana --data <nifti>
 #
+# Service usage
+#   python -m tsvarana --watch <directory> --output <directory>
+#
+# Shard usage, see tsvarana/shard.py
+#   python -m tsvarana --data <nifti> --shard_manifest <dir> --shards <int>
+#   python -m tsvarana --shard_run <dir> --shard_index <int>
+#   python -m tsvarana --shard_merge <dir> --output <basename>
+#
+# Results index usage, see tsvarana/index.py
+#   python -m tsvarana --data <nifti> --index <db> --tag scanner=B
+#   python -m tsvarana --index <db> --query "SELECT data FROM runs ..."
+#
+# Label usage, with an integer label image of the same geometry
+#   python -m tsvarana --data <nifti> --spatial_unit label --labels <nifti>
+#
+# Review usage, see tsvarana/review.py
+#   python -m tsvarana --data <nifti> --session <dir>
+#   python -m tsvarana --review <dir> [--port <int>]
+#
+# Planner usage, see tsvarana/planner.py
+#   python -m tsvarana --data <nifti> --max_memory <GB> [--dry_run]
+#
 # Inputs
 #    data           [string] A 4D NIFTI fila
 #    spatial_unit   [string] Calculate mean variance along the specified
-#                            spatial unit: 'voxel', 'slice' or 'volume'
+#                            spatial unit: 'voxel', 'slice', 'volume' or
+#                            'label'
+#    labels         [string] Integer label NIFTI file, for the label unit.
+#                            Label 0 is background and never flagged
+#    segment        [scalar] If non-zero, scrub this many timepoints at a
+#                            time, for very long runs, see
+#                            tsvarana/segment.py
+#    segment_median [string] 'sketch' for the median of the whole run, or
+#                            'segment' for the median of each segment
 #    slice_axis     [scalar] Axis long which the slice dimension is defined
 #                            default for (x,y,z,t) data is slice_axis=2
 #    time_axis      [scalar] Axis long which time is stored
@@ -14,6 +44,58 @@
 #    var_threshold  [scalar] Normalised variance threshold for scrubbing
 #    one_shot       [ bool ] If True, perform a single iteration of scrubbing
 #    output         [string] Basename for output files
+#    max_size       [scalar] Maximum number of data values embedded in the
+#                            HTML report
+#    session        [string] If specified, save a session directory for
+#                            reloading results without recomputing
+#    cache          [string] If specified, read data through a decompressed
+#                            input cache in this directory
+#    cache_size     [scalar] Input cache size limit, in GB
+#    checkpoint     [string] If specified, checkpoint iterative scrubbing
+#                            to this directory after every iteration
+#    resume         [ bool ] If True, resume from the checkpoint
+#    lazy           [ bool ] If True, record scrubbing as replacement
+#                            intervals and stream the scrubbed output
+#    window         [scalar] If specified, compare each timepoint against a
+#                            rolling median over this odd number of
+#                            timepoints, to follow slow signal drift
+#    masked         [ bool ] If True, exclude flagged timepoints from the
+#                            median and mean intensity of later iterations,
+#                            and scrub once at the end
+#    pyramid        [scalar] If non-zero, calculate voxel-unit variance
+#                            coarse-to-fine over this many pyramid levels,
+#                            only where the threshold could be exceeded
+#    triage         [ bool ] If True, triage the run on a sample of voxels
+#                            first, and only process it fully unless clean
+#    triage_voxels  [scalar] Number of voxels sampled per slice for triage
+#    engine         [string] Implementation of the core steps, 'reference'
+#                            or 'vectorized', see tsvarana/engine.py
+#    verify         [scalar] If non-zero, check every step against the
+#                            reference engine on this many sampled voxels
+#    watch          [string] Run as a service, processing new NIFTI files
+#                            written to this directory
+#    workers        [scalar] Number of service worker processes
+#    poll           [scalar] Seconds between service directory scans
+#    once           [ bool ] If True, the service exits once all files
+#                            present have been processed
+#    review         [string] Serve an interactive review of this session
+#                            directory, in a browser
+#    port           [scalar] Local port of the review server
+#    shard_manifest [string] Write a shard manifest to this directory
+#    shards         [scalar] Number of shards
+#    shard_run      [string] Process one shard from this directory
+#    shard_index    [scalar] Index of the shard to process, defaults to the
+#                            SLURM_ARRAY_TASK_ID environment variable
+#    shard_merge    [string] Merge shards from this directory
+#    index          [string] Add each processed run to this results index
+#    tag            [string] 'key=value' tag stored with the run in the
+#                            index, may be repeated
+#    query          [string] SQL query to run on the results index
+#    max_memory     [scalar] Memory budget in GB, selects an execution
+#                            strategy that fits, see tsvarana/planner.py
+#    plan_iterations [scalar] Number of scrub iterations assumed when
+#                            planning
+#    dry_run        [ bool ] If True, report the plan without processing
 #
 # Ivan Alvarez
 # University of California, Berkeley
@@ -23,6 +105,7 @@
 # =========
 
 # Libraries
+import os
 import sys
 import argparse
 
@@ -40,31 +123,131 @@ if len(sys.argv) == 0:
 
 # Set up parser
 parser = argparse.ArgumentParser()
-parser.add_argument('--data', help='<nifti>', type=str, required=True)
-parser.add_argument('--spatial_unit', help='<voxel,slice,volume>', type=str)
+parser.add_argument('--data', help='<nifti>', type=str)
+parser.add_argument('--spatial_unit', help='<voxel,slice,volume,label>',
+                    type=str)
+parser.add_argument('--labels', help='<nifti>', type=str)
+parser.add_argument('--segment', help='<int>', type=int)
+parser.add_argument('--segment_median', help='<sketch,segment>', type=str)
 parser.add_argument('--slice_axis', help='<int>', type=int)
 parser.add_argument('--time_axis', help='<int>', type=int)
 parser.add_argument('--var_threshold', help='<scalar>', type=float)
 parser.add_argument('--one_shot', action='store_true')
 parser.add_argument('--output', help='<basename>', type=str)
+parser.add_argument('--max_size', help='<int>', type=int)
+parser.add_argument('--session', help='<directory>', type=str)
+parser.add_argument('--cache', help='<directory>', type=str)
+parser.add_argument('--cache_size', help='<scalar>', type=float)
+parser.add_argument('--checkpoint', help='<directory>', type=str)
+parser.add_argument('--resume', action='store_true')
+parser.add_argument('--lazy', action='store_true')
+parser.add_argument('--window', help='<int>', type=int)
+parser.add_argument('--masked', action='store_true')
+parser.add_argument('--pyramid', help='<int>', type=int)
+parser.add_argument('--triage', action='store_true')
+parser.add_argument('--triage_voxels', help='<int>', type=int)
+parser.add_argument('--engine', help='<reference,vectorized>', type=str)
+parser.add_argument('--verify', help='<int>', type=int)
+parser.add_argument('--watch', help='<directory>', type=str)
+parser.add_argument('--workers', help='<int>', type=int)
+parser.add_argument('--poll', help='<scalar>', type=float)
+parser.add_argument('--once', action='store_true')
+parser.add_argument('--review', help='<directory>', type=str)
+parser.add_argument('--port', help='<int>', type=int)
+parser.add_argument('--shard_manifest', help='<directory>', type=str)
+parser.add_argument('--shards', help='<int>', type=int)
+parser.add_argument('--shard_run', help='<directory>', type=str)
+parser.add_argument('--shard_index', help='<int>', type=int)
+parser.add_argument('--shard_merge', help='<directory>', type=str)
+parser.add_argument('--index', help='<database>', type=str)
+parser.add_argument('--tag', help='<key=value>', type=str, action='append')
+parser.add_argument('--query', help='<sql>', type=str)
+parser.add_argument('--max_memory', help='<scalar>', type=float)
+parser.add_argument('--plan_iterations', help='<int>', type=int)
+parser.add_argument('--dry_run', action='store_true')
 
 # Set defaults
 parser.set_defaults(spatial_unit='voxel')
+parser.set_defaults(labels=None)
+parser.set_defaults(segment=0)
+parser.set_defaults(segment_median='sketch')
 parser.set_defaults(slice_axis=2)
 parser.set_defaults(time_axis=3)
 parser.set_defaults(var_threshold=5)
 parser.set_defaults(one_shot=False)
 parser.set_defaults(output='tsvarana')
+parser.set_defaults(max_size=1000000)
+parser.set_defaults(session=None)
+parser.set_defaults(cache=None)
+parser.set_defaults(cache_size=50)
+parser.set_defaults(checkpoint=None)
+parser.set_defaults(resume=False)
+parser.set_defaults(lazy=False)
+parser.set_defaults(window=None)
+parser.set_defaults(masked=False)
+parser.set_defaults(pyramid=0)
+parser.set_defaults(triage=False)
+parser.set_defaults(triage_voxels=tsvarana.triage.TRIAGE_VOXELS)
+parser.set_defaults(engine='reference')
+parser.set_defaults(verify=0)
+parser.set_defaults(workers=2)
+parser.set_defaults(poll=1)
+parser.set_defaults(once=False)
+parser.set_defaults(port=tsvarana.review.REVIEW_PORT)
+parser.set_defaults(shards=1)
+parser.set_defaults(shard_index=os.environ.get('SLURM_ARRAY_TASK_ID'))
+parser.set_defaults(index=None)
+parser.set_defaults(tag=[])
+parser.set_defaults(query=None)
+parser.set_defaults(max_memory=None)
+parser.set_defaults(plan_iterations=tsvarana.planner.PLAN_ITERATIONS)
+parser.set_defaults(dry_run=False)
 
 # Parse input arguments
 args = parser.parse_args()
 
+# Either a data file, a watch directory, a shard directory, a query or a
+# session to review is needed
+if not (args.data or args.watch or args.shard_run or args.shard_merge or
+        args.query or args.review):
+    parser.error(
+        'one of the arguments --data --watch --shard_run --shard_merge '
+        '--query --review is required'
+    )
+if args.query and not args.index:
+    parser.error('argument --index is required with --query')
+if args.shard_run and args.shard_index is None:
+    parser.error('argument --shard_index is required with --shard_run')
+if args.shard_index is not None:
+    args.shard_index = int(args.shard_index)
+
 # ====
 # MAIN
 # ====
 
+# Query the results index
+if args.query:
+    tsvarana.command.query_routine(args)
+
+# Serve an interactive review of a session
+elif args.review:
+    tsvarana.review.review_serve(args.review, port=args.port)
+
+# Run as a watch-folder service
+elif args.watch:
+    tsvarana.service.service_routine(args)
+
+# Shard-and-merge processing
+elif args.shard_manifest:
+    tsvarana.shard.shard_manifest(args)
+elif args.shard_run:
+    tsvarana.shard.shard_run(args)
+elif args.shard_merge:
+    tsvarana.shard.shard_merge(args)
+
 # Execute default tsvarana routine
-tsvarana.command.default_routine(args)
+else:
+    tsvarana.command.default_routine(args)
 
 # Done
 #
@@ -0,0 +1,567 @@
+# aio.py
+#
+# tsvarana asyncio interface.
+#
+# Runs tsvarana from an asyncio event loop without blocking it, e.g. in a
+# web service. Jobs run in stages, and every stage is offloaded to an
+# executor: NIFTI loading and output writing to an input/output executor,
+# variance analysis and scrubbing to a compute executor. Either executor
+# can be a thread pool or a process pool
+#   backpressure  at most max_jobs jobs are in flight, and submitting one
+#                 more waits until a job finishes
+#   progress      every job streams progress events, one per stage and one
+#                 per scrub iteration, as an async iterator
+#   cancellation  cancelling a job stops scrubbing after the current
+#                 iteration. Its slot is freed once the executor has
+#                 stopped, so in-flight jobs stay bounded
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import time
+import queue
+import asyncio
+import threading
+import collections
+import multiprocessing
+import nibabel as nib
+from concurrent import futures
+
+# Project dependencies
+import tsvarana
+
+# Default maximum number of jobs in flight
+AIO_JOBS = 4
+
+# Seconds between checks for progress events from the executor
+AIO_POLL = 0.05
+
+# Progress event
+#   job          [string] Job name
+#   stage        [string] 'load', 'compute', 'iteration' or 'output' as
+#                         the job goes, then 'done', 'failed' or
+#                         'cancelled'
+#   iteration    [scalar] Scrub iteration, iteration events only
+#   n_flagged    [scalar] Timepoints flagged, iteration events only
+#   time         [scalar] Time of the event, as given by time.time
+aio_event = collections.namedtuple(
+    'aio_event',
+    [
+        'job',
+        'stage',
+        'iteration',
+        'n_flagged',
+        'time',
+    ]
+)
+aio_event.__new__.__defaults__ = (None, None, None)
+
+# Stages after which a job sends no further events
+AIO_FINAL = ('done', 'failed', 'cancelled')
+
+
+class aio_cancelled(Exception):
+    '''
+    Raised in the executor to stop a cancelled job between iterations
+    '''
+
+# =======
+# WORKERS
+# =======
+
+
+def aio_progress(events, cancel, job):
+    '''
+    Progress callback for scrubbing in the executor, see
+    tsvarana.pipeline.pipeline_iterative. Sends an event after every
+    iteration, and stops cancelled jobs
+
+    Inputs
+        events      [object] Queue of progress events
+        cancel      [object] Event set once the job is cancelled
+        job         [string] Job name
+    Outputs
+        progress    [func  ] Progress callback
+    '''
+
+    # Callback
+    def progress(iteration, n_flagged):
+        events.put(aio_event(job, 'iteration', iteration, n_flagged,
+                             time.time()))
+        if cancel.is_set():
+            raise aio_cancelled('Error: job ' + job + ' was cancelled.')
+
+    # Return
+    return progress
+
+
+def aio_load(path):
+    '''
+    Read a NIFTI data file, in the executor
+
+    Inputs
+        path        [string] NIFTI file
+    Outputs
+        data        [array ] N-dimensional voxelwise data array
+    '''
+    return nib.load(path).get_fdata()
+
+
+def aio_scrub(data, config, iterative, events, cancel, job):
+    '''
+    Scrub data, in the executor, as in tsvarana.pipeline
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        config      [object] tsvarana.pipeline.varana_config
+        iterative   [ bool ] If True, scrub iteratively, otherwise once
+        events, cancel, job  As in aio_progress
+    Outputs
+        result      [object] tsvarana.pipeline.varana_result
+    '''
+
+    # Progress callback
+    progress = aio_progress(events, cancel, job)
+
+    # Iterative scrubbing
+    if iterative:
+        return tsvarana.pipeline.pipeline_iterative(
+            data,
+            config,
+            progress=progress
+        )
+
+    # One-shot scrubbing, a single iteration
+    result = tsvarana.pipeline.pipeline_oneshot(data, config)
+    progress(1, int(result.regressor[0].sum()))
+
+    # Return
+    return result
+
+
+def aio_compute(data, args, timing, events, cancel, job):
+    '''
+    Triage & scrub data, in the executor, as in
+    tsvarana.command.compute_routine
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        args        [object] As in tsvarana.command.default_routine
+        timing      [dict  ] Seconds spent on earlier steps
+        events, cancel, job  As in aio_progress
+    Outputs
+        varana, status, scratch  As in tsvarana.command.compute_routine
+        timing      [dict  ] Seconds spent on each step
+    '''
+
+    # Compute, with timing updated in this process
+    varana, status, scratch = tsvarana.command.compute_routine(
+        data,
+        args,
+        timing,
+        aio_progress(events, cancel, job)
+    )
+
+    # Return
+    return varana, status, scratch, timing
+
+# =======
+# AIO_JOB
+# =======
+
+
+class aio_job():
+    '''
+    A job in flight, as returned by aio_runner. Iterate over the job with
+    async for to receive its progress events, await job.result() for its
+    result, and call job.cancel() to stop it.
+    '''
+
+    def __init__(self, name, events, cancel):
+        '''
+        Parameters
+            name : string
+                Job name, sent with every event
+            events : queue
+                Queue of progress events sent from the executor
+            cancel : event
+                Event set once the job is cancelled, checked in the
+                executor after every scrub iteration
+        '''
+
+        # Set parameters
+        self.name = name
+        self.events = events
+        self.cancel_event = cancel
+
+        # Events received, in order
+        self.queue = asyncio.Queue()
+
+        # Task running the job stages
+        self.task = None
+
+    def __aiter__(self):
+        '''
+        Iterate over progress events, until the job finishes
+        '''
+        return self.stream()
+
+    async def stream(self):
+        '''
+        Yield progress events, until the job finishes
+        '''
+        while True:
+            event = await self.queue.get()
+            yield event
+            if event.stage in AIO_FINAL:
+                return
+
+    async def result(self):
+        '''
+        Wait for the job, and return its result. Cancelling the caller
+        does not cancel the job
+        '''
+        return await asyncio.shield(self.task)
+
+    def cancel(self):
+        '''
+        Cancel the job. Scrubbing stops after the current iteration, other
+        stages once they finish
+        '''
+        self.cancel_event.set()
+        self.task.cancel()
+
+    def done(self):
+        '''
+        Return True once the job has finished
+        '''
+        return self.task.done()
+
+    def send(self, stage):
+        '''
+        Send a progress event for a stage of the job
+
+        Inputs
+            stage   [string] Stage, see aio_event
+        '''
+        self.queue.put_nowait(aio_event(self.name, stage, time=time.time()))
+
+    def receive(self):
+        '''
+        Forward progress events sent from the executor
+        '''
+        while True:
+            try:
+                self.queue.put_nowait(self.events.get_nowait())
+            except queue.Empty:
+                return
+
+    async def stage(self, executor, func, *args):
+        '''
+        Run one stage of the job in an executor, forwarding progress events
+        until it finishes. If cancelled, wait for the executor to stop
+
+        Inputs
+            executor [object] concurrent.futures executor
+            func     [func  ] Stage function
+            args     [list  ] Stage function inputs
+        Outputs
+            result   [object] Stage function output
+        '''
+
+        # Submit
+        future = executor.submit(func, *args)
+        waiter = asyncio.wrap_future(future)
+
+        # Wait, forwarding events
+        try:
+            while not waiter.done():
+                await asyncio.wait([waiter], timeout=AIO_POLL)
+                self.receive()
+
+        # Stop the executor between iterations, unless it has not started
+        except asyncio.CancelledError:
+            self.cancel_event.set()
+            if not future.cancel():
+                await asyncio.wait([waiter])
+                self.receive()
+                if not waiter.cancelled():
+                    waiter.exception()
+            raise
+
+        # Return
+        return waiter.result()
+
+# ==========
+# AIO_RUNNER
+# ==========
+
+
+class aio_runner():
+    '''
+    Asyncio interface to tsvarana, with stages of every job offloaded to
+    executors, and a bounded number of jobs in flight. Use as an async
+    context manager, or call close() when done.
+    '''
+
+    def __init__(self, executor=None, io_executor=None, max_jobs=AIO_JOBS):
+        '''
+        Parameters
+            executor : concurrent.futures executor
+                Executor for variance analysis and scrubbing, a thread pool
+                or a process pool. Data is copied to and from process
+                pools
+                default = a thread pool of max_jobs threads
+            io_executor : concurrent.futures executor
+                Executor for NIFTI loading and output writing
+                default = a thread pool of max_jobs threads
+            max_jobs : integer
+                Maximum number of jobs in flight. Submitting one more waits
+                until a job finishes
+                default = AIO_JOBS
+        '''
+
+        # Executors, shut down on close if created here
+        self.owned = []
+        if executor is None:
+            executor = futures.ThreadPoolExecutor(max_workers=max_jobs)
+            self.owned.append(executor)
+        if io_executor is None:
+            io_executor = futures.ThreadPoolExecutor(max_workers=max_jobs)
+            self.owned.append(io_executor)
+        self.executor = executor
+        self.io_executor = io_executor
+
+        # Job slots, created in the event loop with the first job
+        self.max_jobs = max_jobs
+        self.slots = None
+
+        # Progress queues & cancel events shared with worker processes,
+        # started with the first job sent to a process pool
+        self.manager = None
+
+        # Job counter
+        self.counter = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        '''
+        Shut down executors created by this runner, once their jobs finish
+        '''
+        loop = asyncio.get_running_loop()
+        for executor in self.owned:
+            await loop.run_in_executor(None, executor.shutdown)
+        if self.manager is not None:
+            self.manager.shutdown()
+
+    async def start(self, name, stages):
+        '''
+        Wait for a free slot, then start a job
+
+        Inputs
+            name    [string] Job name, numbered if None
+            stages  [func  ] Coroutine function running the job stages,
+                             given the job
+        Outputs
+            job     [object] aio_job
+        '''
+
+        # Backpressure
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_jobs)
+        await self.slots.acquire()
+
+        # Progress queue & cancel event reaching the compute executor
+        if isinstance(self.executor, futures.ProcessPoolExecutor):
+            if self.manager is None:
+                self.manager = multiprocessing.Manager()
+            events, cancel = self.manager.Queue(), self.manager.Event()
+        else:
+            events, cancel = queue.Queue(), threading.Event()
+
+        # Job
+        self.counter += 1
+        job = aio_job(name or 'job' + str(self.counter), events, cancel)
+
+        # Run stages, freeing the slot however the job ends
+        job.task = asyncio.ensure_future(self.run(job, stages))
+        job.task.add_done_callback(lambda task: self.slots.release())
+
+        # Return
+        return job
+
+    async def run(self, job, stages):
+        '''
+        Run the stages of a job, sending the final event
+
+        Inputs
+            job     [object] aio_job
+            stages  [func  ] As in start
+        Outputs
+            result  [object] Job result
+        '''
+        try:
+            result = await stages(job)
+        except (asyncio.CancelledError, aio_cancelled):
+            job.send('cancelled')
+            raise asyncio.CancelledError()
+        except Exception:
+            job.send('failed')
+            raise
+        job.send('done')
+        return result
+
+    async def submit(self, data, config, iterative=True, name=None):
+        '''
+        Submit a scrubbing job, once a slot is free
+
+        Inputs
+            data      [array ] N-dimensional voxelwise data array, list of
+                               arrays with one run each, or NIFTI file
+                               read in the input/output executor
+            config    [object] tsvarana.pipeline.varana_config, or a
+                               tsvarana.classes.varana object
+            iterative [ bool ] If True, scrub iteratively, otherwise once
+            name      [string] Job name, numbered if None
+        Outputs
+            job       [object] aio_job, with a tsvarana.pipeline.varana_result
+                               as its result
+        '''
+
+        # Settings of varana objects
+        if isinstance(config, tsvarana.classes.varana):
+            config = config.get_config()
+
+        # Stages
+        async def stages(job):
+
+            # Read NIFTI data file
+            if isinstance(data, str):
+                job.send('load')
+                run = await job.stage(self.io_executor, aio_load, data)
+            else:
+                run = data
+
+            # Scrub
+            job.send('compute')
+            return await job.stage(
+                self.executor,
+                aio_scrub,
+                run,
+                config,
+                iterative,
+                job.events,
+                job.cancel_event,
+                job.name
+            )
+
+        # Start
+        return await self.start(name, stages)
+
+    async def submit_routine(self, args, name=None):
+        '''
+        Submit a job processing a NIFTI file and saving outputs, as in
+        tsvarana.command.default_routine, once a slot is free. Execution
+        planning is not supported
+
+        Inputs
+            args    [object] As in tsvarana.command.default_routine
+            name    [string] Job name, numbered if None
+        Outputs
+            job     [object] aio_job, with the tsvarana.classes.varana object
+                             as its result, None for clean runs
+        '''
+
+        # Planning runs its own strategies, see tsvarana.planner
+        if args.max_memory is not None or args.dry_run:
+            raise TypeError(
+                'Error: execution planning is not supported by aio_runner.'
+            )
+
+        # Stages
+        async def stages(job):
+
+            # Read NIFTI data file
+            job.send('load')
+            start = time.time()
+            data, affine = await job.stage(
+                self.io_executor,
+                tsvarana.command.load_routine,
+                args
+            )
+
+            # Triage & scrub
+            job.send('compute')
+            varana, status, scratch, timing = await job.stage(
+                self.executor,
+                aio_compute,
+                data,
+                args,
+                {'load': time.time() - start},
+                job.events,
+                job.cancel_event,
+                job.name
+            )
+
+            # Save session & outputs
+            job.send('output')
+            await job.stage(
+                self.io_executor,
+                tsvarana.command.finish_routine,
+                varana,
+                affine,
+                args,
+                timing,
+                status,
+                scratch
+            )
+
+            # Return
+            return varana
+
+        # Start
+        return await self.start(name, stages)
+
+    async def scrub(self, varana, data, iterative=True):
+        '''
+        Scrub data without blocking the event loop, as in
+        varana.scrub_iterative, or varana.scrub_oneshot
+
+        Inputs
+            varana    [object] tsvarana.classes.varana, results are stored
+                               on it
+            data      [array ] As in submit
+            iterative [ bool ] If True, scrub iteratively, otherwise once
+        Outputs
+            varana    [object] The same object, with results
+        '''
+        job = await self.submit(data, varana, iterative)
+        varana.set_result(await job.result())
+        return varana
+
+    async def routine(self, args):
+        '''
+        Process a NIFTI file and save outputs without blocking the event
+        loop, as in tsvarana.command.default_routine
+
+        Inputs
+            args    [object] As in submit_routine
+        Outputs
+            varana  [object] tsvarana.classes.varana, None for clean runs
+        '''
+        job = await self.submit_routine(args)
+        return await job.result()
+
+# Done
+#
@@ -0,0 +1,208 @@
+# cache.py
+#
+# tsvarana input cache.
+#
+# Decompressing gzipped NIFTI files is slow, and the same runs are often
+# analysed many times. The cache decompresses each input once into an
+# uncompressed .npy file, stored time-major (one contiguous block per
+# timepoint), which later loads are served from as a read-only memory map.
+# Entries are keyed by input path, modification time, size and time axis,
+# so a modified input is never served stale, and the least recently used
+# entries are evicted once the cache grows beyond its size limit.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+
+# Default cache directory, unless set with the TSVARANA_CACHE variable
+CACHE_DIR = os.environ.get(
+    'TSVARANA_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'tsvarana')
+)
+
+# Default cache size limit, in bytes
+CACHE_SIZE = 50 * 1024 ** 3
+
+# ==========
+# CACHE_LOAD
+# ==========
+
+
+def cache_load(path, time_axis=3, cache_dir=None, max_size=CACHE_SIZE):
+    '''
+    Load a NIFTI file through the input cache.
+
+    Inputs
+        path        [string] NIFTI file
+        time_axis   [scalar] Axis along which time is stored
+        cache_dir   [string] Cache directory, defaults to CACHE_DIR
+        max_size    [scalar] Cache size limit in bytes
+    Outputs
+        data        [array ] Read-only memory-mapped float data, with the
+                             same axis order as the NIFTI file
+        header      [object] nibabel image, for the affine & header
+    '''
+
+    # Cache directory
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Read NIFTI header only
+    header = nib.load(path)
+
+    # Entry for this input
+    entry = os.path.join(cache_dir, cache_key(path, time_axis) + '.npy')
+
+    # Decompress on a cache miss
+    if not os.path.exists(entry):
+        cache_fill(path, entry, time_axis)
+        cache_evict(cache_dir, max_size, keep=entry)
+
+    # Mark as recently used
+    os.utime(entry)
+
+    # Time-major memory map, back to the original axis order
+    data = np.load(entry, mmap_mode='r')
+    data = np.moveaxis(data, 0, time_axis)
+
+    # Return
+    return data, header
+
+# =========
+# UTILITIES
+# =========
+
+
+def cache_key(path, time_axis):
+    '''
+    Cache key of an input file
+
+    Inputs
+        path        [string] NIFTI file
+        time_axis   [scalar] Axis along which time is stored
+    Outputs
+        key         [string] Hex digest of path, mtime, size & time axis
+    '''
+
+    # File identity
+    stat = os.stat(path)
+    identity = '|'.join([
+        os.path.abspath(path),
+        str(stat.st_mtime_ns),
+        str(stat.st_size),
+        str(time_axis),
+    ])
+
+    # Return
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def cache_fill(path, entry, time_axis):
+    '''
+    Decompress a NIFTI file into a time-major cache entry. Gzipped inputs
+    are decompressed once to a temporary file, with pigz when it is
+    installed, as reading them a timepoint at a time would decompress from
+    the start on every read. The entry is written under a temporary name
+    and moved into place when complete.
+
+    Inputs
+        path        [string] NIFTI file
+        entry       [string] Cache entry file
+        time_axis   [scalar] Axis along which time is stored
+    '''
+
+    # Temporary files, in the cache directory
+    cache_dir = os.path.dirname(entry)
+    tmp_entry = entry + '.' + str(os.getpid()) + '.tmp'
+    tmp_nifti = None
+
+    try:
+
+        # Decompression to an uncompressed NIFTI file, in parallel when
+        # pigz is installed
+        if path.endswith('.gz'):
+            fid, tmp_nifti = tempfile.mkstemp(suffix='.nii', dir=cache_dir)
+            with os.fdopen(fid, 'wb') as out:
+                if shutil.which('pigz'):
+                    subprocess.run(['pigz', '-dc', path], stdout=out,
+                                   check=True)
+                else:
+                    with gzip.open(path, 'rb') as source:
+                        shutil.copyfileobj(source, out, 1024 ** 2)
+            header = nib.load(tmp_nifti)
+        else:
+            header = nib.load(path)
+
+        # Time-major output array
+        shape = list(header.shape)
+        n_timepoints = shape.pop(time_axis)
+        data = np.lib.format.open_memmap(
+            tmp_entry,
+            mode='w+',
+            dtype=float,
+            shape=tuple([n_timepoints] + shape)
+        )
+
+        # Copy one timepoint at a time, so memory use stays bounded
+        slicer = [slice(None)] * len(header.shape)
+        for t in range(n_timepoints):
+            slicer[time_axis] = t
+            data[t] = header.dataobj[tuple(slicer)]
+        data.flush()
+        del data
+
+        # Move into place
+        os.replace(tmp_entry, entry)
+
+    # Clean up
+    finally:
+        if tmp_nifti is not None and os.path.exists(tmp_nifti):
+            os.remove(tmp_nifti)
+        if os.path.exists(tmp_entry):
+            os.remove(tmp_entry)
+
+
+def cache_evict(cache_dir, max_size, keep=None):
+    '''
+    Remove least recently used entries until the cache fits its size limit
+
+    Inputs
+        cache_dir   [string] Cache directory
+        max_size    [scalar] Cache size limit in bytes
+        keep        [string] Entry that is never evicted
+    '''
+
+    # Cache entries, least recently used first
+    entries = [
+        entry for entry in os.scandir(cache_dir)
+        if entry.is_file() and entry.name.endswith('.npy')
+    ]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+
+    # Total size
+    total = sum(entry.stat().st_size for entry in entries)
+
+    # Evict
+    for entry in entries:
+        if total <= max_size:
+            break
+        if entry.path == keep:
+            continue
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+# Done
+#
@@ -10,15 +10,26 @@
 # =========
 
 # Project dependencies
-from tsvarana.core import (
-    variance_calc,
-    threshold_test,
-    scrub
+from tsvarana.pipeline import (
+    PIPELINE_UNITS,
+    varana_config,
+    varana_result,
+    pipeline_detect,
+    pipeline_oneshot,
+    pipeline_iterative,
+    pipeline_units,
+    pipeline_split
 )
-from tsvarana.utils import (
-    parse_spatial_unit,
-    regressor_final
+from tsvarana.session import (
+    session_save,
+    session_load
 )
+from tsvarana.triage import (
+    TRIAGE_VOXELS,
+    TRIAGE_ALPHA,
+    triage_run
+)
+from tsvarana.utils import regressor_final
 
 # ======
 # VARANA
@@ -28,17 +39,32 @@ from tsvarana.utils import (
 class varana():
     '''
     Variance analysis class.
+
+    A thin stateful wrapper over tsvarana.pipeline. Settings are read from
+    the attributes of this object on every call, and results are stored
+    back on it. Use the pipeline functions directly to share one
+    configuration across threads.
     '''
 
     def __init__(self,
                  spatial_unit='voxel',
                  slice_axis=2,
                  time_axis=3,
-                 var_threshold=5):
+                 var_threshold=5,
+                 run_axis=None,
+                 lazy=False,
+                 engine='reference',
+                 verify=0,
+                 window=None,
+                 masked=False,
+                 pyramid=0,
+                 labels=None,
+                 segment=0,
+                 segment_median='sketch'):
         '''
         Parameters
             spatial_unit : string
-                'voxel', 'slice' or 'volume'
+                'voxel', 'slice', 'volume' or 'label'
             slice_axis : integer
                 Axis long which the slice dimension is defined
                 default for (x,y,z,t) data is slice_axis=2
@@ -48,6 +74,58 @@ class varana():
             var_threshold : scalar
                 Normalised variance threshold
                 default = 5
+            run_axis : integer
+                Axis along which runs are stacked, for batch processing of
+                several runs with identical geometry. Lists of runs are
+                always treated as a batch. slice_axis and time_axis refer
+                to the axes of a single run
+                default = None
+            lazy : bool
+                If True, scrubbed data is returned as a lazy
+                tsvarana.view.scrubview, which records replacement
+                intervals instead of copying the data
+                default = False
+            engine : string
+                Implementation of the core steps, see tsvarana.engine,
+                'reference' or 'vectorized'
+                default = 'reference'
+            verify : integer
+                If non-zero, check every step against the reference engine
+                on this many randomly sampled voxels
+                default = 0
+            window : integer
+                If specified, compare each timepoint against a rolling
+                median over this odd number of timepoints, instead of the
+                median of the whole run, to follow slow signal drift
+                default = None
+            masked : bool
+                If True, iterative scrubbing excludes timepoints already
+                flagged from the median and mean intensity, and scrubs once
+                at the end. If False, every iteration scrubs the data and
+                recomputes the median from it
+                default = False
+            pyramid : integer
+                If non-zero, calculate voxel-unit variance coarse-to-fine
+                over this many pyramid levels, see tsvarana.pyramid. Only
+                voxels that could exceed the threshold get their variance
+                calculated, others have zero variance, and the regressor is
+                unchanged
+                default = 0
+            labels : array
+                Integer label image with the spatial shape of a run, for the
+                'label' unit. Mean variance is tested per label, and label 0
+                is background, never flagged
+                default = None
+            segment : integer
+                If non-zero, scrub this many timepoints at a time, for
+                very long runs, see tsvarana.segment. Results are memory
+                maps of files in a scratch directory
+                default = 0
+            segment_median : string
+                Median compared against when segmented, 'sketch' for the
+                median of the whole run, or 'segment' for the median of
+                each segment
+                default = 'sketch'
         '''
 
         # Set parameters
@@ -55,105 +133,250 @@ class varana():
         self.slice_axis = slice_axis
         self.time_axis = time_axis
         self.var_threshold = var_threshold
+        self.run_axis = run_axis
+        self.lazy = lazy
+        self.engine = engine
+        self.verify = verify
+        self.window = window
+        self.masked = masked
+        self.pyramid = pyramid
+        self.labels = labels
+        self.segment = segment
+        self.segment_median = segment_median
+
+    def get_config(self):
+        '''
+        Return frozen copy of the current settings, as a
+        tsvarana.pipeline.varana_config
+        '''
+        return varana_config(
+            spatial_unit=self.spatial_unit,
+            slice_axis=self.slice_axis,
+            time_axis=self.time_axis,
+            var_threshold=self.var_threshold,
+            run_axis=self.run_axis,
+            lazy=self.lazy,
+            engine=self.engine,
+            verify=self.verify,
+            window=self.window,
+            masked=self.masked,
+            pyramid=self.pyramid,
+            labels=self.labels,
+            segment=self.segment,
+            segment_median=self.segment_median
+        )
 
-    def detect(self, data):
+    def set_result(self, result):
         '''
-        Calculate timepoint-to-median variance using setting stored in _self_,
-        then compared the empirical normalised variance against the variance
-        threshold given
+        Store results from a tsvarana.pipeline function on this object
 
         Inputs
-            data    [array ] N-dimensional voxelwise data array
+            result  [object] tsvarana.pipeline.varana_result
         '''
 
-        # Update summary axis
-        self.summary_axis = parse_spatial_unit(
-            self.spatial_unit,
-            data.ndim,
-            self.slice_axis,
-            self.time_axis
+        # Store
+        self.summary_axis = result.summary_axis
+        self.variance = list(result.variance)
+        self.regressor = list(result.regressor)
+        self.n_runs = result.n_runs
+        self.n_iter = result.n_iter
+        if result.data_scrub is not None:
+            self.data_scrub = result.data_scrub
+
+    def get_result(self):
+        '''
+        Return results stored on this object, as a
+        tsvarana.pipeline.varana_result
+        '''
+        return varana_result(
+            config=self.get_config(),
+            summary_axis=self.summary_axis,
+            variance=tuple(self.variance),
+            regressor=tuple(self.regressor),
+            data_scrub=getattr(self, 'data_scrub', None),
+            n_runs=self.n_runs,
+            n_iter=self.n_iter
         )
 
-        # Variance calculation
-        vw_variance = variance_calc(data, self.time_axis)
+    def detect(self, data):
+        '''
+        Calculate timepoint-to-median variance using setting stored in _self_,
+        then compared the empirical normalised variance against the variance
+        threshold given
 
-        # Threshold test
-        regressor = threshold_test(
-            vw_variance,
-            self.summary_axis,
-            self.var_threshold
-        )
+        In batch mode, outputs are stacked with runs along the first axis
 
-        # Store
-        self.variance = [vw_variance]
-        self.regressor = [regressor]
+        Inputs
+            data    [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        '''
+        self.set_result(pipeline_detect(data, self.get_config()))
 
-    def scrub_oneshot(self, data):
+    def scrub_oneshot(self, data, scratch=None):
         '''
         Perform one-shot data scrubbing
 
         Inputs
-            data    [array ] N-dimensional voxelwise data array
+            data    [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+            scratch [string] Directory for the results of segmented runs,
+                             a new temporary directory if None
         '''
-
-        # Run detection
-        self.detect(data)
-
-        # Scrubbing
-        data_scrub = scrub(
+        self.set_result(pipeline_oneshot(
             data,
-            self.regressor[0],
-            self.time_axis
-        )
+            self.get_config(),
+            scratch=scratch
+        ))
 
-        # Store
-        self.data_scrub = data_scrub
-
-    def scrub_iterative(self, data):
+    def scrub_iterative(self, data, checkpoint=None, checkpoint_every=1,
+                        resume=False, scratch=None, progress=None):
         '''
         Perform iterative variance calculation and data scrubbing,
         until no timepoints get replaced.
 
+        In batch mode, each run drops out of later iterations once no
+        timepoints get replaced
+
         Inputs
-            data    [array ] N-dimensional voxelwise data array
+            data    [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+            checkpoint [string] If specified, save the scrub state to this
+                             directory every checkpoint_every iterations
+            resume  [ bool ] If True, continue from the last checkpoint
+            scratch [string] Directory for the results of segmented runs,
+                             a new temporary directory if None
+            progress [func ] If specified, called after every iteration
+                             with the iteration number and the number of
+                             timepoints flagged, see
+                             tsvarana.pipeline.pipeline_iterative
         '''
+        self.set_result(pipeline_iterative(
+            data,
+            self.get_config(),
+            checkpoint=checkpoint,
+            checkpoint_every=checkpoint_every,
+            resume=resume,
+            scratch=scratch,
+            progress=progress
+        ))
+
+    def triage(self, data, n_voxels=TRIAGE_VOXELS, alpha=TRIAGE_ALPHA,
+               escalate=False, seed=None):
+        '''
+        Estimate from a sample of voxels whether any slice or volume
+        exceeds the variance threshold, see tsvarana.triage. The triage
+        result is stored in self.triage_result
 
-        # Empty lists
-        var_iter = []
-        reg_iter = []
+        Inputs
+            data     [array ] N-dimensional voxelwise data array
+            n_voxels [scalar] Number of voxels sampled per slice
+            alpha    [scalar] Family-wise error rate of the bounds
+            escalate [ bool ] If True, run iterative scrubbing unless the
+                              run is clean
+            seed     [scalar] Random seed of the voxel sample
+        Outputs
+            status   [string] 'clean', 'dirty' or 'uncertain'
+        '''
 
-        # Iteration counter
-        counter = 0
+        # Triage
+        self.triage_result = triage_run(
+            data,
+            self.get_config(),
+            n_voxels=n_voxels,
+            alpha=alpha,
+            seed=seed
+        )
 
-        # Start infinite loop
-        while True:
+        # Full pipeline when needed
+        if escalate and self.triage_result.status != 'clean':
+            self.scrub_iterative(data)
 
-            # Update counter
-            counter += 1
+        # Return
+        return self.triage_result.status
 
-            # Message
-            print('Iteration: ' + str(counter))
+    def detect_units(self, data, units=PIPELINE_UNITS, iterative=False):
+        '''
+        Run several spatial units from one shared median & variance
+        calculation, see tsvarana.pipeline.pipeline_units. Results match
+        a separate varana object per unit, with its spatial unit set
 
-            # Run scrubbing
-            self.scrub_oneshot(data)
+        Inputs
+            data      [array ] N-dimensional voxelwise data array,
+                               or list of arrays with one run each
+            units     [tuple ] Spatial units, e.g. ('slice', 'volume')
+            iterative [ bool ] If True, scrub each unit iteratively,
+                               otherwise detect only
+        Outputs
+            runs      [dict  ] varana object of each unit
+        '''
 
-            # Message
-            print('Bad timepoints: ' + str(self.regressor[0].sum()))
+        # Empty dictionary
+        runs = {}
 
-            # Store voxelwise variance & regressor
-            var_iter.append(self.variance[0])
-            reg_iter.append(self.regressor[0])
+        # Loop units, with the settings they were run with
+        results = pipeline_units(data, self.get_config(), units, iterative)
+        for unit, result in results.items():
+            run = varana(**result.config._asdict())
+            run.set_result(result)
+            runs[unit] = run
 
-            # Re-assigned scrubbed data as the input for the next iteration
-            data = self.data_scrub
+        # Return
+        return runs
 
-            # Exit clause
-            if self.regressor[0].sum() == 0:
-                break
+    def get_runs(self):
+        '''
+        Return list of single-run varana objects, one per run in the batch
+        '''
+
+        # Empty list
+        runs = []
+
+        # Loop runs
+        for result in pipeline_split(self.get_result()):
+
+            # Same settings, single run
+            run = varana(
+                spatial_unit=self.spatial_unit,
+                slice_axis=self.slice_axis,
+                time_axis=self.time_axis,
+                var_threshold=self.var_threshold,
+                engine=self.engine,
+                verify=self.verify,
+                window=self.window,
+                masked=self.masked,
+                pyramid=self.pyramid,
+                labels=self.labels,
+                segment=self.segment,
+                segment_median=self.segment_median
+            )
+            run.set_result(result)
+
+            # Store
+            runs.append(run)
+
+        # Return
+        return runs
+
+    def save(self, path, affine=None):
+        '''
+        Save settings and results to a session directory, see
+        tsvarana.session
 
-        # Iterations finished, re-assign variance & regressor lists
-        self.variance = var_iter
-        self.regressor = reg_iter
+        Inputs
+            path    [string] Session directory
+            affine  [array ] NIFTI affine, restored as self.affine on load
+        '''
+        session_save(self, path, affine)
+
+    def load(self, path):
+        '''
+        Load settings and results from a session directory, with arrays
+        memory-mapped rather than read into memory
+
+        Inputs
+            path    [string] Session directory
+        '''
+        session_load(self, path)
 
     def get_variance(self):
         '''
@@ -175,7 +398,8 @@ class varana():
 
     def get_data_scrub(self):
         '''
-        Return final scrubbed data
+        Return final scrubbed data, as a lazy tsvarana.view.scrubview if
+        lazy is set
         '''
         return self.data_scrub
 
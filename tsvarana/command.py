@@ -10,6 +10,12 @@
 # =========
 
 # Libraries
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
 import nibabel as nib
 
 # Project dependencies
@@ -27,7 +33,15 @@ def default_routine(args):
     Inputs
       args.data           [string] A 4D NIFTI fila
       args.spatial_unit   [string] Calculate mean variance along the specified
-                                   spatial unit: 'voxel', 'slice' or 'volume'
+                                   spatial unit: 'voxel', 'slice', 'volume'
+                                   or 'label'
+      args.labels         [string] Integer label NIFTI file, label unit only
+      args.segment        [scalar] If non-zero, scrub this many timepoints at
+                                   a time, reading the NIFTI file a segment
+                                   at a time. Gzipped files are first
+                                   decompressed into the input cache
+      args.segment_median [string] 'sketch' for the median of the whole run,
+                                   'segment' for the median of each segment
       args.slice_axis     [scalar] Axis long which slice dimension is defined
                                    default for (x,y,z,t) data is slice_axis=2
       args.time_axis      [scalar] Axis long which time is stored
@@ -35,11 +49,177 @@ def default_routine(args):
       args.var_threshold  [scalar] Normalised variance threshold for scrubbing
       args.one_shot       [ bool ] If True, perform a single scrub iteration
       args.output         [string] Basename for output files
+      args.max_size       [scalar] Maximum number of data values embedded
+                                   in the HTML report
+      args.session        [string] If specified, save a session directory
+                                   for reloading results without recomputing
+      args.cache          [string] If specified, read data through an input
+                                   cache in this directory
+      args.cache_size     [scalar] Input cache size limit, in GB
+      args.checkpoint     [string] If specified, checkpoint iterative
+                                   scrubbing to this directory
+      args.resume         [ bool ] If True, resume from the checkpoint
+      args.lazy           [ bool ] If True, record scrubbing as replacement
+                                   intervals and stream the scrubbed output
+      args.window         [scalar] If specified, compare each timepoint
+                                   against a rolling median over this odd
+                                   number of timepoints
+      args.masked         [ bool ] If True, exclude flagged timepoints from
+                                   the median and scrub once at the end
+      args.pyramid        [scalar] If non-zero, calculate voxel-unit
+                                   variance coarse-to-fine over this many
+                                   pyramid levels
+      args.engine         [string] Implementation of the core steps,
+                                   'reference' or 'vectorized'
+      args.verify         [scalar] If non-zero, check every step against the
+                                   reference engine on this many voxels
+      args.triage         [ bool ] If True, triage the run on a sample of
+                                   voxels first, and only process it fully
+                                   unless it is clean
+      args.triage_voxels  [scalar] Number of voxels sampled per slice
+      args.index          [string] If specified, add the run to this results
+                                   index, see tsvarana/index.py
+      args.tag            [list  ] 'key=value' tags stored in the index
+      args.max_memory     [scalar] If specified, memory budget in GB, used to
+                                   select an execution strategy
+      args.plan_iterations [scalar] Number of scrub iterations assumed when
+                                   planning
+      args.dry_run        [ bool ] If True, report the plan and stop
     '''
 
+    # Plan execution strategy from the NIFTI header
+    if args.max_memory is not None or args.dry_run:
+        plan = tsvarana.planner.plan_routine(args)
+        if args.dry_run:
+            return
+
+        # One slab at a time
+        if plan['strategy'] == 'shard':
+            args.shards = plan['shards']
+            tsvarana.shard.shard_local(args)
+            return
+
+        # Memory-mapped input
+        if plan['strategy'] == 'cache' and not args.cache:
+            args.cache = tsvarana.cache.CACHE_DIR
+
     # Read NIFTI data file
+    start = time.time()
+    data, affine = load_routine(args)
+
+    # Process & save outputs
+    process_routine(
+        data,
+        affine,
+        args,
+        timing={'load': time.time() - start}
+    )
+
+# ============
+# LOAD_ROUTINE
+# ============
+
+
+def load_routine(args):
+    '''
+    Read the NIFTI data file, as in default_routine.
+
+    Inputs
+      args.data           [string] A 4D NIFTI file
+      args.cache          [string] If specified, read data through an input
+                                   cache in this directory
+      ...                          Settings as in default_routine
+    Outputs
+      data                [array ] N-dimensional voxelwise data array, or
+                                   an array proxy for segmented runs
+      affine              [array ] NIFTI affine for output files
+    '''
+
+    # Segmented runs read segments from the file as needed, except for
+    # triage, which samples the whole run. Gzipped files would be
+    # decompressed from the start for every segment, so they are
+    # decompressed once, into the input cache
+    segmented = args.segment and not args.triage
+    cache_dir = args.cache
+    if segmented and args.data.endswith('.gz') and not cache_dir:
+        cache_dir = tsvarana.cache.CACHE_DIR
+
+    # Through the input cache if requested
+    if cache_dir:
+        data, header = tsvarana.cache.cache_load(
+            args.data,
+            time_axis=args.time_axis,
+            cache_dir=cache_dir,
+            max_size=args.cache_size * 1024 ** 3
+        )
+        return data, header.affine
+
+    # Uncompressed segmented runs are read in place
     header = nib.load(args.data)
-    data = header.get_fdata()
+    if segmented:
+        data = header.dataobj
+    else:
+        data = header.get_fdata()
+
+    # Return
+    return data, header.affine
+
+# ===============
+# PROCESS_ROUTINE
+# ===============
+
+
+def process_routine(data, affine, args, timing=None, progress=None):
+    '''
+    Process data already in memory and save outputs, as in default_routine.
+
+    Inputs
+      data                [array ] N-dimensional voxelwise data array
+      affine              [array ] NIFTI affine for output files
+      args                [object] As in default_routine, except args.data
+      timing              [dict  ] Seconds spent on earlier steps, e.g.
+                                   'load', for the results index
+      progress            [func  ] Called after every scrub iteration, see
+                                   tsvarana.pipeline.pipeline_iterative
+    '''
+
+    # Seconds spent on each step
+    timing = dict(timing or {})
+
+    # Process, then save outputs
+    varana, status, scratch = compute_routine(data, args, timing, progress)
+    finish_routine(varana, affine, args, timing, status, scratch)
+
+# ===============
+# COMPUTE_ROUTINE
+# ===============
+
+
+def compute_routine(data, args, timing, progress=None):
+    '''
+    Triage & scrub data, as in default_routine.
+
+    Inputs
+      data                [array ] N-dimensional voxelwise data array
+      args                [object] As in default_routine, except args.data
+      timing              [dict  ] Seconds spent on each step, updated in
+                                   place
+      progress            [func  ] As in process_routine
+    Outputs
+      varana              [object] As created by tsvarana.classes.varana,
+                                   after scrubbing, or None for clean runs
+      status              [string] Triage status, None if not triaged
+      scratch             [string] Directory of segmented results, to be
+                                   removed once outputs are saved, or None
+    '''
+
+    # Clean runs need no further processing
+    status = None
+    if args.triage:
+        status = triage_routine(data, args)
+        if status == 'clean':
+            return None, status, None
+    start = time.time()
 
     # Define the variance analysis model
     varana = tsvarana.classes.varana()
@@ -49,30 +229,267 @@ def default_routine(args):
     varana.slice_axis = args.slice_axis
     varana.time_axis = args.time_axis
     varana.var_threshold = args.var_threshold
+    varana.lazy = args.lazy
+    varana.window = args.window
+    varana.masked = args.masked
+    varana.pyramid = args.pyramid
+    varana.labels = labels_load(args.labels) if args.labels else None
+    varana.segment = args.segment
+    varana.segment_median = args.segment_median
+    varana.engine = args.engine
+    varana.verify = args.verify
 
-    # Perform single-shot variance analysis and scrubbing
-    if args.one_shot:
-        varana.scrub_oneshot(data)
+    # Segmented results are memory-mapped from next to the outputs, until
+    # the outputs are saved
+    scratch = None
+    if args.segment:
+        scratch = tempfile.mkdtemp(
+            prefix='tsvarana_',
+            dir=os.path.dirname(os.path.abspath(args.output))
+        )
 
-    # Perform iterative variance analysis and scrubbing
-    else:
-        varana.scrub_iterative(data)
+    # Segmented results of interrupted runs are not kept
+    try:
+
+        # Perform single-shot variance analysis and scrubbing
+        if args.one_shot:
+            varana.scrub_oneshot(data, scratch=scratch)
+
+        # Perform iterative variance analysis and scrubbing
+        else:
+            varana.scrub_iterative(
+                data,
+                checkpoint=args.checkpoint,
+                resume=args.resume,
+                scratch=scratch,
+                progress=progress
+            )
+    except BaseException:
+        if scratch:
+            shutil.rmtree(scratch)
+        raise
+
+    timing['compute'] = time.time() - start
+
+    # Return
+    return varana, status, scratch
+
+# ==============
+# FINISH_ROUTINE
+# ==============
+
+
+def finish_routine(varana, affine, args, timing, status=None, scratch=None):
+    '''
+    Save the session & outputs, add the run to the results index and remove
+    segmented results, as in default_routine.
+
+    Inputs
+      varana              [object] As returned by compute_routine
+      affine              [array ] NIFTI affine for output files
+      args                [object] As in default_routine
+      timing              [dict  ] Seconds spent on each step, updated in
+                                   place
+      status              [string] Triage status, None if not triaged
+      scratch             [string] Directory of segmented results, or None
+    '''
+
+    # Save session & outputs, clean runs have none
+    if varana is not None:
+        start = time.time()
+        if args.session:
+            varana.save(args.session, affine)
+        output_routine(varana, affine, args)
+        timing['output'] = time.time() - start
+
+    # Add to the results index
+    if args.index:
+        index_routine(varana, args, timing, status)
 
-    # Plot & save diagnostics
-    tsvarana.plot.diagnostic(varana, outfile=args.output + '_variance.html')
+    # Segmented results are no longer needed
+    if scratch:
+        shutil.rmtree(scratch)
 
-    # Plot & save regressors
-    tsvarana.plot.regressor(varana, outfile=args.output + '_regressor.html')
+# ===========
+# LABELS_LOAD
+# ===========
+
+
+def labels_load(path):
+    '''
+    Read an integer label image, for the label unit
+
+    Inputs
+      path                [string] A 3D NIFTI file of integer labels
+    Outputs
+      labels              [array ] Integer label image
+    '''
+
+    # Read as stored, labels are often saved as floats
+    labels = np.asanyarray(nib.load(path).dataobj)
+    if not np.issubdtype(labels.dtype, np.integer):
+        if not np.array_equal(labels, np.round(labels)):
+            raise TypeError('Error: labels must be integers, ' + path)
+        labels = np.round(labels).astype(int)
+
+    # Return
+    return labels
+
+# ==============
+# TRIAGE_ROUTINE
+# ==============
+
+
+def triage_routine(data, args):
+    '''
+    Triage data on a sample of voxels, and save the result as JSON.
+
+    Inputs
+      data                [array ] N-dimensional voxelwise data array
+      args.triage_voxels  [scalar] Number of voxels sampled per slice
+      args.output         [string] Basename for output files
+      ...                          Settings as in default_routine
+    Outputs
+      status              [string] 'clean', 'dirty' or 'uncertain'
+    '''
+
+    # Define the variance analysis model
+    varana = tsvarana.classes.varana(
+        spatial_unit=args.spatial_unit,
+        slice_axis=args.slice_axis,
+        time_axis=args.time_axis,
+        var_threshold=args.var_threshold,
+        window=args.window
+    )
+
+    # Triage
+    status = varana.triage(data, n_voxels=args.triage_voxels)
+    triage = varana.triage_result
+
+    # Save summary
+    with open(args.output + '_triage.json', 'w') as fid:
+        json.dump({
+            'status': status,
+            'n_voxels': int(triage.n_voxels),
+            'var_threshold': float(args.var_threshold),
+            'max_estimate': float(triage.estimate.max()),
+            'max_lower': float(triage.lower.max()),
+            'max_upper': float(triage.upper.max()),
+        }, fid, indent=2)
+
+    # Message
+    print('Triage: ' + status)
+
+    # Return
+    return status
+
+# =============
+# INDEX_ROUTINE
+# =============
+
+
+def index_routine(varana, args, timing, triage=None):
+    '''
+    Add a run to the results index, see tsvarana.index.index_add.
+
+    Inputs
+      varana              [object] As created by tsvarana.classes.varana,
+                                   after scrubbing, or None if the run was
+                                   not processed
+      args.index          [string] Results index file
+      args.tag            [list  ] 'key=value' tags
+      ...                          Settings as in default_routine
+      timing              [dict  ] Seconds spent on each step
+      triage              [string] Triage status, if triaged
+    '''
+
+    # Tags
+    tags = {}
+    for tag in args.tag or []:
+        key, _, value = tag.partition('=')
+        tags[key] = value
+
+    # Add
+    tsvarana.index.index_add(
+        args.index,
+        varana,
+        {
+            'data': os.path.abspath(args.data) if args.data else None,
+            'output': os.path.abspath(args.output),
+            'spatial_unit': args.spatial_unit,
+            'slice_axis': args.slice_axis,
+            'time_axis': args.time_axis,
+            'var_threshold': args.var_threshold,
+            'median_window': args.window,
+            'masked': args.masked,
+            'one_shot': args.one_shot,
+            'engine': args.engine,
+            'triage': triage,
+        },
+        timing=timing,
+        tags=tags
+    )
+
+# =============
+# QUERY_ROUTINE
+# =============
+
+
+def query_routine(args):
+    '''
+    Query the results index and print the results as tab-separated values.
+
+    Inputs
+      args.index          [string] Results index file
+      args.query          [string] SQL query, see tsvarana/index.py for the
+                                   tables
+    '''
+
+    # Query
+    columns, rows = tsvarana.index.index_query(args.index, args.query)
+
+    # Print
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if v is None else str(v) for v in row))
+
+# ==============
+# OUTPUT_ROUTINE
+# ==============
+
+
+def output_routine(varana, affine, args):
+    '''
+    Save report, final regressor and scrubbed data, as in default_routine.
+
+    Inputs
+      varana              [object] As created by tsvarana.classes.varana,
+                                   after scrubbing
+      affine              [array ] NIFTI affine for output files
+      args.output         [string] Basename for output files
+      args.max_size       [scalar] Maximum number of data values embedded
+                                   in the HTML report
+    '''
+
+    # Plot & save diagnostics and regressors in one size-bounded document
+    tsvarana.plot.plot_report(
+        varana,
+        outfile=args.output + '_report.html',
+        max_size=args.max_size
+    )
 
     # Save final regressor matrix as NIFTI
-    final_regressor = varana.get_final_regressor()
-    img = nib.Nifti1Image(final_regressor, header.affine)
+    final_regressor = varana.get_regressor_final().astype(np.int16)
+    img = nib.Nifti1Image(final_regressor, affine)
     nib.save(img, args.output + '_regressor.nii.gz')
 
-    # Save scrubbed timeseries data as NIFTI
+    # Save scrubbed timeseries data as NIFTI, streaming lazy views
     data_scrub = varana.get_data_scrub()
-    img = nib.Nifti1Image(data_scrub, header.affine)
-    nib.save(img, args.output + '_scrubbed.nii.gz')
+    if isinstance(data_scrub, tsvarana.view.scrubview):
+        data_scrub.to_nifti(args.output + '_scrubbed.nii.gz', affine)
+    else:
+        img = nib.Nifti1Image(data_scrub, affine)
+        nib.save(img, args.output + '_scrubbed.nii.gz')
 
 # Done
 #
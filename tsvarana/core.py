@@ -11,6 +11,7 @@
 
 # Libraries
 import numpy as np
+from scipy.ndimage import median_filter
 from scipy.signal import find_peaks
 
 # =============
@@ -18,7 +19,8 @@ from scipy.signal import find_peaks
 # =============
 
 
-def variance_calc(data, time_axis):
+def variance_calc(data, time_axis, run_axis=None, data_mean=None,
+                  window=None, median_img=None):
     '''
     Calculate timeseries variance against median timepoint.
 
@@ -26,16 +28,43 @@ def variance_calc(data, time_axis):
         data        [array ] N-dimensional voxelwise data array
         time_axis   [scalar] Axis along which time is encoded
                              e.g. for (x,y,z,t) data, time_axis=3
+        run_axis    [scalar] If specified, data is a batch of runs stacked
+                             along this axis, and each run is normalised
+                             by its own mean intensity
+        data_mean   [scalar] If specified, normalise by this value instead
+                             of the mean intensity of data, e.g. data_mean=1
+                             for unnormalised variance
+        window      [scalar] If specified, compare each timepoint against
+                             the median of an odd number of timepoints
+                             centred on it, rather than the median of the
+                             whole run, see median_rolling
+        median_img  [array ] If specified, use this median instead of
+                             calculating it, as given by median_calc
 
     Outputs
         vw_variance [array ] Voxelwise variance-to-mean array
     '''
 
+    # Per-run mean voxel intensity, for batches of stacked runs
+    if run_axis is not None and data_mean is None:
+        data_mean = np.mean(
+            data,
+            axis=tuple(i for i in range(data.ndim) if i != run_axis),
+            keepdims=True
+        )
+
     # Move the time axis to the front
     data = np.moveaxis(data, time_axis, 0)
 
-    # Median timepoint
-    median_img = np.median(data, axis=0)
+    # Mean voxel intensity across entire dataset
+    if run_axis is None and data_mean is None:
+        data_mean = data.mean()
+
+    # Median timepoint, or rolling median around each timepoint
+    if median_img is None:
+        median_img = median_calc(data, 0, window)
+    else:
+        median_img = np.moveaxis(median_img, time_axis, 0)
 
     # Empty list for voxelwise variance
     var_img = []
@@ -44,7 +73,8 @@ def variance_calc(data, time_axis):
     for tp in range(data.shape[0]):
 
         # Voxelwise variance between this timepoint and the median timepoint
-        sample = np.stack([data[tp, ...], median_img], axis=0)
+        median_tp = median_img[min(tp, median_img.shape[0] - 1), ...]
+        sample = np.stack([data[tp, ...], median_tp], axis=0)
         var = np.var(sample, axis=0)
 
         # Store
@@ -53,16 +83,194 @@ def variance_calc(data, time_axis):
     # Stack variance image
     vw_variance = np.stack(var_img, axis=0)
 
-    # Normalise by mean voxel intensity across entire dataset
-    vw_variance = vw_variance / data.mean()
-
     # Revert to original axis order
     vw_variance = np.moveaxis(vw_variance, 0, time_axis)
 
+    # Normalise by mean voxel intensity
+    vw_variance = vw_variance / data_mean
+
     # Return
     return vw_variance
 
 
+# ===============
+# VARIANCE_MASKED
+# ===============
+
+
+def variance_masked(data, time_axis, mask, run_axis=None):
+    '''
+    Calculate timeseries variance against median timepoint, as in
+    variance_calc, with the median and the mean intensity taken over
+    timepoints not excluded by mask only. Variance is still calculated for
+    every timepoint.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        time_axis   [scalar] Axis along which time is encoded
+                             e.g. for (x,y,z,t) data, time_axis=3
+        mask        [array ] Voxelwise binary array of excluded timepoints
+        run_axis    [scalar] If specified, data is a batch of runs stacked
+                             along this axis, and each run is normalised
+                             by its own mean intensity
+
+    Outputs
+        vw_variance [array ] Voxelwise variance-to-mean array
+    '''
+
+    # Excluded timepoints set to NaN
+    masked = np.where(mask, np.nan, data)
+
+    # Included timepoints
+    included = np.isfinite(masked)
+
+    # Mean voxel intensity of included timepoints, per run for batches of
+    # stacked runs. Runs with every timepoint excluded have no mean
+    if run_axis is None:
+        axis = None
+    else:
+        axis = tuple(i for i in range(data.ndim) if i != run_axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data_mean = np.divide(
+            np.nansum(masked, axis=axis, keepdims=run_axis is not None),
+            np.sum(included, axis=axis, keepdims=run_axis is not None)
+        )
+
+    # Voxels with every timepoint excluded have no median, so these are
+    # filled before the median is taken, then set to NaN
+    valid = included.any(axis=time_axis, keepdims=True)
+    masked[~np.broadcast_to(valid, masked.shape)] = 0
+
+    # Median of included timepoints
+    median_img = np.nanmedian(masked, axis=time_axis, keepdims=True)
+    median_img[~valid] = np.nan
+
+    # Variance between each timepoint and the median, the squared half
+    # difference, normalised by mean voxel intensity
+    vw_variance = data - median_img
+    vw_variance /= 2
+    vw_variance **= 2
+    vw_variance /= data_mean
+
+    # Return
+    return vw_variance
+
+# ==============
+# MEDIAN_ROLLING
+# ==============
+
+
+def median_rolling(data, time_axis, window):
+    '''
+    Calculate the rolling median of each voxel timeseries, over a window
+    centred on each timepoint. Windows at the start and end of the run are
+    completed by reflecting the timeseries about its edges.
+
+    Timeseries are padded by reflection and joined end to end, so a single
+    one-dimensional scipy.ndimage.median_filter call keeps each window in
+    a pair of heaps that are updated as the window slides, rather than
+    recomputing the median of every window. Windows that straddle two
+    timeseries only fall in the padding, which is discarded.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        time_axis   [scalar] Axis along which time is encoded
+                             e.g. for (x,y,z,t) data, time_axis=3
+        window      [scalar] Odd number of timepoints in each window
+
+    Outputs
+        median_img  [array ] Rolling median, with the same shape as data
+    '''
+
+    # Odd windows only, so every window has a middle timepoint
+    if window < 1 or window % 2 == 0:
+        raise TypeError('Error: median window must be a positive odd number.')
+
+    # Number of timepoints
+    n_timepoints = data.shape[time_axis]
+
+    # Move the time axis to the end & vectorise
+    q_data = np.moveaxis(data, time_axis, -1)
+    v_data = np.reshape(q_data, [-1, n_timepoints])
+
+    # Reflect each timeseries about its edges
+    pad = window // 2
+    p_data = np.pad(
+        v_data.astype(float),
+        [(0, 0), (pad, pad)],
+        mode='symmetric'
+    )
+
+    # Filter all timeseries end to end & drop the padding
+    median_img = median_filter(p_data.ravel(), size=window, mode='reflect')
+    median_img = np.reshape(median_img, p_data.shape)
+    median_img = median_img[:, pad:pad + n_timepoints]
+
+    # Reshape and revert to original axis order
+    median_img = np.reshape(median_img, q_data.shape)
+    median_img = np.moveaxis(median_img, -1, time_axis)
+
+    # Return
+    return median_img
+
+# ===========
+# MEDIAN_CALC
+# ===========
+
+
+def median_calc(data, time_axis, window=None):
+    '''
+    Calculate the median timepoint, or the rolling median around each
+    timepoint, as compared against in variance_calc
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        time_axis   [scalar] Axis along which time is encoded
+        window      [scalar] If specified, odd number of timepoints in each
+                             window, see median_rolling
+
+    Outputs
+        median_img  [array ] Median timepoint, with a time axis of length
+                             one, or rolling median, with the shape of data
+    '''
+
+    # Rolling median
+    if window is not None:
+        return median_rolling(data, time_axis, window)
+
+    # Return
+    return np.median(data, axis=time_axis, keepdims=True)
+
+
+def median_update(data, time_axis, median_img, changed, window=None):
+    '''
+    Recalculate the median of some voxels only, e.g. those changed by
+    scrubbing. The median of every other voxel is unchanged, so the result
+    matches median_calc on the whole of data.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        time_axis   [scalar] Axis along which time is encoded
+        median_img  [array ] Median of earlier data, as given by median_calc
+        changed     [array ] Voxelwise binary array of voxels to update,
+                             with a time axis of length one
+        window      [scalar] As in median_calc
+
+    Outputs
+        median_img  [array ] Updated median, as a new array
+    '''
+
+    # Move the time axis to the end
+    q_data = np.moveaxis(data, time_axis, -1)
+    q_median = np.moveaxis(median_img, time_axis, -1).copy()
+    q_changed = np.moveaxis(changed, time_axis, -1)[..., 0]
+
+    # Recalculate changed voxels, as (voxel, time) timeseries
+    q_median[q_changed] = median_calc(q_data[q_changed], 1, window)
+
+    # Revert to original axis order
+    return np.moveaxis(q_median, -1, time_axis)
+
 # ==============
 # THRESHOLD_TEST
 # ==============
@@ -105,6 +313,104 @@ def threshold_test(vw_variance, summary_axis, threshold):
     # Return
     return regressor
 
+# ==========
+# LABEL_MEAN
+# ==========
+
+
+def label_mean(vw_variance, labels, summary_axis):
+    '''
+    Mean variance of every label of a label image at every timepoint.
+    Voxel timepoints are grouped by label & timepoint in a single pass over
+    the data, with no loop over labels.
+
+    Inputs
+        vw_variance  [array]  Voxelwise variance-to-mean array
+        labels       [array]  Non-negative integer label image, with the
+                              shape of vw_variance along summary_axis
+        summary_axis [tuple]  Spatial axes of vw_variance, as returned by
+                              tsvarana.utils.parse_spatial_unit
+
+    Outputs
+        means        [array]  Mean variance, (label, timepoint), where
+                              timepoints run over all other axes in order.
+                              Labels with no voxels are NaN
+        unit         [array]  Row-major index into means of every voxel
+                              timepoint, with the shape of vw_variance
+    '''
+
+    # Label image must match the spatial axes
+    labels = np.asarray(labels)
+    spatial = tuple(vw_variance.shape[i] for i in summary_axis)
+    if labels.shape != spatial or \
+            not np.issubdtype(labels.dtype, np.integer) or \
+            (labels.size and labels.min() < 0):
+        raise TypeError(
+            'Error: labels must be a non-negative integer image of shape ' +
+            str(spatial) + '.'
+        )
+
+    # Labels & timepoint numbers, each singleton along the other's axes
+    shape = [1] * vw_variance.ndim
+    for i in range(vw_variance.ndim):
+        if i not in summary_axis:
+            shape[i] = vw_variance.shape[i]
+    n_timepoints = int(np.prod(shape))
+    timepoint = np.arange(n_timepoints).reshape(shape)
+    labels = labels.reshape([
+        vw_variance.shape[i] if i in summary_axis else 1
+        for i in range(vw_variance.ndim)
+    ])
+    n_labels = int(labels.max()) + 1 if labels.size else 1
+
+    # Unit of every voxel timepoint
+    unit = labels.astype(np.intp) * n_timepoints + timepoint
+
+    # Grouped sums & voxel counts
+    sums = np.bincount(
+        unit.ravel(),
+        weights=np.ravel(vw_variance),
+        minlength=n_labels * n_timepoints
+    )
+    counts = np.bincount(labels.ravel(), minlength=n_labels)
+
+    # Means, empty labels are NaN
+    with np.errstate(invalid='ignore'):
+        means = sums.reshape(n_labels, n_timepoints) / counts[:, np.newaxis]
+
+    # Return
+    return means, unit
+
+
+def threshold_labels(vw_variance, labels, summary_axis, threshold):
+    '''
+    Test the mean variance of every label against specified threshold, as
+    threshold_test does for slices and volumes. Label 0 is background, and
+    is never flagged.
+
+    Inputs
+        vw_variance  [array]  Voxelwise variance-to-mean array
+        labels       [array]  Label image, see label_mean
+        summary_axis [tuple]  Spatial axes of vw_variance
+        threshold    [scalar] Normalized variance threshold
+
+    Outputs
+        regressor   [array]  Voxelwise binary regressor of threshold violations
+    '''
+
+    # Mean variance per label & timepoint
+    means, unit = label_mean(vw_variance, labels, summary_axis)
+
+    # Test each label, background excluded
+    flagged = means > threshold
+    flagged[0] = False
+
+    # Broadcast back to voxels
+    regressor = flagged.ravel()[unit]
+
+    # Return
+    return regressor
+
 # =====
 # SCRUB
 # =====
@@ -216,5 +522,79 @@ def scrub(data, regressor, time_axis):
     # Return
     return data_scrub
 
+# ===============
+# SCRUB_INTERVALS
+# ===============
+
+
+def scrub_intervals(data, regressor, time_axis):
+    '''
+    Find the replacement intervals that scrub would apply, without
+    modifying or copying the data. Each run of consecutive flagged
+    timepoints in a voxel is one interval, with the same fill value and
+    window edge rules as scrub.
+
+    Voxels are numbered as in scrub, by flattening all axes except the
+    time axis in C order.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        regressor   [array ] Voxelwise binary regressor of threshold violations
+        time_axis   [scalar] Axis along which time is encoded
+                             e.g. for (x,y,z,t) data, time_axis=3
+
+    Outputs
+        intervals   [tuple ] (voxel, start, length, fill) arrays, one
+                             element per interval
+    '''
+
+    # Number of timepoints
+    n_timepoints = data.shape[time_axis]
+
+    # Move the time axis to the front & vectorise
+    v_data = np.reshape(np.moveaxis(data, time_axis, 0), [n_timepoints, -1])
+    v_regr = np.reshape(
+        np.moveaxis(regressor, time_axis, 0),
+        [n_timepoints, -1]
+    )
+
+    # Interval edges, from the zero-padded regressor
+    edges = np.diff(
+        np.pad(v_regr.astype(np.int8), ((1, 1), (0, 0)), 'constant'),
+        axis=0
+    ).T
+
+    # Interval starts and (exclusive) ends, ordered by voxel then time, so
+    # every start pairs with the following end
+    voxel, start = np.nonzero(edges == 1)
+    _, end = np.nonzero(edges == -1)
+    length = end - start
+
+    # Timepoints before and after each window
+    prev = start - 1
+    post = end
+    has_prev = prev >= 0
+    has_post = post < n_timepoints
+
+    # Values before and after each window, where available
+    value_prev = v_data[np.maximum(prev, 0), voxel]
+    value_post = v_data[np.minimum(post, n_timepoints - 1), voxel]
+
+    # If both edges are available, average them
+    # If only one is available, take that one
+    fill = np.where(
+        has_prev & has_post,
+        (value_prev + value_post) / 2,
+        np.where(has_post, value_post, value_prev)
+    ).astype(float)
+
+    # If the entire timeseries is flagged, replace with the median timepoint
+    whole = ~has_prev & ~has_post
+    if whole.any():
+        fill[whole] = np.median(v_data[:, voxel[whole]], axis=0)
+
+    # Return
+    return voxel, start, length, fill
+
 # Done
 #
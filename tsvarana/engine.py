@@ -0,0 +1,399 @@
+# engine.py
+#
+# tsvarana engines.
+#
+# An engine is one implementation of the three core steps: variance
+# calculation, threshold test and scrubbing. The reference engine is
+# tsvarana/core.py, and defines the expected results. Other engines must
+# match it, which the verification mode checks while processing real data:
+# a random sample of voxels is run through the reference engine after every
+# step, and processing stops if the results differ.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import collections
+import numpy as np
+
+# Project dependencies
+from tsvarana import core
+from tsvarana.pyramid import variance_pyramid
+
+# Tolerance when comparing against the reference engine
+ENGINE_RTOL = 1e-9
+ENGINE_ATOL = 1e-12
+
+# Implementation of the core steps, with the signatures of tsvarana.core
+varana_engine = collections.namedtuple(
+    'varana_engine',
+    [
+        'variance_calc',
+        'threshold_test',
+        'scrub',
+    ]
+)
+
+# ==================
+# VECTORIZED ENGINE
+# ==================
+
+
+def variance_vectorized(data, time_axis, run_axis=None, data_mean=None,
+                        window=None, median_img=None):
+    '''
+    Calculate timeseries variance against median timepoint, as in
+    tsvarana.core.variance_calc. The variance of a timepoint and the median
+    is the squared half difference, computed for all timepoints at once.
+    '''
+
+    # Per-run mean voxel intensity, for batches of stacked runs
+    if run_axis is not None and data_mean is None:
+        data_mean = np.mean(
+            data,
+            axis=tuple(i for i in range(data.ndim) if i != run_axis),
+            keepdims=True
+        )
+
+    # Mean voxel intensity across entire dataset
+    if data_mean is None:
+        data_mean = data.mean()
+
+    # Median timepoint, or rolling median around each timepoint
+    if median_img is None:
+        median_img = core.median_calc(data, time_axis, window)
+
+    # Squared half difference, normalised by mean voxel intensity
+    vw_variance = data - median_img
+    vw_variance /= 2
+    vw_variance **= 2
+    vw_variance /= data_mean
+
+    # Return
+    return vw_variance
+
+
+def threshold_vectorized(vw_variance, summary_axis, threshold):
+    '''
+    Test sample-to-median variance against specified threshold, as in
+    tsvarana.core.threshold_test. Means are tested before being broadcast
+    back to the voxel grid.
+    '''
+
+    # Turn into a tuple
+    if type(summary_axis) == int:
+        summary_axis = (summary_axis,)
+
+    # Mean variance along each axis, in the same order as the reference
+    summary = vw_variance
+    for i in summary_axis or ():
+        summary = np.mean(summary, axis=i, keepdims=True)
+
+    # Test, then broadcast to the voxel grid
+    regressor = np.broadcast_to(summary > threshold, vw_variance.shape)
+
+    # Return
+    return regressor.copy()
+
+
+def scrub_vectorized(data, regressor, time_axis):
+    '''
+    Perform variance-based scrubbing, as in tsvarana.core.scrub. Replacement
+    intervals are found with tsvarana.core.scrub_intervals, and written for
+    all voxels at once.
+    '''
+
+    # Replacement intervals
+    voxel, start, length, fill = core.scrub_intervals(
+        data,
+        regressor,
+        time_axis
+    )
+
+    # Copy of the data, with time along the first axis
+    n_timepoints = data.shape[time_axis]
+    q_data = np.moveaxis(data, time_axis, 0)
+    v_data = np.reshape(q_data, [n_timepoints, -1]).copy()
+
+    # Every timepoint of every interval
+    offset = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length,
+                                                 length)
+    v_data[np.repeat(start, length) + offset, np.repeat(voxel, length)] = \
+        np.repeat(fill, length)
+
+    # Reshape and revert to original axis order
+    data_scrub = np.reshape(v_data, q_data.shape)
+    data_scrub = np.moveaxis(data_scrub, 0, time_axis)
+
+    # Return
+    return data_scrub
+
+# ========
+# REGISTRY
+# ========
+
+# Registered engines, by name
+ENGINES = {
+    'reference': varana_engine(
+        variance_calc=core.variance_calc,
+        threshold_test=core.threshold_test,
+        scrub=core.scrub
+    ),
+    'vectorized': varana_engine(
+        variance_calc=variance_vectorized,
+        threshold_test=threshold_vectorized,
+        scrub=scrub_vectorized
+    ),
+}
+
+
+def engine_register(name, variance_calc=None, threshold_test=None,
+                    scrub=None):
+    '''
+    Register an engine. Steps that are not given use the reference engine.
+
+    Inputs
+        name            [string] Engine name, as passed to varana
+        variance_calc   [func  ] As tsvarana.core.variance_calc
+        threshold_test  [func  ] As tsvarana.core.threshold_test
+        scrub           [func  ] As tsvarana.core.scrub
+    '''
+
+    # Fill in reference steps
+    reference = ENGINES['reference']
+    ENGINES[name] = varana_engine(
+        variance_calc=variance_calc or reference.variance_calc,
+        threshold_test=threshold_test or reference.threshold_test,
+        scrub=scrub or reference.scrub
+    )
+
+
+def engine_get(name):
+    '''
+    Return a registered engine
+
+    Inputs
+        name        [string] Engine name
+    Outputs
+        engine      [object] varana_engine
+    '''
+
+    # Check name
+    if name not in ENGINES:
+        raise TypeError(
+            'Error: unknown engine ' + str(name) + ', available engines are ' +
+            ', '.join(sorted(ENGINES)) + '.'
+        )
+
+    # Return
+    return ENGINES[name]
+
+# ============
+# VERIFICATION
+# ============
+
+
+def engine_sample(shape, time_axis, n_voxels, seed=None):
+    '''
+    Draw a random sample of voxels, from a local random generator so the
+    global random state is left untouched
+
+    Inputs
+        shape       [tuple ] Data shape
+        time_axis   [scalar] Axis along which time is encoded
+        n_voxels    [scalar] Number of voxels to sample
+        seed        [scalar] Random seed
+    Outputs
+        index       [tuple ] Index arrays into all axes except time
+    '''
+
+    # Spatial shape
+    spatial = tuple(n for i, n in enumerate(shape) if i != time_axis)
+    n_total = int(np.prod(spatial))
+
+    # Sample without replacement
+    rng = np.random.default_rng(seed)
+    flat = rng.choice(n_total, min(n_voxels, n_total), replace=False)
+
+    # Return
+    return np.unravel_index(np.sort(flat), spatial)
+
+
+def engine_check(name, step, result, expected):
+    '''
+    Compare a result against the reference engine
+
+    Inputs
+        name        [string] Engine name
+        step        [string] Step being checked
+        result      [array ] Result of the engine
+        expected    [array ] Result of the reference engine
+    '''
+
+    # Compare within tolerance
+    if not np.allclose(result, expected, rtol=ENGINE_RTOL, atol=ENGINE_ATOL):
+        raise TypeError(
+            'Error: ' + step + ' of engine ' + name +
+            ' does not match the reference engine.'
+        )
+
+
+def engine_variance(config, data, time_axis, run_axis=None,
+                    median_img=None):
+    '''
+    Variance calculation with the engine set in config, checked against the
+    reference engine on config.verify sampled voxels. With config.pyramid
+    set, single runs in the voxel unit are calculated coarse-to-fine, see
+    tsvarana.pyramid, and checked on the threshold test only. A given
+    median is passed on to the engine, and is not used by the check, which
+    calculates its own
+
+    Inputs
+        config      [object] tsvarana.pipeline.varana_config
+        data, time_axis, run_axis, median_img  As in
+                             tsvarana.core.variance_calc
+    Outputs
+        vw_variance [array ] Voxelwise variance-to-mean array
+    '''
+
+    # Coarse-to-fine variance, only bounded for the whole-run median
+    pyramid = (
+        config.pyramid and
+        config.spatial_unit == 'voxel' and
+        run_axis is None and
+        config.window is None and
+        median_img is None
+    )
+
+    # Engines registered without median_img are still supported
+    median = {} if median_img is None else {'median_img': median_img}
+
+    # Engine step
+    if pyramid:
+        vw_variance = variance_pyramid(
+            data,
+            time_axis,
+            config.var_threshold,
+            levels=config.pyramid,
+            variance=engine_get(config.engine).variance_calc
+        )
+    else:
+        vw_variance = engine_get(config.engine).variance_calc(
+            data,
+            time_axis,
+            run_axis,
+            window=config.window,
+            **median
+        )
+
+    # Reference step on sampled voxels, with time along the last axis and
+    # the normalisation of the whole data
+    if config.verify and (config.engine != 'reference' or pyramid):
+        index = engine_sample(data.shape, time_axis, config.verify)
+        if run_axis is None:
+            data_mean = data.mean()
+        else:
+            data_mean = np.mean(
+                data,
+                axis=tuple(i for i in range(data.ndim) if i != run_axis)
+            )[index[run_axis]][:, np.newaxis]
+        expected = core.variance_calc(
+            np.moveaxis(data, time_axis, -1)[index],
+            1,
+            data_mean=data_mean,
+            window=config.window
+        )
+        result = np.moveaxis(vw_variance, time_axis, -1)[index]
+        if pyramid:
+            result = result > config.var_threshold
+            expected = expected > config.var_threshold
+        engine_check(config.engine, 'variance_calc', result, expected)
+
+    # Return
+    return vw_variance
+
+
+def engine_threshold(config, vw_variance, summary_axis, threshold):
+    '''
+    Threshold test with the engine set in config. Units span many voxels,
+    so the check against the reference engine covers all voxels. The label
+    unit is tested by tsvarana.core.threshold_labels, whatever the engine
+
+    Inputs
+        config      [object] tsvarana.pipeline.varana_config
+        vw_variance, summary_axis, threshold  As in
+                             tsvarana.core.threshold_test
+    Outputs
+        regressor   [array ] Voxelwise binary regressor
+    '''
+
+    # Labels, already a single grouped pass
+    if config.spatial_unit == 'label':
+        if config.labels is None:
+            raise TypeError('Error: the label unit needs a label image.')
+        return core.threshold_labels(
+            vw_variance,
+            config.labels,
+            summary_axis,
+            threshold
+        )
+
+    # Engine step
+    regressor = engine_get(config.engine).threshold_test(
+        vw_variance,
+        summary_axis,
+        threshold
+    )
+
+    # Reference step
+    if config.verify and config.engine != 'reference':
+        engine_check(
+            config.engine,
+            'threshold_test',
+            regressor,
+            core.threshold_test(vw_variance, summary_axis, threshold)
+        )
+
+    # Return
+    return regressor
+
+
+def engine_scrub(config, data, regressor, time_axis):
+    '''
+    Scrubbing with the engine set in config, checked against the reference
+    engine on config.verify sampled voxels
+
+    Inputs
+        config      [object] tsvarana.pipeline.varana_config
+        data, regressor, time_axis  As in tsvarana.core.scrub
+    Outputs
+        data_scrub  [array ] Scrubbed data array
+    '''
+
+    # Engine step
+    data_scrub = engine_get(config.engine).scrub(data, regressor, time_axis)
+
+    # Reference step on sampled voxels, with time along the last axis
+    if config.verify and config.engine != 'reference':
+        index = engine_sample(data.shape, time_axis, config.verify)
+        expected = core.scrub(
+            np.moveaxis(data, time_axis, -1)[index],
+            np.moveaxis(regressor, time_axis, -1)[index],
+            1
+        )
+        engine_check(
+            config.engine,
+            'scrub',
+            np.moveaxis(data_scrub, time_axis, -1)[index],
+            expected
+        )
+
+    # Return
+    return data_scrub
+
+# Done
+#
@@ -0,0 +1,297 @@
+# index.py
+#
+# tsvarana results index.
+#
+# A SQLite database with one row per processed run, for cohort-level QC
+# queries without reopening per-run outputs. Tables are
+#   runs        input & output files, settings, flagged counts, runtime
+#   tags        free-form key & value pairs per run, e.g. scanner=B
+#   iterations  flagged counts per scrub iteration
+#   units       summary variance per slice, per volume, or per label, of the
+#               first iteration, with the full timecourse stored as float32
+#               bytes
+#
+# Several processes can add runs to the same index, as writes wait for
+# each other and readers are never blocked.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import time
+import sqlite3
+import numpy as np
+
+# Project dependencies
+from tsvarana.utils import (
+    parse_spatial_unit,
+    summary_calc
+)
+
+# Seconds to wait for other processes writing to the index
+INDEX_TIMEOUT = 60
+
+# Index schema
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    time REAL,
+    data TEXT,
+    output TEXT,
+    spatial_unit TEXT,
+    slice_axis INTEGER,
+    time_axis INTEGER,
+    var_threshold REAL,
+    median_window INTEGER,
+    masked INTEGER,
+    one_shot INTEGER,
+    engine TEXT,
+    triage TEXT,
+    n_iter INTEGER,
+    n_flagged INTEGER,
+    n_volumes INTEGER,
+    max_variance REAL,
+    load_time REAL,
+    compute_time REAL,
+    output_time REAL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    run_id INTEGER REFERENCES runs(id),
+    key TEXT,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS iterations (
+    run_id INTEGER REFERENCES runs(id),
+    iteration INTEGER,
+    n_flagged INTEGER,
+    n_volumes INTEGER
+);
+CREATE TABLE IF NOT EXISTS units (
+    run_id INTEGER REFERENCES runs(id),
+    unit INTEGER,
+    mean_variance REAL,
+    max_variance REAL,
+    variance BLOB
+);
+CREATE INDEX IF NOT EXISTS runs_time ON runs(time);
+CREATE INDEX IF NOT EXISTS runs_data ON runs(data);
+CREATE INDEX IF NOT EXISTS runs_n_volumes ON runs(n_volumes);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags(key, value);
+CREATE INDEX IF NOT EXISTS iterations_run ON iterations(run_id);
+CREATE INDEX IF NOT EXISTS units_run ON units(run_id);
+'''
+
+# ==========
+# INDEX_OPEN
+# ==========
+
+
+def index_open(path, read_only=False):
+    '''
+    Open a results index, creating it if needed
+
+    Inputs
+        path        [string] SQLite database file
+        read_only   [ bool ] If True, open for queries only
+    Outputs
+        connection  [object] sqlite3 connection
+    '''
+
+    # Queries only
+    if read_only:
+        return sqlite3.connect(
+            'file:' + path + '?mode=ro',
+            uri=True,
+            timeout=INDEX_TIMEOUT
+        )
+
+    # Create tables, with a write-ahead log so readers are never blocked
+    connection = sqlite3.connect(path, timeout=INDEX_TIMEOUT)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(INDEX_SCHEMA)
+
+    # Return
+    return connection
+
+# =========
+# INDEX_ADD
+# =========
+
+
+def index_flagged(regressor, time_axis):
+    '''
+    Count flagged timepoints
+
+    Inputs
+        regressor   [array ] Voxelwise regressor
+        time_axis   [scalar] Axis along which time is encoded
+    Outputs
+        n_flagged   [scalar] Number of flagged voxel timepoints
+        n_volumes   [scalar] Number of timepoints flagged in any voxel
+    '''
+
+    # Flags per timepoint
+    regressor = np.asarray(regressor).astype(bool)
+    axes = tuple(i for i in range(regressor.ndim) if i != time_axis)
+    per_volume = regressor.any(axis=axes)
+
+    # Return
+    return int(regressor.sum()), int(per_volume.sum())
+
+
+def index_add(path, varana, settings, timing=None, tags=None):
+    '''
+    Add a processed run to a results index
+
+    Inputs
+        path        [string] SQLite database file
+        varana      [object] As created by tsvarana.classes.varana, after
+                             scrubbing, or None if the run was not
+                             processed
+        settings    [dict  ] Input & output files and settings, with the
+                             keys of the runs table
+        timing      [dict  ] Seconds spent in 'load', 'compute' and
+                             'output'
+        tags        [dict  ] Free-form key & value pairs
+    Outputs
+        run_id      [scalar] Row id of the run
+    '''
+
+    # Run summary
+    run = dict(settings)
+    run['time'] = time.time()
+    for step in ('load', 'compute', 'output'):
+        run[step + '_time'] = (timing or {}).get(step)
+
+    # Per-iteration counts & unit summaries
+    iterations = []
+    units = []
+    if varana is not None:
+
+        # Flagged counts
+        for counter, regressor in enumerate(varana.regressor):
+            iterations.append(
+                (counter + 1,) + index_flagged(regressor, varana.time_axis)
+            )
+        run['n_iter'] = len(iterations)
+        run['n_flagged'], run['n_volumes'] = index_flagged(
+            varana.get_regressor_final(),
+            varana.time_axis
+        )
+
+        # Summary variance of the first iteration, per slice for the
+        # voxel unit, per label for the label unit, (unit, time). Units are
+        # numbered from 0, labels by their value, without background
+        variance = varana.variance[0]
+        summary_axis = varana.summary_axis
+        if varana.spatial_unit == 'voxel':
+            summary_axis = parse_spatial_unit(
+                'slice',
+                variance.ndim,
+                varana.slice_axis,
+                varana.time_axis
+            )
+        if varana.spatial_unit == 'label':
+            summary = summary_calc(
+                variance,
+                'label',
+                summary_axis,
+                varana.time_axis,
+                labels=varana.labels
+            )
+        else:
+            summary = np.mean(
+                variance,
+                axis=tuple(summary_axis),
+                keepdims=True
+            )
+            summary = np.moveaxis(summary, varana.time_axis, -1)
+            summary = np.reshape(summary, [-1, summary.shape[-1]])
+        run['max_variance'] = float(summary.max()) if summary.size else None
+        first = 1 if varana.spatial_unit == 'label' else 0
+        for unit, timecourse in enumerate(summary, first):
+            units.append((
+                unit,
+                float(timecourse.mean()),
+                float(timecourse.max()),
+                timecourse.astype(np.float32).tobytes(),
+            ))
+
+    # Write in a single transaction
+    connection = index_open(path)
+    try:
+        with connection:
+            columns = ', '.join(run)
+            values = ', '.join('?' * len(run))
+            run_id = connection.execute(
+                'INSERT INTO runs (' + columns + ') VALUES (' + values + ')',
+                list(run.values())
+            ).lastrowid
+            connection.executemany(
+                'INSERT INTO tags VALUES (?, ?, ?)',
+                [(run_id, k, str(v)) for k, v in (tags or {}).items()]
+            )
+            connection.executemany(
+                'INSERT INTO iterations VALUES (?, ?, ?, ?)',
+                [(run_id,) + row for row in iterations]
+            )
+            connection.executemany(
+                'INSERT INTO units VALUES (?, ?, ?, ?, ?)',
+                [(run_id,) + row for row in units]
+            )
+    finally:
+        connection.close()
+
+    # Return
+    return run_id
+
+# ===========
+# INDEX_QUERY
+# ===========
+
+
+def index_query(path, query, parameters=()):
+    '''
+    Run a read-only SQL query on a results index
+
+    Inputs
+        path        [string] SQLite database file
+        query       [string] SQL query
+        parameters  [tuple ] Query parameters
+    Outputs
+        columns     [list  ] Column names
+        rows        [list  ] One tuple per row
+    '''
+
+    # Query
+    connection = index_open(path, read_only=True)
+    try:
+        cursor = connection.execute(query, parameters)
+        columns = [d[0] for d in cursor.description or ()]
+        rows = cursor.fetchall()
+    finally:
+        connection.close()
+
+    # Return
+    return columns, rows
+
+
+def index_units(blob):
+    '''
+    Decode the summary variance timecourse stored in the units table
+
+    Inputs
+        blob        [bytes ] units.variance
+    Outputs
+        timecourse  [array ] Summary variance per timepoint
+    '''
+
+    # Return
+    return np.frombuffer(blob, dtype=np.float32)
+
+# Done
+#
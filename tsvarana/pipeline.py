@@ -0,0 +1,978 @@
+# pipeline.py
+#
+# tsvarana functional pipeline.
+#
+# Pipeline functions take data and a frozen configuration, and return an
+# immutable result. They keep no state between calls, so a single
+# configuration can be shared by any number of threads.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import tempfile
+import collections
+import numpy as np
+
+# Project dependencies
+from tsvarana.core import (
+    variance_masked,
+    median_calc,
+    median_update,
+    scrub_intervals
+)
+from tsvarana.engine import (
+    engine_variance,
+    engine_threshold,
+    engine_scrub
+)
+from tsvarana.segment import segment_scrub
+from tsvarana.session import (
+    checkpoint_identity,
+    checkpoint_clear,
+    checkpoint_save,
+    checkpoint_load
+)
+from tsvarana.utils import parse_spatial_unit
+from tsvarana.view import scrubview
+
+# =============
+# CONFIGURATION
+# =============
+
+# Variance analysis settings, see tsvarana.classes.varana
+varana_config = collections.namedtuple(
+    'varana_config',
+    [
+        'spatial_unit',
+        'slice_axis',
+        'time_axis',
+        'var_threshold',
+        'run_axis',
+        'lazy',
+        'engine',
+        'verify',
+        'window',
+        'masked',
+        'pyramid',
+        'labels',
+        'segment',
+        'segment_median',
+    ]
+)
+varana_config.__new__.__defaults__ = (
+    'voxel', 2, 3, 5, None, False, 'reference', 0, None, False, 0, None,
+    0, 'sketch'
+)
+
+# Spatial units of multi-unit runs, see pipeline_units
+PIPELINE_UNITS = ('voxel', 'slice', 'volume')
+
+# Variance analysis results
+#   config       [object] varana_config used to produce the results
+#   summary_axis [tuple ] Axes along which variance was averaged
+#   variance     [tuple ] Voxelwise variance, one per scrub iteration
+#   regressor    [tuple ] Voxelwise regressor, one per scrub iteration
+#   data_scrub   [array ] Scrubbed data, None if not scrubbed
+#   n_runs       [scalar] Number of runs in batch mode, None otherwise
+#   n_iter       [array ] Scrub iterations per run in batch mode
+varana_result = collections.namedtuple(
+    'varana_result',
+    [
+        'config',
+        'summary_axis',
+        'variance',
+        'regressor',
+        'data_scrub',
+        'n_runs',
+        'n_iter',
+    ]
+)
+
+# =========
+# UTILITIES
+# =========
+
+
+def pipeline_prepare(data, config):
+    '''
+    Arrange input data for processing. Batches of runs are stacked along
+    the first axis, and the time and summary axes are shifted to match.
+
+    Inputs
+        data         [array ] N-dimensional voxelwise data array,
+                              or list of arrays with one run each
+        config       [object] varana_config
+    Outputs
+        data         [array ] Data array, with runs along the first axis
+                              in batch mode
+        time_axis    [scalar] Axis along which time is encoded in data
+        summary_axis [tuple ] Axes along which to average variance in data
+        n_runs       [scalar] Number of runs in batch mode, None otherwise
+    '''
+
+    # Stack lists of runs along a new leading axis
+    if isinstance(data, (list, tuple)):
+        data = np.stack(data, axis=0)
+
+    # Move stacked runs to the front
+    elif config.run_axis is not None:
+        data = np.moveaxis(data, config.run_axis, 0)
+
+    # Single run
+    else:
+        summary_axis = parse_spatial_unit(
+            config.spatial_unit,
+            data.ndim,
+            config.slice_axis,
+            config.time_axis
+        )
+        return data, config.time_axis, summary_axis, None
+
+    # Batch of runs, summary axes are defined on a single run and
+    # shifted by one to step over the run axis
+    summary_axis = tuple(
+        i + 1 for i in parse_spatial_unit(
+            config.spatial_unit,
+            data.ndim - 1,
+            config.slice_axis,
+            config.time_axis
+        )
+    )
+
+    # Return
+    return data, config.time_axis + 1, summary_axis, data.shape[0]
+
+
+def pipeline_freeze(*arrays):
+    '''
+    Mark arrays as read-only, so results cannot be modified in place
+
+    Inputs
+        arrays      [array ] Arrays to freeze
+    Outputs
+        arrays      [tuple ] The same arrays, now read-only
+    '''
+
+    # Loop arrays, lazy views hold no data of their own
+    for array in arrays:
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+
+    # Return
+    return arrays
+
+# ===============
+# PIPELINE_DETECT
+# ===============
+
+
+def pipeline_detect(data, config):
+    '''
+    Calculate timepoint-to-median variance, then compare the empirical
+    normalised variance against the variance threshold
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        config      [object] varana_config
+    Outputs
+        result      [object] varana_result, with a single iteration
+    '''
+
+    # Arrange data
+    data, time_axis, summary_axis, n_runs = pipeline_prepare(data, config)
+
+    # Variance calculation, normalised per run in batch mode
+    vw_variance = engine_variance(
+        config,
+        data,
+        time_axis,
+        run_axis=None if n_runs is None else 0
+    )
+
+    # Threshold test
+    regressor = engine_threshold(
+        config,
+        vw_variance,
+        summary_axis,
+        config.var_threshold
+    )
+
+    # Return
+    return varana_result(
+        config=config,
+        summary_axis=summary_axis,
+        variance=pipeline_freeze(vw_variance),
+        regressor=pipeline_freeze(regressor),
+        data_scrub=None,
+        n_runs=n_runs,
+        n_iter=None if n_runs is None else pipeline_freeze(
+            np.ones(n_runs, dtype=int)
+        )[0]
+    )
+
+# ================
+# PIPELINE_ONESHOT
+# ================
+
+
+def pipeline_oneshot(data, config, scratch=None):
+    '''
+    Perform one-shot data scrubbing
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        config      [object] varana_config
+        scratch     [string] Directory for the results of segmented runs,
+                             see pipeline_segmented
+    Outputs
+        result      [object] varana_result, with a single iteration
+    '''
+
+    # A segment of timepoints at a time, see pipeline_segmented
+    if config.segment:
+        return pipeline_segmented(data, config, scratch, max_iter=1)
+
+    # Stack lists of runs once, detection then treats them as a batch
+    # with runs along the first axis
+    if isinstance(data, (list, tuple)):
+        data = np.stack(data, axis=0)
+        config = config._replace(run_axis=0)
+
+    # Run detection
+    result = pipeline_detect(data, config)
+
+    # Arrange data
+    data, time_axis, _, _ = pipeline_prepare(data, config)
+
+    # Scrubbing, or lazy view of the scrubbed data
+    if config.lazy:
+        data_scrub = scrubview(
+            data,
+            time_axis,
+            scrub_intervals(data, result.regressor[0], time_axis)
+        )
+    else:
+        data_scrub = engine_scrub(
+            config,
+            data,
+            result.regressor[0],
+            time_axis
+        )
+
+    # Return
+    return result._replace(data_scrub=pipeline_freeze(data_scrub)[0])
+
+# ==================
+# PIPELINE_ITERATIVE
+# ==================
+
+
+def pipeline_iterative(data, config, checkpoint=None, checkpoint_every=1,
+                       resume=False, scratch=None, shared=None,
+                       progress=None):
+    '''
+    Perform iterative variance calculation and data scrubbing,
+    until no timepoints get replaced.
+
+    In batch mode, all runs still being scrubbed are processed together, and
+    each run drops out once no timepoints get replaced. Finished runs carry
+    their last variance forward and flag no further timepoints, matching
+    the outputs of processing every run separately.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        config      [object] varana_config
+        checkpoint  [string] If specified, save the scrub state to this
+                             directory, see tsvarana.session.checkpoint_save
+        checkpoint_every [scalar] Iterations between checkpoints
+        resume      [ bool ] If True, continue from the last checkpoint, if
+                             any. Results are identical to an uninterrupted
+                             run
+        scratch     [string] Directory for the results of segmented runs,
+                             see pipeline_segmented
+        shared      [tuple ] If specified, variance, regressor & median of
+                             the first iteration, already calculated, see
+                             pipeline_units. Later iterations recalculate
+                             the median of scrubbed voxels only
+        progress    [func  ] If specified, called after every iteration
+                             with the iteration number and the number of
+                             timepoints flagged. Raising an exception stops
+                             scrubbing, after any checkpoint of the
+                             iteration is saved
+    Outputs
+        result      [object] varana_result, with one entry per iteration
+    '''
+
+    # Flag-excluding iterations, see pipeline_masked
+    if config.masked:
+        if checkpoint:
+            raise TypeError(
+                'Error: checkpointing is not supported in masked mode.'
+            )
+        return pipeline_masked(data, config, progress)
+
+    # A segment of timepoints at a time, see pipeline_segmented
+    if config.segment:
+        if checkpoint:
+            raise TypeError(
+                'Error: checkpointing is not supported for segmented runs.'
+            )
+        return pipeline_segmented(data, config, scratch, progress=progress)
+
+    # Arrange data
+    data, time_axis, summary_axis, n_runs = pipeline_prepare(data, config)
+
+    # Batch mode normalises per run
+    run_axis = None if n_runs is None else 0
+
+    # Lazy view of the scrubbed data, on top of the original data
+    view = scrubview(data, time_axis) if config.lazy else None
+
+    # Identity of the input data, checked on resume
+    identity = checkpoint_identity(data) if checkpoint else None
+
+    # Work on a copy of batches, so scrubbed runs can be updated in place
+    if n_runs is not None:
+        data = data.copy()
+
+    # Empty lists
+    var_iter = []
+    reg_iter = []
+
+    # Runs still being scrubbed & iterations per run
+    active = np.ones(n_runs or 1, dtype=bool)
+    n_iter = np.zeros(n_runs or 1, dtype=int)
+
+    # Iteration counter
+    counter = 0
+
+    # Median carried across iterations, shared runs only
+    median_img = None
+
+    # Continue from the last checkpoint
+    state = None
+    if resume and checkpoint:
+        state = checkpoint_load(checkpoint, config, identity)
+        if state is not None:
+            counter, var_iter, reg_iter, data, active, n_iter = state[:6]
+            if config.lazy:
+                view = scrubview(view.data, time_axis, state[6])
+            print('Resuming after iteration: ' + str(counter))
+
+    # Otherwise start afresh, without files of earlier runs
+    if checkpoint and state is None:
+        checkpoint_clear(checkpoint)
+
+    # Loop until all runs have converged
+    while active.any():
+
+        # Update counter
+        counter += 1
+
+        # Message
+        print('Iteration: ' + str(counter))
+
+        # Active runs
+        if n_runs is None:
+            data_active = data
+            median_active = median_img
+        else:
+            data_active = data[active]
+            median_active = None if median_img is None else \
+                median_img[active]
+
+        # First iteration, already calculated
+        if shared is not None and counter == 1:
+            vw_variance, regressor, median_active = shared
+
+        # Variance calculation & threshold test
+        else:
+            vw_variance = engine_variance(
+                config,
+                data_active,
+                time_axis,
+                run_axis,
+                median_img=median_active
+            )
+            regressor = engine_threshold(
+                config,
+                vw_variance,
+                summary_axis,
+                config.var_threshold
+            )
+
+        # Scrubbing
+        if config.lazy:
+
+            # Replacement intervals, applied in place to the working data.
+            # Later iterations need the variance of the scrubbed data, so
+            # the original data is copied once, on the first iteration
+            intervals = scrub_intervals(data_active, regressor, time_axis)
+            if data_active is view.data:
+                data_active = np.array(data_active)
+            coords, fill = scrubview(
+                data_active,
+                time_axis,
+                intervals
+            ).samples()
+
+            # Record intervals, with voxels numbered across all runs in
+            # batch mode
+            if n_runs is not None:
+                per_run = data_active[0].size // data.shape[time_axis]
+                run = np.nonzero(active)[0][intervals[0] // per_run]
+                intervals = (
+                    run * per_run + intervals[0] % per_run,
+                ) + intervals[1:]
+            view = view.compose(intervals)
+            data_active[coords] = fill
+        else:
+            data_active = engine_scrub(
+                config,
+                data_active,
+                regressor,
+                time_axis
+            )
+
+        # Median of the scrubbed data, updating scrubbed voxels only
+        if shared is not None:
+            median_active = median_update(
+                data_active,
+                time_axis,
+                median_active,
+                regressor.any(axis=time_axis, keepdims=True),
+                config.window
+            )
+            if n_runs is None or median_img is None:
+                median_img = median_active
+            else:
+                median_img[active] = median_active
+
+        # Message
+        print('Bad timepoints: ' + str(regressor.sum()))
+
+        # Single run
+        if n_runs is None:
+            data = data_active
+            var_iter.append(vw_variance)
+            reg_iter.append(regressor)
+            n_iter[0] += 1
+            active[0] = regressor.any()
+
+        # Batch of runs
+        else:
+
+            # Update scrubbed runs
+            data[active] = data_active
+
+            # Full-batch variance, finished runs keep their last variance
+            if var_iter:
+                variance = var_iter[-1].copy()
+            else:
+                variance = np.zeros(data.shape)
+            variance[active] = vw_variance
+
+            # Full-batch regressor, finished runs flag nothing
+            regressor_batch = np.zeros(data.shape, dtype=bool)
+            regressor_batch[active] = regressor
+
+            # Store
+            var_iter.append(variance)
+            reg_iter.append(regressor_batch)
+
+            # Update per-run convergence mask
+            n_iter[active] += 1
+            active[active] = regressor.reshape(
+                regressor.shape[0], -1
+            ).any(axis=1)
+
+        # Save checkpoint
+        if checkpoint and counter % checkpoint_every == 0:
+            checkpoint_save(
+                checkpoint,
+                config,
+                counter,
+                var_iter,
+                reg_iter,
+                data,
+                active,
+                n_iter,
+                intervals=None if view is None else view.intervals,
+                identity=identity
+            )
+
+        # Report progress
+        if progress is not None:
+            progress(counter, int(np.count_nonzero(regressor)))
+
+    # Return
+    return varana_result(
+        config=config,
+        summary_axis=summary_axis,
+        variance=pipeline_freeze(*var_iter),
+        regressor=pipeline_freeze(*reg_iter),
+        data_scrub=pipeline_freeze(data)[0] if view is None else view,
+        n_runs=n_runs,
+        n_iter=None if n_runs is None else pipeline_freeze(n_iter)[0]
+    )
+
+# ===============
+# PIPELINE_MASKED
+# ===============
+
+
+def pipeline_masked(data, config, progress=None):
+    '''
+    Perform iterative variance calculation, excluding timepoints flagged by
+    earlier iterations from the median and the mean intensity, until no new
+    timepoints get flagged. Data is scrubbed once at the end, from the union
+    of flags across iterations.
+
+    Each iteration records only the timepoints it newly flagged. In batch
+    mode, each run drops out once no new timepoints get flagged.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        config      [object] varana_config
+        progress    [func  ] As in pipeline_iterative
+    Outputs
+        result      [object] varana_result, with one entry per iteration
+    '''
+
+    # The rolling median has no masked counterpart
+    if config.window is not None:
+        raise TypeError('Error: masked mode does not support a median window.')
+
+    # Arrange data
+    data, time_axis, summary_axis, n_runs = pipeline_prepare(data, config)
+
+    # Batch mode normalises per run
+    run_axis = None if n_runs is None else 0
+
+    # Union of flags so far
+    flags = np.zeros(data.shape, dtype=bool)
+
+    # Empty lists
+    var_iter = []
+    reg_iter = []
+
+    # Runs still being scrubbed & iterations per run
+    active = np.ones(n_runs or 1, dtype=bool)
+    n_iter = np.zeros(n_runs or 1, dtype=int)
+
+    # Iteration counter
+    counter = 0
+
+    # Loop until all runs have converged
+    while active.any():
+
+        # Update counter
+        counter += 1
+
+        # Message
+        print('Iteration: ' + str(counter))
+
+        # Active runs
+        if n_runs is None:
+            data_active = data
+            flags_active = flags
+        else:
+            data_active = data[active]
+            flags_active = flags[active]
+
+        # Variance against the median of timepoints not yet flagged
+        vw_variance = variance_masked(
+            data_active,
+            time_axis,
+            flags_active,
+            run_axis
+        )
+
+        # Threshold test, keeping only new flags
+        regressor = engine_threshold(
+            config,
+            vw_variance,
+            summary_axis,
+            config.var_threshold
+        )
+        regressor &= ~flags_active
+
+        # Message
+        print('Bad timepoints: ' + str(regressor.sum()))
+
+        # Single run
+        if n_runs is None:
+            flags |= regressor
+            var_iter.append(vw_variance)
+            reg_iter.append(regressor)
+            n_iter[0] += 1
+            active[0] = regressor.any()
+
+        # Batch of runs, as in pipeline_iterative
+        else:
+
+            # Update flags
+            flags[active] = flags_active | regressor
+
+            # Full-batch variance, finished runs keep their last variance
+            if var_iter:
+                variance = var_iter[-1].copy()
+            else:
+                variance = np.zeros(data.shape)
+            variance[active] = vw_variance
+
+            # Full-batch regressor, finished runs flag nothing
+            regressor_batch = np.zeros(data.shape, dtype=bool)
+            regressor_batch[active] = regressor
+
+            # Store
+            var_iter.append(variance)
+            reg_iter.append(regressor_batch)
+
+            # Update per-run convergence mask
+            n_iter[active] += 1
+            active[active] = regressor.reshape(
+                regressor.shape[0], -1
+            ).any(axis=1)
+
+        # Report progress
+        if progress is not None:
+            progress(counter, int(np.count_nonzero(regressor)))
+
+    # Scrub once, or lazy view of the scrubbed data
+    if config.lazy:
+        data_scrub = scrubview(
+            data,
+            time_axis,
+            scrub_intervals(data, flags, time_axis)
+        )
+    else:
+        data_scrub = pipeline_freeze(
+            engine_scrub(config, data, flags, time_axis)
+        )[0]
+
+    # Return
+    return varana_result(
+        config=config,
+        summary_axis=summary_axis,
+        variance=pipeline_freeze(*var_iter),
+        regressor=pipeline_freeze(*reg_iter),
+        data_scrub=data_scrub,
+        n_runs=n_runs,
+        n_iter=None if n_runs is None else pipeline_freeze(n_iter)[0]
+    )
+
+# ==================
+# PIPELINE_SEGMENTED
+# ==================
+
+
+def pipeline_segmented(data, config, scratch=None, max_iter=None,
+                       progress=None):
+    '''
+    Perform iterative variance calculation and data scrubbing, as in
+    pipeline_iterative, reading config.segment timepoints at a time, see
+    tsvarana.segment. Every iteration reads the data of the previous one
+    from disk, so only one segment is held in memory. Results are memory
+    maps of files in the scratch directory, which must be kept while they
+    are in use.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array of a single
+                             run, or an array-like that can be sliced,
+                             e.g. a memory map or a nibabel array proxy
+        config      [object] varana_config
+        scratch     [string] Directory for results, created if needed.
+                             A new temporary directory if None
+        max_iter    [scalar] Maximum number of iterations, no limit if None
+        progress    [func  ] As in pipeline_iterative
+    Outputs
+        result      [object] varana_result, with one entry per iteration
+    '''
+
+    # Single runs only, scrubbed every iteration
+    if isinstance(data, (list, tuple)) or config.run_axis is not None:
+        raise TypeError('Error: segmented runs do not support batches.')
+    if config.masked or config.lazy:
+        raise TypeError(
+            'Error: segmented runs do not support masked or lazy mode.'
+        )
+
+    # Shapes & summary axes, with time along the first axis for results
+    time_axis = config.time_axis
+    ndim = len(data.shape)
+    shape = tuple(data.shape)
+    q_shape = (shape[time_axis],) + shape[:time_axis] + shape[time_axis + 1:]
+    summary_axis = parse_spatial_unit(
+        config.spatial_unit,
+        ndim,
+        config.slice_axis,
+        time_axis
+    )
+    q_summary = parse_spatial_unit(
+        config.spatial_unit,
+        ndim,
+        config.slice_axis + (config.slice_axis < time_axis),
+        0
+    )
+
+    # Results directory
+    if scratch is None:
+        scratch = tempfile.mkdtemp(prefix='tsvarana_')
+    os.makedirs(scratch, exist_ok=True)
+
+    # Empty lists
+    var_iter = []
+    reg_iter = []
+
+    # Iteration counter
+    counter = 0
+
+    # Loop until no timepoints get replaced
+    while max_iter is None or counter < max_iter:
+
+        # Update counter
+        counter += 1
+
+        # Message
+        print('Iteration: ' + str(counter))
+
+        # Memory-mapped results of this iteration
+        variance, regressor, data_scrub = [
+            np.lib.format.open_memmap(
+                os.path.join(
+                    scratch,
+                    name + '_' + str(counter).zfill(3) + '.npy'
+                ),
+                mode='w+',
+                dtype=dtype,
+                shape=q_shape
+            )
+            for name, dtype in (('variance', float),
+                                ('regressor', bool),
+                                ('data', float))
+        ]
+
+        # Variance calculation, threshold test & scrubbing
+        segment_scrub(
+            data,
+            time_axis,
+            config,
+            q_summary,
+            variance,
+            regressor,
+            data_scrub
+        )
+
+        # Store, in the original axis order
+        var_iter.append(np.moveaxis(variance, 0, time_axis))
+        reg_iter.append(np.moveaxis(regressor, 0, time_axis))
+
+        # Message
+        n_flagged = int(np.count_nonzero(regressor))
+        print('Bad timepoints: ' + str(n_flagged))
+
+        # Scrubbed data of the previous iteration is no longer needed
+        if counter > 1:
+            del data
+            os.remove(os.path.join(
+                scratch,
+                'data_' + str(counter - 1).zfill(3) + '.npy'
+            ))
+
+        # Next iteration reads the scrubbed data
+        data = np.moveaxis(data_scrub, 0, time_axis)
+
+        # Report progress
+        if progress is not None:
+            progress(counter, n_flagged)
+        if not n_flagged:
+            break
+
+    # Return
+    return varana_result(
+        config=config,
+        summary_axis=summary_axis,
+        variance=pipeline_freeze(*var_iter),
+        regressor=pipeline_freeze(*reg_iter),
+        data_scrub=pipeline_freeze(data)[0],
+        n_runs=None,
+        n_iter=None
+    )
+
+# ==============
+# PIPELINE_UNITS
+# ==============
+
+
+def pipeline_units(data, config, units=PIPELINE_UNITS, iterative=False):
+    '''
+    Run several spatial units from one shared variance calculation. The
+    median and the variance are calculated once, and each unit is tested
+    on means of the shared variance, with wider units starting from the
+    partial means of narrower ones, e.g. volume means from slice means.
+    Results match running each unit separately.
+
+    With iterative set, each unit is then scrubbed as in pipeline_iterative,
+    starting from the shared first iteration. Later iterations recalculate
+    the median of scrubbed voxels only.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array,
+                             or list of arrays with one run each
+        config      [object] varana_config, the spatial unit is ignored
+        units       [tuple ] Spatial units, see
+                             tsvarana.utils.parse_spatial_unit
+        iterative   [ bool ] If True, scrub each unit iteratively,
+                             otherwise detect only
+    Outputs
+        results     [dict  ] varana_result of each unit
+    '''
+
+    # Whole-data variance only
+    if config.masked or config.segment:
+        raise TypeError(
+            'Error: multi-unit runs do not support masked or segmented mode.'
+        )
+
+    # Stack lists of runs once, as in pipeline_oneshot
+    if isinstance(data, (list, tuple)):
+        data = np.stack(data, axis=0)
+        config = config._replace(run_axis=0)
+
+    # Coarse-to-fine variance depends on the unit, so is not shared
+    config = config._replace(pyramid=0)
+
+    # Arrange data
+    prepared, time_axis, _, n_runs = pipeline_prepare(data, config)
+
+    # Batch mode normalises per run
+    run_axis = None if n_runs is None else 0
+    shift = int(n_runs is not None)
+
+    # Shared median & variance
+    median_img = median_calc(prepared, time_axis, config.window)
+    vw_variance = engine_variance(
+        config,
+        prepared,
+        time_axis,
+        run_axis,
+        median_img=median_img
+    )
+
+    # Means along leading summary axes, by axes
+    means = {(): vw_variance}
+
+    # Empty dictionary
+    results = {}
+
+    # Loop units
+    for unit in units:
+
+        # Unit settings & summary axes, stepping over the run axis
+        unit_config = config._replace(spatial_unit=unit)
+        summary_axis = tuple(
+            i + shift for i in parse_spatial_unit(
+                unit,
+                prepared.ndim - shift,
+                config.slice_axis,
+                config.time_axis
+            )
+        )
+
+        # Labels, already a single grouped pass
+        if unit == 'label':
+            regressor = engine_threshold(
+                unit_config,
+                vw_variance,
+                summary_axis,
+                config.var_threshold
+            )
+
+        # Mean variance along each axis, reusing earlier partial means
+        else:
+            for n in range(1, len(summary_axis) + 1):
+                if summary_axis[:n] not in means:
+                    means[summary_axis[:n]] = np.mean(
+                        means[summary_axis[:n - 1]],
+                        axis=summary_axis[n - 1],
+                        keepdims=True
+                    )
+            regressor = np.broadcast_to(
+                means[summary_axis] > config.var_threshold,
+                vw_variance.shape
+            ).copy()
+
+        # Iterative scrubbing, from the shared first iteration
+        if iterative:
+            results[unit] = pipeline_iterative(
+                data,
+                unit_config,
+                shared=(vw_variance, regressor, median_img)
+            )
+
+        # Detection only
+        else:
+            results[unit] = varana_result(
+                config=unit_config,
+                summary_axis=summary_axis,
+                variance=pipeline_freeze(vw_variance),
+                regressor=pipeline_freeze(regressor),
+                data_scrub=None,
+                n_runs=n_runs,
+                n_iter=None if n_runs is None else pipeline_freeze(
+                    np.ones(n_runs, dtype=int)
+                )[0]
+            )
+
+    # Return
+    return results
+
+# ==============
+# PIPELINE_SPLIT
+# ==============
+
+
+def pipeline_split(result):
+    '''
+    Split a batch result into single-run results
+
+    Inputs
+        result      [object] varana_result, in batch mode
+    Outputs
+        results     [list  ] varana_result, one per run
+    '''
+
+    # Single-run settings
+    config = result.config._replace(run_axis=None)
+    summary_axis = tuple(i - 1 for i in result.summary_axis)
+
+    # Return one result per run, keeping only its own iterations
+    return [
+        varana_result(
+            config=config,
+            summary_axis=summary_axis,
+            variance=tuple(v[r] for v in result.variance[:result.n_iter[r]]),
+            regressor=tuple(
+                g[r] for g in result.regressor[:result.n_iter[r]]
+            ),
+            data_scrub=None if result.data_scrub is None else
+            result.data_scrub[r],
+            n_runs=None,
+            n_iter=None
+        )
+        for r in range(result.n_runs)
+    ]
+
+# Done
+#
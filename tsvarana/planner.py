@@ -0,0 +1,314 @@
+# planner.py
+#
+# tsvarana memory-budget planner.
+#
+# Estimates peak memory and runtime of each execution strategy from the
+# NIFTI header alone, before any data is loaded, and picks the fastest
+# strategy that fits within a memory budget. Strategies are
+#   - memory    whole run in memory, as read by nibabel
+#   - cache     input served as a memory map from the input cache, see
+#               tsvarana/cache.py, so only working arrays count
+#   - shard     slabs along the slice axis processed one at a time, see
+#               tsvarana/shard.py, so only one slab is held in memory.
+#               The number of shards is the smallest that fits
+#
+# Memory is modelled in bytes per data value, measured on the current
+# pipeline. Runtime is extrapolated from timing the pipeline on a small
+# synthetic run, and the number of scrub iterations is an assumption.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import time
+import numpy as np
+import nibabel as nib
+
+# Project dependencies
+from tsvarana.core import (
+    variance_calc,
+    threshold_test,
+    scrub
+)
+from tsvarana.utils import parse_spatial_unit
+
+# Default number of scrub iterations assumed for iterative scrubbing
+PLAN_ITERATIONS = 5
+
+# Bytes per data value held in memory
+#   input      float input data
+#   working    scrubbed data being updated
+#   transient  temporaries of one variance, threshold & scrub iteration
+#   iteration  variance & regressor kept for every iteration
+#   output     final regressor & report, once scrubbing is done
+#   slab       data, variance & regressor of one shard
+#   merge      final regressor & report, from memory-mapped shards
+PLAN_BYTES = {
+    'input': 8,
+    'working': 8,
+    'transient': 24,
+    'iteration': 9,
+    'output': 18,
+    'slab': 41,
+    'merge': 16,
+}
+
+# Read rate in bytes per second, for gzipped & uncompressed NIFTI files
+PLAN_READ_RATE = {'gz': 100 * 1024 ** 2, 'nii': 1000 * 1024 ** 2}
+
+# Rate at which shard data is written & read back, in bytes per second
+PLAN_DISK_RATE = 500 * 1024 ** 2
+
+# Options of default_routine that sharded runs do not support, with their
+# unset values. Shards scrub every iteration, so cannot run masked mode,
+# and only write the outputs of default_routine
+PLAN_SHARD_UNSUPPORTED = {
+    'masked': False,
+    'triage': False,
+    'index': None,
+    'checkpoint': None,
+    'resume': False,
+    'lazy': False,
+    'engine': 'reference',
+    'verify': 0,
+    'pyramid': 0,
+    'segment': 0,
+}
+
+# =========
+# UTILITIES
+# =========
+
+
+def plan_calibrate(n_timepoints, spatial_unit='voxel'):
+    '''
+    Time one iteration of the pipeline on a small synthetic run
+
+    Inputs
+        n_timepoints [scalar] Number of timepoints of the planned run
+        spatial_unit [string] Spatial unit of the planned run
+    Outputs
+        seconds     [scalar] Seconds per data value per iteration
+    '''
+
+    # Synthetic run, with a few flagged timepoints
+    data = np.random.rand(16, 16, 8, min(max(n_timepoints, 10), 200))
+    data[:, :, :, ::7] += 3
+    summary_axis = parse_spatial_unit(spatial_unit, data.ndim, 2, 3)
+
+    # One iteration
+    start = time.perf_counter()
+    vw_variance = variance_calc(data, 3)
+    regressor = threshold_test(vw_variance, summary_axis, 5)
+    scrub(data, regressor, 3)
+
+    # Return
+    return (time.perf_counter() - start) / data.size
+
+
+def plan_human(n_bytes):
+    '''
+    Format a number of bytes in MB or GB
+
+    Inputs
+        n_bytes     [scalar] Number of bytes
+    Outputs
+        text        [string] Size in MB below 1 GB, in GB otherwise
+    '''
+
+    # Return
+    if n_bytes < 1024 ** 3:
+        return '{:.1f} MB'.format(n_bytes / 1024 ** 2)
+    return '{:.2f} GB'.format(n_bytes / 1024 ** 3)
+
+# =============
+# PLAN_ESTIMATE
+# =============
+
+
+def plan_estimate(shape, slice_axis=2, n_iter=PLAN_ITERATIONS, seconds=None,
+                  read_rate=PLAN_READ_RATE['nii']):
+    '''
+    Estimate peak memory and runtime of each execution strategy
+
+    Inputs
+        shape       [tuple ] Data shape, from the NIFTI header
+        slice_axis  [scalar] Axis along which shards are split
+        n_iter      [scalar] Number of scrub iterations
+        seconds     [scalar] Seconds per data value per iteration, see
+                             plan_calibrate. Runtime is not estimated if
+                             None
+        read_rate   [scalar] Rate at which the input file is read, in
+                             bytes per second
+    Outputs
+        candidates  [list  ] One dict per strategy, fastest first
+                             'strategy': 'memory', 'cache' or 'shard'
+                             'shards':   number of shards, 1 otherwise
+                             'memory':   peak memory in bytes
+                             'runtime':  runtime in seconds, or None
+    '''
+
+    # Number of data values & their size
+    n_values = int(np.prod(shape))
+    n_bytes = n_values * PLAN_BYTES['input']
+
+    # Compute & read time, common to every strategy
+    runtime = None
+    if seconds is not None:
+        runtime = n_iter * n_values * seconds + n_bytes / read_rate
+
+    # Whole run in memory, iterations are kept until the outputs are saved
+    in_memory = n_values * (
+        PLAN_BYTES['working'] +
+        PLAN_BYTES['iteration'] * n_iter +
+        max(PLAN_BYTES['transient'], PLAN_BYTES['output'])
+    )
+    candidates = [
+        {
+            'strategy': 'memory',
+            'shards': 1,
+            'memory': in_memory + n_bytes,
+            'runtime': runtime,
+        },
+        {
+            'strategy': 'cache',
+            'shards': 1,
+            'memory': in_memory,
+            'runtime': runtime,
+        },
+    ]
+
+    # One slab at a time, doubling the number of shards up to one per
+    # slice. Data is written & read back every round
+    n_slices = shape[slice_axis]
+    n_shards = 2
+    while True:
+        n_shards = min(n_shards, n_slices)
+        slab = max(
+            int(np.ceil(n_slices / n_shards)) * n_values // n_slices *
+            PLAN_BYTES['slab'],
+            n_values * PLAN_BYTES['merge']
+        )
+        candidates.append({
+            'strategy': 'shard',
+            'shards': n_shards,
+            'memory': slab,
+            'runtime': None if runtime is None else
+            runtime + (n_iter + 1) * 2 * n_bytes / PLAN_DISK_RATE,
+        })
+        if n_shards == n_slices:
+            break
+        n_shards *= 2
+
+    # Return
+    return candidates
+
+# ===========
+# PLAN_SELECT
+# ===========
+
+
+def plan_select(candidates, max_memory=None):
+    '''
+    Select the fastest strategy within a memory budget
+
+    Inputs
+        candidates  [list  ] As returned by plan_estimate
+        max_memory  [scalar] Memory budget in bytes, no limit if None
+    Outputs
+        plan        [dict  ] Selected candidate
+    '''
+
+    # First candidate that fits, candidates are ordered fastest first
+    for candidate in candidates:
+        if max_memory is None or candidate['memory'] <= max_memory:
+            return candidate
+
+    # Nothing fits
+    raise TypeError(
+        'Error: no strategy fits within ' + plan_human(max_memory) +
+        ', the smallest needs ' +
+        plan_human(min(c['memory'] for c in candidates)) + '.'
+    )
+
+# ============
+# PLAN_ROUTINE
+# ============
+
+
+def plan_routine(args):
+    '''
+    Plan the default routine for a NIFTI file, reading its header only,
+    and print the plan.
+
+    Inputs
+      args.data           [string] A 4D NIFTI file
+      args.max_memory     [scalar] Memory budget in GB, no limit if None
+      args.plan_iterations [scalar] Number of scrub iterations assumed
+      ...                          Settings as in default_routine
+    Outputs
+      plan                [dict  ] Selected strategy, as in plan_estimate
+    '''
+
+    # Read NIFTI header only
+    shape = nib.load(args.data).shape
+
+    # One iteration for one-shot scrubbing
+    n_iter = 1 if args.one_shot else args.plan_iterations
+
+    # Estimate every strategy
+    candidates = plan_estimate(
+        shape,
+        slice_axis=args.slice_axis,
+        n_iter=n_iter,
+        seconds=plan_calibrate(shape[args.time_axis], args.spatial_unit),
+        read_rate=PLAN_READ_RATE[
+            'gz' if args.data.endswith('.gz') else 'nii'
+        ]
+    )
+
+    # Options sharded runs do not support, and labels may span several
+    # shards
+    unsupported = [
+        '--' + option
+        for option, unset in PLAN_SHARD_UNSUPPORTED.items()
+        if getattr(args, option) != unset
+    ]
+    if args.spatial_unit == 'label':
+        unsupported.append('--spatial_unit label')
+    if unsupported:
+        candidates = [c for c in candidates if c['strategy'] != 'shard']
+
+    # Select
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = args.max_memory * 1024 ** 3
+    plan = plan_select(candidates, max_memory)
+
+    # Report
+    print('Data: ' + os.path.basename(args.data) + ' ' + str(shape) +
+          ', assuming ' + str(n_iter) + ' iteration(s)')
+    if unsupported:
+        print('Shards not considered, as they do not support ' +
+              ', '.join(unsupported))
+    for candidate in candidates:
+        print(
+            ('* ' if candidate is plan else '  ') +
+            '{:<6} shards {:>4}  memory {:>10}  runtime {:>8.1f} s'.format(
+                candidate['strategy'],
+                candidate['shards'],
+                plan_human(candidate['memory']),
+                candidate['runtime']
+            )
+        )
+
+    # Return
+    return plan
+
+# Done
+#
@@ -16,6 +16,14 @@ from bokeh import layouts
 from bokeh import models
 from bokeh import palettes
 
+# Project dependencies
+from tsvarana.utils import (
+    carpet_bin,
+    summary_calc,
+    decimate_minmax,
+    image_pyramid
+)
+
 # ===============
 # PLOT_DIAGNOSTIC
 # ===============
@@ -80,6 +88,130 @@ def plot_regressor(varana, show=False, outfile=None):
     # Return
     return grid
 
+# ===========
+# PLOT_REPORT
+# ===========
+
+
+def plot_report(varana, show=False, outfile=None, max_size=1000000,
+                n_rows=200):
+    '''
+    Plot variance and regressors for every scrub iteration in one document.
+    Summaries are computed once per iteration, then decimated to fit the
+    output size budget: lines with min-max decimation, images by picking
+    the first image pyramid level under budget, with the time column of
+    the lines counted in the budget. Line figures read from one shared
+    data source, image figures from another, and all share the time axis
+
+    Inputs
+        varana       [object] As created by tsvarana.classes.varana
+        show         [ bool ] Show the plot
+        outfile      [string] If specified, save plot as HTML file
+        max_size     [scalar] Maximum number of data values embedded
+        n_rows       [scalar] Number of voxel bins, voxel unit only
+    Output
+        grid         [object] Figure grid handle
+    '''
+
+    # Shared summaries, one per iteration
+    # Variance and regressor figures are interleaved per iteration
+    summaries = []
+    for counter in range(len(varana.variance)):
+        for data_type, data_list in (('variance', varana.variance),
+                                     ('regressor', varana.regressor)):
+            summaries.append((
+                data_type,
+                counter,
+                summary_calc(
+                    data_list[counter],
+                    varana.spatial_unit,
+                    varana.summary_axis,
+                    varana.time_axis,
+                    n_rows,
+                    labels=getattr(varana, 'labels', None)
+                )
+            ))
+
+    # Output size budget per column, counting the time column shared by
+    # line figures
+    n_columns = len(summaries) + any(y.ndim == 1 for _, _, y in summaries)
+    budget = max(max_size // n_columns, 1)
+
+    # Decimate summaries into shared line & image data sources
+    lines = {}
+    images = {}
+    for data_type, counter, y in summaries:
+
+        # Column name
+        key = data_type + '_' + str(counter + 1)
+
+        # Lines, min-max decimation
+        if y.ndim == 1:
+            lines['x'], y = decimate_minmax(y, max(budget // 2, 1))
+            lines[key] = y.astype(np.float32)
+
+        # Images, coarsest pyramid level needed to fit the budget
+        else:
+            images[key] = [image_pyramid(y, budget)[-1].astype(np.float32)]
+
+    # Shared sources
+    line_source = models.ColumnDataSource(data=lines)
+    image_source = models.ColumnDataSource(data=images)
+
+    # Empty plot handle list
+    handles = []
+
+    # Loop summaries
+    for data_type, counter, y in summaries:
+
+        # Column name
+        key = data_type + '_' + str(counter + 1)
+
+        # Plot line or image
+        if y.ndim == 1:
+            handle = plot_line(
+                line_source,
+                key,
+                binary=data_type == 'regressor'
+            )
+        else:
+            handle = plot_image(
+                y,
+                {'slice': 'Slice', 'label': 'Label'}.get(
+                    varana.spatial_unit,
+                    'Voxel bin'
+                ),
+                source=image_source,
+                key=key
+            )
+
+        # Change title
+        new_title = models.annotations.Title()
+        new_title.text = data_type + ' - iteration ' + str(counter + 1)
+        handle.title = new_title
+
+        # Share time axis with the first figure
+        if handles:
+            handle.x_range = handles[0].x_range
+
+        # Store handle
+        handles.append(handle)
+
+    # Arrange plots
+    grid = layouts.gridplot(handles, ncols=1)
+
+    # Show
+    if show:
+        plotting.show(grid)
+
+    # Save figure
+    if outfile:
+        plotting.output_file(outfile)
+        plotting.save(grid)
+
+    # Return
+    return grid
+
 # =============
 # PLOT_ITERATOR
 # =============
@@ -127,11 +259,21 @@ def plot_iterator(varana, data_type):
                 varana.time_axis
             )
 
+        elif varana.spatial_unit == 'label':
+
+            # Plot labels x time heatmap
+            handle = plot_label(
+                data,
+                varana.labels,
+                varana.summary_axis
+            )
+
         elif varana.spatial_unit == 'voxel':
 
-            # Not plotting 3D, because that's silly
-            raise TypeError(
-                'Error: Voxelwise variance diagnostic plot is not defined.'
+            # Plot binned voxel carpet
+            handle = plot_carpet(
+                data,
+                varana.time_axis
             )
 
         # Change title
@@ -182,8 +324,8 @@ def plot_1d(data, summary_axis, time_axis):
 
     # Create figure
     handle = plotting.figure(
-        plot_width=800,
-        plot_height=500,
+        width=800,
+        height=500,
         title='',
         x_axis_label='Time (TR)',
         y_axis_label='Mean normalized variance',
@@ -246,15 +388,155 @@ def plot_2d(data, summary_axis, time_axis):
     # Force data into float type
     y = y.astype(float)
 
+    # Plot image
+    handle = plot_image(y, 'Slice')
+
+    # Return
+    return handle
+
+# ===========
+# PLOT_CARPET
+# ===========
+
+
+def plot_carpet(data, time_axis, n_rows=200):
+    '''
+    Plot voxelwise variance analysis as a carpet image, with voxels binned
+    into a fixed number of rows so the figure size does not grow with the
+    number of voxels
+
+    Inputs
+        data         [array]  Voxelwise data
+                              Can be scalar (vw_variance) or binary (regressor)
+        time_axis    [scalar] Axis along which time is encoded
+        n_rows       [scalar] Number of voxel bins
+
+    Outputs
+        handle       [object] Figure handle
+    '''
+
+    # Mean across voxel bins
+    # y = (voxel bin, time)
+    y = carpet_bin(data, time_axis, n_rows)
+
+    # Plot image
+    handle = plot_image(y, 'Voxel bin')
+
+    # Return
+    return handle
+
+# ==========
+# PLOT_LABEL
+# ==========
+
+
+def plot_label(data, labels, summary_axis):
+    '''
+    Plot variance analysis per label of a label image, as a labels x time
+    heatmap
+
+    Inputs
+        data         [array]  Voxelwise data
+                              Can be scalar (vw_variance) or binary (regressor)
+        labels       [array]  Integer label image, label 0 is background
+        summary_axis [tuple]  Spatial axes of data
+
+    Outputs
+        handle       [object] Figure handle
+    '''
+
+    # Mean per label, background excluded
+    # y = (label, time)
+    y = summary_calc(data, 'label', summary_axis, None, labels=labels)
+
+    # Plot image
+    handle = plot_image(y, 'Label')
+
+    # Return
+    return handle
+
+# =========
+# PLOT_LINE
+# =========
+
+
+def plot_line(source, key, binary=False):
+    '''
+    Plot a timecourse from a shared data source
+
+    Inputs
+        source       [object] ColumnDataSource, with timepoints in column 'x'
+        key          [string] Column holding the timecourse
+        binary       [ bool ] Plot as step, for binary data (regressor)
+
+    Outputs
+        handle       [object] Figure handle
+    '''
+
+    # Create figure
+    handle = plotting.figure(
+        width=800,
+        height=500,
+        title='',
+        x_axis_label='Time (TR)',
+        y_axis_label='Mean normalized variance',
+        tools='pan,box_zoom,reset',
+    )
+
+    # If the array is binary, plot as step
+    # Otherwise, plot as line
+    if binary:
+        handle.step('x', key, source=source, line_width=2)
+    else:
+        handle.line('x', key, source=source, line_width=2)
+
+    # Tidy
+    handle.title.align = 'center'
+    handle.xaxis.axis_label_text_align = 'center'
+    handle.yaxis.axis_label_text_align = 'center'
+    handle.xaxis.axis_label_text_font_size = '10pt'
+    handle.yaxis.axis_label_text_font_size = '10pt'
+    handle.xaxis.axis_label_text_font_style = 'normal'
+    handle.yaxis.axis_label_text_font_style = 'normal'
+
+    # Return
+    return handle
+
+# ==========
+# PLOT_IMAGE
+# ==========
+
+
+def plot_image(y, y_axis_label, source=None, key='image'):
+    '''
+    Plot a (row, time) image with colorbar
+
+    Inputs
+        y            [array]  2D array with time along the second axis
+                              Can be scalar (vw_variance) or binary (regressor)
+        y_axis_label [string] Label for the row axis
+        source       [object] If specified, ColumnDataSource holding a
+                              (possibly downsampled) copy of y, which is
+                              stretched to the full extent of y
+        key          [string] Column of source holding the image
+
+    Outputs
+        handle       [object] Figure handle
+    '''
+
+    # Data source
+    if source is None:
+        source = models.ColumnDataSource(data={key: [y]})
+
     # Create figure
     handle = plotting.figure(
-        plot_width=800,
-        plot_height=500,
+        width=800,
+        height=500,
         title='',
         x_axis_label='Time (TR)',
-        y_axis_label='Slice',
+        y_axis_label=y_axis_label,
         tools='pan,box_zoom,reset',
-        tooltips=[('x', '$x'), ('y', '$y'), ('value', '@image')]
+        tooltips=[('x', '$x'), ('y', '$y'), ('value', '@' + key)]
     )
 
     # If the array is binary, set colour mapper to b/w
@@ -277,7 +559,8 @@ def plot_2d(data, summary_axis, time_axis):
 
     # Add image
     handle.image(
-        image=[y],
+        image=key,
+        source=source,
         x=0,
         y=0,
         dh=y.shape[0],
@@ -0,0 +1,182 @@
+# pyramid.py
+#
+# tsvarana coarse-to-fine variance for the voxel unit.
+#
+# Artefacts are usually spatially clustered, so most of the brain can be
+# cleared at coarse resolution. The data is pooled into a pyramid of blocks,
+# halving each spatial axis per level, keeping the minimum and maximum of
+# every block at every timepoint. Since every voxel of a block lies between
+# the block minimum and maximum at all timepoints, its median lies between
+# the medians of the block minimum and maximum, which bounds the distance
+# of every voxel from its median, and so its normalised variance.
+#
+# Blocks are tested from the coarsest level down, and only blocks whose
+# bound exceeds the threshold are refined. Exact variance is calculated
+# only for voxels that could exceed the threshold, so the threshold test
+# gives the same result as at full resolution. Voxels cleared by the bound
+# are given zero variance.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+
+# Project dependencies
+from tsvarana.core import variance_calc
+
+# Relative margin added to bounds, to absorb rounding differences
+PYRAMID_SLACK = 1e-6
+
+# =========
+# UTILITIES
+# =========
+
+
+def pyramid_pool(lo, hi, axes):
+    '''
+    Halve the resolution of block minima & maxima along the given axes.
+    Odd axes are padded by repeating their last element.
+
+    Inputs
+        lo          [array ] Block minima
+        hi          [array ] Block maxima
+        axes        [list  ] Axes to pool
+    Outputs
+        lo          [array ] Minima of pairs of blocks
+        hi          [array ] Maxima of pairs of blocks
+    '''
+
+    # Loop axes
+    for axis in axes:
+
+        # Pad odd axes
+        if lo.shape[axis] % 2:
+            pad = [(0, 0)] * lo.ndim
+            pad[axis] = (0, 1)
+            lo = np.pad(lo, pad, mode='edge')
+            hi = np.pad(hi, pad, mode='edge')
+
+        # Even & odd elements
+        even = [slice(None)] * lo.ndim
+        odd = [slice(None)] * lo.ndim
+        even[axis] = slice(0, None, 2)
+        odd[axis] = slice(1, None, 2)
+
+        # Pool pairs
+        lo = np.minimum(lo[tuple(even)], lo[tuple(odd)])
+        hi = np.maximum(hi[tuple(even)], hi[tuple(odd)])
+
+    # Return
+    return lo, hi
+
+
+def pyramid_upsample(mask, shape):
+    '''
+    Double the resolution of a block mask, cropped to a given shape
+
+    Inputs
+        mask        [array ] Binary mask of blocks
+        shape       [tuple ] Shape at the finer level
+    Outputs
+        mask        [array ] Binary mask at the finer level
+    '''
+
+    # Repeat along every axis & crop
+    for axis, n in enumerate(shape):
+        mask = np.repeat(mask, 2, axis=axis)
+        mask = np.take(mask, np.arange(n), axis=axis)
+
+    # Return
+    return mask
+
+# ================
+# VARIANCE_PYRAMID
+# ================
+
+
+def variance_pyramid(data, time_axis, threshold, levels=3, data_mean=None,
+                     variance=variance_calc):
+    '''
+    Calculate timeseries variance against median timepoint, as in
+    tsvarana.core.variance_calc, for the voxels that could exceed the
+    threshold only. Other voxels have zero variance.
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        time_axis   [scalar] Axis along which time is encoded
+                             e.g. for (x,y,z,t) data, time_axis=3
+        threshold   [scalar] Normalised variance threshold
+        levels      [scalar] Number of pyramid levels, each halving every
+                             spatial axis
+        data_mean   [scalar] If specified, normalise by this value instead
+                             of the mean intensity of data
+        variance    [func  ] Variance calculation for the remaining
+                             voxels, as tsvarana.core.variance_calc
+
+    Outputs
+        vw_variance [array ] Voxelwise variance-to-mean array
+    '''
+
+    # Mean voxel intensity across entire dataset
+    if data_mean is None:
+        data_mean = data.mean()
+
+    # Bounds only hold for a positive mean intensity
+    if data_mean <= 0 or levels < 1:
+        return variance(data, time_axis, data_mean=data_mean)
+
+    # Time along the last axis
+    q_data = np.moveaxis(data, time_axis, -1)
+    spatial = list(range(q_data.ndim - 1))
+
+    # Pyramid of block minima & maxima, finest level first
+    pyramid = []
+    lo, hi = q_data, q_data
+    for _ in range(levels):
+        lo, hi = pyramid_pool(lo, hi, spatial)
+        pyramid.append((lo, hi))
+
+    # Blocks that could exceed the threshold, from the coarsest level down
+    suspect = np.ones(pyramid[-1][0].shape[:-1], dtype=bool)
+    for level, (lo, hi) in enumerate(reversed(pyramid)):
+
+        # Refine blocks of the level above
+        if level > 0:
+            suspect = pyramid_upsample(suspect, lo.shape[:-1])
+
+        # Minima & maxima of suspect blocks, (block, time)
+        index = np.nonzero(suspect)
+        block_lo = lo[index]
+        block_hi = hi[index]
+
+        # Bound on the distance of every voxel from its median
+        median_lo = np.median(block_lo, axis=-1, keepdims=True)
+        median_hi = np.median(block_hi, axis=-1, keepdims=True)
+        distance = np.maximum(block_hi - median_lo, median_hi - block_lo)
+
+        # Blocks whose bound exceeds the threshold at any timepoint
+        bound = (distance / 2) ** 2 / data_mean * (1 + PYRAMID_SLACK)
+        suspect[index] = (bound > threshold).any(axis=-1)
+
+    # Voxels that could exceed the threshold
+    suspect = pyramid_upsample(suspect, q_data.shape[:-1])
+    index = np.nonzero(suspect)
+
+    # Exact variance of those voxels only
+    vw_variance = np.zeros(q_data.shape)
+    if index[0].size:
+        vw_variance[index] = variance(q_data[index], 1, data_mean=data_mean)
+
+    # Revert to original axis order
+    vw_variance = np.moveaxis(vw_variance, -1, time_axis)
+
+    # Return
+    return vw_variance
+
+# Done
+#
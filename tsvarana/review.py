@@ -0,0 +1,377 @@
+# review.py
+#
+# tsvarana interactive review server.
+#
+# Serves a saved session with a Bokeh server. Session arrays are memory
+# maps, so a run opens without being read, and only what is visible gets
+# read and sent to the browser
+#   carpet   variance or regressor of one iteration, voxels x time. A tile
+#            is computed for the visible range whenever the view changes,
+#            sampling at most REVIEW_ROWS evenly spaced voxels and
+#            max-pooling time into at most REVIEW_COLUMNS bins, so
+#            single-timepoint spikes stay visible. Zooming in far enough
+#            shows every voxel
+#   slice    mean variance, or fraction of voxels flagged, of one slice
+#   voxel    scrubbed data, variance & regressor of one voxel, picked by
+#            clicking on the carpet
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import functools
+import numpy as np
+from bokeh import events
+from bokeh import layouts
+from bokeh import models
+from bokeh import palettes
+from bokeh import plotting
+
+# Project dependencies
+from tsvarana.classes import varana as varana_class
+from tsvarana.utils import decimate_minmax
+
+# Maximum number of voxel rows & time columns per carpet tile
+REVIEW_ROWS = 400
+REVIEW_COLUMNS = 800
+
+# Default server port
+REVIEW_PORT = 5006
+
+# =========
+# UTILITIES
+# =========
+
+
+def review_rows(array, time_axis, rows, start, stop):
+    '''
+    Read the timeseries of some voxels over a range of timepoints
+
+    Inputs
+        array       [array ] N-dimensional voxelwise array, e.g. a memory map
+        time_axis   [scalar] Axis along which time is encoded
+        rows        [array ] Voxel numbers, flattening all axes except the
+                             time axis in C order
+        start       [scalar] First timepoint
+        stop        [scalar] Timepoint after the last
+    Outputs
+        block       [array ] (voxel, time) float array
+    '''
+
+    # Voxel coordinates, with time along the last axis
+    q_array = np.moveaxis(array, time_axis, -1)
+    coords = np.unravel_index(rows, q_array.shape[:-1])
+
+    # Return
+    return np.asarray(q_array[coords + (slice(start, stop),)], dtype=float)
+
+
+def review_tile(array, time_axis, y_range, x_range, max_rows=REVIEW_ROWS,
+                max_columns=REVIEW_COLUMNS):
+    '''
+    Carpet tile of the visible range, voxels x time
+
+    Inputs
+        array       [array ] N-dimensional voxelwise array, e.g. a memory map
+        time_axis   [scalar] Axis along which time is encoded
+        y_range     [tuple ] Visible range of voxel rows
+        x_range     [tuple ] Visible range of timepoints
+        max_rows    [scalar] Maximum number of rows, sampled evenly
+        max_columns [scalar] Maximum number of columns, max-pooled
+    Outputs
+        tile        [dict  ] Image & placement, as image glyph columns
+    '''
+
+    # Visible range, within the array
+    n_timepoints = array.shape[time_axis]
+    n_voxels = int(np.prod(array.shape)) // n_timepoints
+    r0 = min(max(int(np.floor(y_range[0])), 0), n_voxels - 1)
+    r1 = max(min(int(np.ceil(y_range[1])), n_voxels), r0 + 1)
+    t0 = min(max(int(np.floor(x_range[0])), 0), n_timepoints - 1)
+    t1 = max(min(int(np.ceil(x_range[1])), n_timepoints), t0 + 1)
+
+    # Evenly spaced voxels
+    rows = np.arange(r0, r1)
+    if rows.size > max_rows:
+        rows = np.linspace(r0, r1 - 1, max_rows).round().astype(int)
+    image = review_rows(array, time_axis, rows, t0, t1)
+
+    # Max-pool time
+    if image.shape[1] > max_columns:
+        edges = np.linspace(0, image.shape[1], max_columns + 1).astype(int)
+        image = np.maximum.reduceat(image, edges[:-1], axis=1)
+
+    # Return
+    return {
+        'image': [image],
+        'x': [t0],
+        'y': [r0],
+        'dw': [t1 - t0],
+        'dh': [r1 - r0],
+    }
+
+
+def review_slice(array, slice_axis, time_axis, index):
+    '''
+    Mean of one slice at every timepoint
+
+    Inputs
+        array       [array ] N-dimensional voxelwise array, e.g. a memory map
+        slice_axis  [scalar] Axis along which slices are defined
+        time_axis   [scalar] Axis along which time is encoded
+        index       [scalar] Slice
+    Outputs
+        timecourse  [array ] Slice mean per timepoint
+    '''
+
+    # Read one slice
+    q_array = np.moveaxis(array, time_axis, -1)
+    q_slice = slice_axis - (slice_axis > time_axis)
+    block = np.take(q_array, index, axis=q_slice)
+
+    # Return
+    return np.reshape(block, [-1, block.shape[-1]]).mean(axis=0, dtype=float)
+
+# ===============
+# REVIEW_DOCUMENT
+# ===============
+
+
+def review_document(doc, path):
+    '''
+    Build the review document of a saved session
+
+    Inputs
+        doc         [object] Bokeh document, as given by the server
+        path        [string] Session directory, see tsvarana.session
+    '''
+
+    # Memory-mapped session
+    varana = varana_class()
+    varana.load(path)
+
+    # Batches are stacked along a leading run axis
+    shift = int(varana.n_runs is not None)
+    time_axis = varana.time_axis + shift
+    slice_axis = varana.slice_axis + shift
+    shape = varana.variance[0].shape
+    n_timepoints = shape[time_axis]
+    spatial = shape[:time_axis] + shape[time_axis + 1:]
+    n_voxels = int(np.prod(spatial))
+    q_slice = slice_axis - (slice_axis > time_axis)
+
+    # Controls
+    iteration = models.Select(
+        title='Iteration',
+        value='1',
+        options=[str(i + 1) for i in range(len(varana.variance))]
+    )
+    data_type = models.Select(
+        title='Data',
+        value='variance',
+        options=['variance', 'regressor']
+    )
+    slice_index = models.Spinner(
+        title='Slice',
+        low=0,
+        high=shape[slice_axis] - 1,
+        step=1,
+        value=0
+    )
+
+    # Selected array
+    def selected():
+        return getattr(varana, data_type.value)[int(iteration.value) - 1]
+
+    # Carpet, with the colour scale saturating at the threshold
+    carpet_source = models.ColumnDataSource(data=review_tile(
+        selected(),
+        time_axis,
+        (0, n_voxels),
+        (0, n_timepoints)
+    ))
+    color_mapper = models.LinearColorMapper(
+        palette=palettes.Viridis256,
+        low=0,
+        high=varana.var_threshold
+    )
+    carpet = plotting.figure(
+        width=800,
+        height=500,
+        title='Carpet',
+        x_axis_label='Time (TR)',
+        y_axis_label='Voxel',
+        x_range=(0, n_timepoints),
+        y_range=(0, n_voxels),
+        tools='pan,box_zoom,wheel_zoom,reset,tap',
+    )
+    carpet.image(
+        image='image',
+        x='x',
+        y='y',
+        dw='dw',
+        dh='dh',
+        source=carpet_source,
+        color_mapper=color_mapper
+    )
+    carpet.add_layout(
+        models.ColorBar(color_mapper=color_mapper, label_standoff=12),
+        'right'
+    )
+
+    # Slice & voxel timecourses
+    slice_source = models.ColumnDataSource(data={'x': [], 'y': []})
+    slice_figure = plotting.figure(
+        width=800,
+        height=250,
+        title='Slice',
+        x_axis_label='Time (TR)',
+        x_range=carpet.x_range,
+        tools='pan,box_zoom,reset',
+    )
+    slice_figure.line('x', 'y', source=slice_source, line_width=2)
+    voxel_source = models.ColumnDataSource(
+        data={'x': [], 'data': [], 'variance': [], 'flagged': []}
+    )
+    voxel_figure = plotting.figure(
+        width=800,
+        height=250,
+        title='Voxel',
+        x_axis_label='Time (TR)',
+        x_range=carpet.x_range,
+        tools='pan,box_zoom,reset',
+    )
+    voxel_figure.line('x', 'data', source=voxel_source, line_width=2,
+                      legend_label='scrubbed data')
+    voxel_figure.scatter('x', 'flagged', source=voxel_source, color='red',
+                         size=6, legend_label='flagged')
+    voxel_figure.extra_y_ranges = {'variance': models.DataRange1d()}
+    voxel_figure.add_layout(models.LinearAxis(y_range_name='variance'),
+                            'right')
+    voxel_figure.line('x', 'variance', source=voxel_source, color='orange',
+                      y_range_name='variance', legend_label='variance')
+
+    # Visible carpet range
+    visible = {'x': (0, n_timepoints), 'y': (0, n_voxels)}
+
+    # Update carpet tile
+    def update_carpet():
+        carpet_source.data = review_tile(
+            selected(),
+            time_axis,
+            visible['y'],
+            visible['x']
+        )
+        if data_type.value == 'regressor':
+            color_mapper.palette = palettes.grey(2)[::-1]
+            color_mapper.high = 1
+        else:
+            color_mapper.palette = palettes.Viridis256
+            color_mapper.high = varana.var_threshold
+
+    # Update slice timecourse
+    def update_slice():
+        x, y = decimate_minmax(
+            review_slice(selected(), slice_axis, time_axis, slice_index.value),
+            REVIEW_COLUMNS // 2
+        )
+        slice_source.data = {'x': x - 1, 'y': y}
+        slice_figure.title.text = data_type.value + ' - slice ' + \
+            str(slice_index.value)
+
+    # Update voxel timecourse
+    def update_voxel(row):
+        n = int(iteration.value) - 1
+        flagged = review_rows(varana.regressor[n], time_axis, [row], 0,
+                              n_timepoints)[0]
+        data = np.full(n_timepoints, np.nan)
+        if hasattr(varana, 'data_scrub'):
+            data = review_rows(varana.data_scrub, time_axis, [row], 0,
+                               n_timepoints)[0]
+        voxel_source.data = {
+            'x': np.arange(n_timepoints),
+            'data': data,
+            'variance': review_rows(varana.variance[n], time_axis, [row],
+                                    0, n_timepoints)[0],
+            'flagged': np.where(flagged > 0, data, np.nan),
+        }
+        voxel_figure.title.text = 'Voxel ' + str(
+            tuple(int(c) for c in np.unravel_index(row, spatial))
+        )
+
+    # Zoom & pan
+    def on_ranges(event):
+        visible['x'] = (event.x0, event.x1)
+        visible['y'] = (event.y0, event.y1)
+        update_carpet()
+
+    # Click on the carpet
+    def on_tap(event):
+        row = min(max(int(event.y), 0), n_voxels - 1)
+        update_voxel(row)
+        slice_index.value = int(np.unravel_index(row, spatial)[q_slice])
+
+    # Change of iteration or data
+    def on_select(attr, old, new):
+        update_carpet()
+        update_slice()
+
+    # Wire up
+    carpet.on_event(events.RangesUpdate, on_ranges)
+    carpet.on_event(events.Tap, on_tap)
+    iteration.on_change('value', on_select)
+    data_type.on_change('value', on_select)
+    slice_index.on_change('value', lambda attr, old, new: update_slice())
+
+    # Initial view
+    update_slice()
+    update_voxel(0)
+    doc.add_root(layouts.column(
+        layouts.row(iteration, data_type, slice_index),
+        carpet,
+        slice_figure,
+        voxel_figure
+    ))
+    doc.title = 'tsvarana review'
+
+# ============
+# REVIEW_SERVE
+# ============
+
+
+def review_serve(path, port=REVIEW_PORT, show=True):
+    '''
+    Serve the review document of a saved session, until interrupted
+
+    Inputs
+        path        [string] Session directory, see tsvarana.session
+        port        [scalar] Local port
+        show        [ bool ] Open the review in a browser
+    '''
+
+    # Bokeh server, only needed here
+    from bokeh.application import Application
+    from bokeh.application.handlers.function import FunctionHandler
+    from bokeh.server.server import Server
+
+    # Serve locally
+    server = Server(
+        {'/': Application(FunctionHandler(
+            functools.partial(review_document, path=path)
+        ))},
+        port=port
+    )
+    server.start()
+    print('Reviewing ' + path + ' at http://localhost:' + str(port) + '/')
+
+    # Open browser & serve
+    if show:
+        server.io_loop.add_callback(server.show, '/')
+    server.io_loop.start()
+
+# Done
+#
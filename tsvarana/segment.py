@@ -0,0 +1,463 @@
+# segment.py
+#
+# tsvarana temporal segmentation, for very long runs.
+#
+# Data is read a segment of timepoints at a time, so only one segment is
+# held in memory, and variance, regressors and scrubbed data are written to
+# memory-mapped files as each segment is done. The median each timepoint is
+# compared against is
+#   - sketch    the median of the whole run, assembled exactly from
+#               per-segment histograms of each voxel. Histograms of
+#               segments are merged by adding counts, and each pass narrows
+#               every voxel to the bin holding its middle values, until
+#               they are known
+#   - segment   the median of the segment, read with SEGMENT_OVERLAP of a
+#               segment of context on either side
+#   - window    the rolling median of tsvarana.core.median_rolling, with
+#               segments read with half a window of context on either side,
+#               which gives the same result as the whole run
+#
+# Scrubbing keeps the value before, and the start of, every flagged
+# interval still open at the end of a segment, and fills it once the first
+# valid value after it is read, so intervals crossing segment boundaries
+# are filled as in tsvarana.core.scrub.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+
+# Project dependencies
+from tsvarana.core import median_rolling
+from tsvarana.engine import engine_threshold
+
+# Number of histogram bins per voxel & pass of the median sketch
+SEGMENT_BINS = 16
+
+# Context read on either side of a segment for per-segment medians, as a
+# fraction of the segment length
+SEGMENT_OVERLAP = 0.25
+
+# =========
+# UTILITIES
+# =========
+
+
+def segment_bounds(n_timepoints, length):
+    '''
+    Split a run into consecutive segments
+
+    Inputs
+        n_timepoints [scalar] Number of timepoints
+        length      [scalar] Number of timepoints per segment
+    Outputs
+        bounds      [list  ] (start, stop) of every segment
+    '''
+
+    # Positive lengths only
+    if length < 1:
+        raise TypeError('Error: segment length must be positive.')
+
+    # Return
+    return [
+        (start, min(start + length, n_timepoints))
+        for start in range(0, n_timepoints, length)
+    ]
+
+
+def segment_read(data, time_axis, start, stop):
+    '''
+    Read a range of timepoints, with time along the first axis and all
+    other axes flattened into voxels
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array, or any
+                             array-like that can be sliced, e.g. a
+                             memory map or a nibabel array proxy
+        time_axis   [scalar] Axis along which time is encoded
+        start       [scalar] First timepoint
+        stop        [scalar] Timepoint after the last
+    Outputs
+        block       [array ] (time, voxel) float array
+    '''
+
+    # Slice along time only
+    key = [slice(None)] * len(data.shape)
+    key[time_axis] = slice(start, stop)
+    block = np.asarray(data[tuple(key)], dtype=float)
+
+    # Return
+    return np.reshape(np.moveaxis(block, time_axis, 0), [stop - start, -1])
+
+
+def segment_mean(data, time_axis, length):
+    '''
+    Mean intensity of the whole run, a segment at a time
+
+    Inputs
+        data, time_axis  As in segment_read
+        length      [scalar] Number of timepoints per segment
+    Outputs
+        data_mean   [scalar] Mean voxel intensity
+    '''
+
+    # Sum of every segment
+    total = 0.0
+    for start, stop in segment_bounds(data.shape[time_axis], length):
+        total += segment_read(data, time_axis, start, stop).sum()
+
+    # Return
+    return total / np.prod(data.shape)
+
+# ==============
+# SEGMENT_MEDIAN
+# ==============
+
+
+def segment_median(data, time_axis, length, bins=SEGMENT_BINS):
+    '''
+    Median of every voxel over the whole run, reading a segment at a time.
+    The result is the same as numpy.median along the time axis.
+
+    Each pass counts, for every voxel, the values falling in each of a
+    number of bins spanning the range known to hold its middle values, with
+    the minimum and maximum value of each bin. Counts are added across
+    segments. If both middle values fall in one bin, the range shrinks to
+    that bin for the next pass. Otherwise they are the maximum and minimum
+    of consecutive occupied bins. Voxels drop out once their median is
+    known.
+
+    Inputs
+        data, time_axis  As in segment_read
+        length      [scalar] Number of timepoints per segment
+        bins        [scalar] Number of bins per voxel & pass
+    Outputs
+        median_img  [array ] Median of every voxel, (voxel,)
+        data_mean   [scalar] Mean voxel intensity, from the first pass
+    '''
+
+    # Segments
+    n_timepoints = data.shape[time_axis]
+    segments = segment_bounds(n_timepoints, length)
+
+    # First pass, minimum, maximum & sum of every voxel
+    total = 0.0
+    for start, stop in segments:
+        block = segment_read(data, time_axis, start, stop)
+        if start == 0:
+            lo = block.min(axis=0)
+            hi = block.max(axis=0)
+        else:
+            np.minimum(lo, block.min(axis=0), out=lo)
+            np.maximum(hi, block.max(axis=0), out=hi)
+        total += block.sum()
+    data_mean = total / (n_timepoints * lo.size)
+
+    # Ranks of the middle values, the same for odd numbers of timepoints
+    rank = ((n_timepoints - 1) // 2, n_timepoints // 2)
+
+    # Voxels of a single value are done
+    median_img = lo.copy()
+    below = np.zeros(lo.size, dtype=int)
+    active = np.nonzero(lo < hi)[0]
+
+    # Narrow down until every median is known
+    while active.size:
+
+        # Range of every active voxel
+        lo_a = lo[active]
+        hi_a = hi[active]
+        width = hi_a - lo_a
+
+        # Counts, minima & maxima per voxel & bin
+        counts = np.zeros(active.size * bins, dtype=int)
+        mins = np.full(active.size * bins, np.inf)
+        maxs = np.full(active.size * bins, -np.inf)
+        for start, stop in segments:
+
+            # Values within range
+            block = segment_read(data, time_axis, start, stop)[:, active]
+            inside = (block >= lo_a) & (block <= hi_a)
+            _, voxel = np.nonzero(inside)
+            value = block[inside]
+
+            # Bin of every value, the maximum falls in the last bin
+            key = np.minimum(
+                ((value - lo_a[voxel]) / width[voxel] * bins).astype(int),
+                bins - 1
+            ) + voxel * bins
+
+            # Merge
+            counts += np.bincount(key, minlength=counts.size)
+            np.minimum.at(mins, key, value)
+            np.maximum.at(maxs, key, value)
+
+        # Bins of the middle values
+        counts = counts.reshape(-1, bins)
+        mins = mins.reshape(-1, bins)
+        maxs = maxs.reshape(-1, bins)
+        cumulative = below[active, np.newaxis] + np.cumsum(counts, axis=1)
+        first = np.argmax(cumulative > rank[0], axis=1)
+        second = np.argmax(cumulative > rank[1], axis=1)
+        index = np.arange(active.size)
+
+        # Middle values in different bins, the last value of one and the
+        # first of the next
+        split = first != second
+        median_img[active[split]] = (
+            maxs[index, first] + mins[index, second]
+        )[split] / 2
+
+        # Middle values in the same bin, narrow down to it
+        below[active] = cumulative[index, first] - counts[index, first]
+        lo[active] = mins[index, first]
+        hi[active] = maxs[index, first]
+        median_img[active[~split]] = lo[active[~split]]
+        active = active[~split & (lo[active] < hi[active])]
+
+    # Return
+    return median_img, data_mean
+
+# =================
+# SEGMENT_INTERVALS
+# =================
+
+
+def segment_intervals(block, flags, start, n_timepoints, state=None):
+    '''
+    Find the replacement intervals of tsvarana.core.scrub_intervals one
+    segment at a time. Intervals still open at the end of a segment are
+    returned once the segment holding their end is processed.
+
+    Inputs
+        block       [array ] Segment data, (time, voxel)
+        flags       [array ] Segment regressor, (time, voxel)
+        start       [scalar] First timepoint of the segment
+        n_timepoints [scalar] Number of timepoints of the run
+        state       [dict  ] As returned for the previous segment, None
+                             for the first segment
+    Outputs
+        intervals   [tuple ] (voxel, start, length, fill) arrays of the
+                             intervals ending in this segment. Intervals
+                             spanning the whole run have NaN fill
+        state       [dict  ] Intervals open at the end of the segment
+    '''
+
+    # Segment size
+    n_rows, n_voxels = block.shape
+
+    # Nothing open before the first segment
+    if state is None:
+        state = {
+            'open': np.zeros(n_voxels, dtype=bool),
+            'start': np.zeros(n_voxels, dtype=int),
+            'prev': np.zeros(n_voxels),
+            'has_prev': np.zeros(n_voxels, dtype=bool),
+            'last': np.zeros(n_voxels),
+        }
+
+    # Interval edges, open intervals continue from before the segment
+    edges = np.diff(
+        np.concatenate([
+            state['open'][np.newaxis],
+            flags,
+            np.zeros((1, n_voxels), dtype=bool)
+        ]).astype(np.int8),
+        axis=0
+    ).T
+
+    # Starts within the segment & continued intervals, ordered by voxel
+    # then time, so every start pairs with the following end
+    voxel, row = np.nonzero(edges == 1)
+    continued = np.nonzero(state['open'])[0]
+    voxel = np.concatenate([voxel, continued])
+    row = np.concatenate([row, np.zeros(continued.size, dtype=int)])
+    resumed = np.arange(voxel.size) >= voxel.size - continued.size
+    order = np.lexsort((row, voxel))
+    voxel, row, resumed = voxel[order], row[order], resumed[order]
+    _, end = np.nonzero(edges == -1)
+
+    # Timepoint & value before each interval
+    first = np.where(resumed, state['start'][voxel], start + row)
+    has_prev = np.where(resumed, state['has_prev'][voxel], start + row > 0)
+    prev = np.where(
+        resumed,
+        state['prev'][voxel],
+        np.where(
+            row > 0,
+            block[np.maximum(row - 1, 0), voxel],
+            state['last'][voxel]
+        )
+    )
+
+    # Value after each interval, if it ends within the segment
+    has_post = end < n_rows
+    post = block[np.minimum(end, n_rows - 1), voxel]
+
+    # Intervals ending here, either within the segment or at the end of the
+    # run
+    done = has_post | (start + n_rows == n_timepoints)
+
+    # If both edges are available, average them
+    # If only one is available, take that one
+    fill = np.where(
+        has_prev & has_post,
+        (prev + post) / 2,
+        np.where(has_post, post, prev)
+    ).astype(float)
+    fill[~has_prev & ~has_post] = np.nan
+
+    # Intervals open at the end of the segment
+    still = ~done
+    state = {
+        'open': np.zeros(n_voxels, dtype=bool),
+        'start': np.zeros(n_voxels, dtype=int),
+        'prev': np.zeros(n_voxels),
+        'has_prev': np.zeros(n_voxels, dtype=bool),
+        'last': block[-1].astype(float),
+    }
+    state['open'][voxel[still]] = True
+    state['start'][voxel[still]] = first[still]
+    state['prev'][voxel[still]] = prev[still]
+    state['has_prev'][voxel[still]] = has_prev[still]
+
+    # Return
+    return (
+        voxel[done],
+        first[done],
+        start + end[done] - first[done],
+        fill[done]
+    ), state
+
+
+def segment_apply(data, intervals):
+    '''
+    Apply replacement intervals in place
+
+    Inputs
+        data        [array ] (time, voxel) array, e.g. a memory map
+        intervals   [tuple ] (voxel, start, length, fill) arrays
+    '''
+
+    # Expand intervals into samples
+    voxel, start, length, fill = intervals
+    offset = np.arange(length.sum()) - np.repeat(
+        np.cumsum(length) - length,
+        length
+    )
+
+    # Replace
+    data[np.repeat(start, length) + offset, np.repeat(voxel, length)] = \
+        np.repeat(fill, length)
+
+# =============
+# SEGMENT_SCRUB
+# =============
+
+
+def segment_scrub(data, time_axis, config, summary_axis, variance, regressor,
+                  data_scrub):
+    '''
+    Perform one iteration of variance calculation, threshold test and
+    scrubbing, a segment of timepoints at a time
+
+    Inputs
+        data        [array ] Data of this iteration, as in segment_read
+        time_axis   [scalar] Axis along which time is encoded in data
+        config      [object] tsvarana.pipeline.varana_config, with
+                             config.segment timepoints per segment
+        summary_axis [tuple ] Axes along which to average variance, with
+                             time along the first axis
+        variance    [array ] Output voxelwise variance, with time along the
+                             first axis, e.g. a memory map
+        regressor   [array ] Output voxelwise regressor, as variance
+        data_scrub  [array ] Output scrubbed data, as variance
+    '''
+
+    # Segments
+    n_timepoints = data.shape[time_axis]
+    segments = segment_bounds(n_timepoints, config.segment)
+    shape = variance.shape[1:]
+
+    # Median of the whole run & mean intensity
+    median_img = None
+    if config.window is None and config.segment_median == 'sketch':
+        median_img, data_mean = segment_median(
+            data,
+            time_axis,
+            config.segment
+        )
+    else:
+        data_mean = segment_mean(data, time_axis, config.segment)
+
+    # Context on either side of each segment
+    margin = 0
+    if config.window is not None:
+        margin = config.window // 2
+    elif median_img is None:
+        margin = int(config.segment * SEGMENT_OVERLAP)
+
+    # Loop segments
+    state = None
+    flat = np.reshape(data_scrub, [n_timepoints, -1])
+    for start, stop in segments:
+
+        # Segment & context
+        lo = max(start - margin, 0)
+        hi = min(stop + margin, n_timepoints)
+        chunk = segment_read(data, time_axis, lo, hi)
+        block = chunk[start - lo:stop - lo]
+
+        # Rolling median, segment median or median of the whole run
+        if config.window is not None:
+            median_block = median_rolling(chunk, 0, config.window)
+            median_block = median_block[start - lo:stop - lo]
+        elif median_img is None:
+            median_block = np.median(chunk, axis=0)
+        else:
+            median_block = median_img
+
+        # Squared half difference, normalised by mean voxel intensity
+        vw_variance = block - median_block
+        vw_variance /= 2
+        vw_variance **= 2
+        vw_variance /= data_mean
+
+        # Threshold test
+        vw_variance = np.reshape(vw_variance, (stop - start,) + shape)
+        flags = engine_threshold(
+            config,
+            vw_variance,
+            summary_axis,
+            config.var_threshold
+        )
+
+        # Store
+        variance[start:stop] = vw_variance
+        regressor[start:stop] = flags
+        flat[start:stop] = block
+
+        # Fill intervals ending in this segment, intervals spanning the
+        # whole run take the median timepoint
+        intervals, state = segment_intervals(
+            block,
+            np.reshape(flags, [stop - start, -1]),
+            start,
+            n_timepoints,
+            state
+        )
+        whole = np.isnan(intervals[3])
+        if whole.any():
+            median_run = median_img
+            if median_run is None:
+                median_run = segment_median(data, time_axis, config.segment)[0]
+            intervals[3][whole] = median_run[intervals[0][whole]]
+        segment_apply(flat, intervals)
+
+# Done
+#
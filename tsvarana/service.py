@@ -0,0 +1,315 @@
+# service.py
+#
+# tsvarana watch-folder service.
+#
+# A long-running service that watches an incoming directory for new NIFTI
+# runs, and dispatches them to a pool of worker processes. Workers are
+# started, and their libraries imported, once when the service starts, and
+# keep their data buffers between jobs so runs with the same geometry reuse
+# the same memory. Queue depth and per-job latency are written to a JSON
+# status file in the output directory.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import copy
+import json
+import time
+import numpy as np
+import nibabel as nib
+from concurrent import futures
+
+# Project dependencies
+import tsvarana
+
+# NIFTI file extensions picked up by the service
+SERVICE_EXTENSIONS = ('.nii', '.nii.gz')
+
+# Name of the status file within the output directory
+SERVICE_STATUS = 'service_status.json'
+
+# Number of completed jobs listed in the status file
+SERVICE_HISTORY = 100
+
+# Maximum number of data buffers kept by each worker
+WORKER_BUFFERS = 2
+
+# Data buffers kept by this worker process, keyed by data shape
+_worker_buffers = {}
+
+# ==============
+# WORKER ROUTINE
+# ==============
+
+
+def worker_init():
+    '''
+    Warm up a worker process, by importing and exercising the libraries
+    used by every job before the first job arrives
+    '''
+
+    # Exercise the pipeline on a tiny dataset
+    data = np.random.rand(2, 2, 2, 3)
+    config = tsvarana.pipeline.varana_config(spatial_unit='slice')
+    tsvarana.pipeline.pipeline_detect(data, config)
+
+
+def worker_buffer(shape):
+    '''
+    Return a float data buffer of the given shape, reusing the buffer from
+    a previous job with the same geometry when available
+
+    Inputs
+        shape       [tuple ] Data shape
+    Outputs
+        buffer      [array ] Float data buffer, contents undefined
+    '''
+
+    # Reuse buffer, moving it to the back of the eviction order
+    if shape in _worker_buffers:
+        _worker_buffers[shape] = _worker_buffers.pop(shape)
+        return _worker_buffers[shape]
+
+    # Evict the least recently used buffer
+    if len(_worker_buffers) >= WORKER_BUFFERS:
+        del _worker_buffers[next(iter(_worker_buffers))]
+
+    # New buffer
+    _worker_buffers[shape] = np.empty(shape)
+
+    # Return
+    return _worker_buffers[shape]
+
+
+def worker_load(path):
+    '''
+    Read a NIFTI file into a reused data buffer. The file is read in a
+    single pass, as gzipped files are decompressed from the start on every
+    partial read
+
+    Inputs
+        path        [string] NIFTI file
+    Outputs
+        data        [array ] Float data buffer, holding the data
+        affine      [array ] NIFTI affine
+    '''
+
+    # Read once, converting into the buffer
+    header = nib.load(path)
+    data = worker_buffer(header.shape)
+    data[...] = header.dataobj
+
+    # Return
+    return data, header.affine
+
+
+def worker_job(path, args):
+    '''
+    Process a single NIFTI run in a worker process
+
+    Inputs
+        path        [string] NIFTI file
+        args        [object] As in tsvarana.command.default_routine, with
+                             args.output the output directory
+    Outputs
+        timing      [dict  ] Path, start time, load and compute durations
+    '''
+
+    # Start
+    start = time.time()
+
+    # Read NIFTI data file
+    data, affine = worker_load(path)
+    loaded = time.time()
+
+    # Output basename from the input file name
+    name = os.path.basename(path)
+    for extension in SERVICE_EXTENSIONS[::-1]:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    job_args = copy.copy(args)
+    job_args.data = path
+    job_args.output = os.path.join(args.output, name)
+    if args.session:
+        job_args.session = job_args.output + '_session'
+    if args.checkpoint:
+        job_args.checkpoint = job_args.output + '_checkpoint'
+
+    # Process & save outputs
+    tsvarana.command.process_routine(
+        data,
+        affine,
+        job_args,
+        timing={'load': loaded - start}
+    )
+
+    # Return
+    return {
+        'path': path,
+        'start': start,
+        'load': loaded - start,
+        'compute': time.time() - loaded,
+    }
+
+# ============
+# SERVICE_SCAN
+# ============
+
+
+def service_scan(watch_dir, state):
+    '''
+    Scan the watch directory for NIFTI files that are ready to process.
+    A file is ready once its size and modification time are unchanged
+    between two scans, so runs still being written are skipped.
+
+    Inputs
+        watch_dir   [string] Directory to watch
+        state       [dict  ] Scan state, updated in place
+                             'seen': path -> (size, mtime) on last scan
+                             'done': set of paths already dispatched
+    Outputs
+        ready       [list  ] Paths ready to be dispatched
+        pending     [scalar] Number of files still being written
+    '''
+
+    # Empty list
+    ready = []
+    pending = 0
+
+    # Loop directory entries, in name order
+    for entry in sorted(os.scandir(watch_dir), key=lambda e: e.name):
+
+        # NIFTI files only
+        if not entry.is_file() or not entry.name.endswith(SERVICE_EXTENSIONS):
+            continue
+
+        # Skip files already dispatched
+        if entry.path in state['done']:
+            continue
+
+        # Ready if unchanged since the last scan
+        stat = entry.stat()
+        signature = (stat.st_size, stat.st_mtime)
+        if state['seen'].get(entry.path) == signature:
+            ready.append(entry.path)
+            state['done'].add(entry.path)
+        else:
+            pending += 1
+        state['seen'][entry.path] = signature
+
+    # Return
+    return ready, pending
+
+# ===============
+# SERVICE_ROUTINE
+# ===============
+
+
+def service_routine(args):
+    '''
+    Watch-folder service routine.
+
+    Inputs
+      args.watch          [string] Directory to watch for new NIFTI runs
+      args.workers        [scalar] Number of worker processes
+      args.poll           [scalar] Seconds between directory scans
+      args.once           [ bool ] If True, exit once all runs present in
+                                   the watch directory have been processed
+      args.output         [string] Output directory
+      ...                          Other options as in default_routine
+    '''
+
+    # Output directory
+    os.makedirs(args.output, exist_ok=True)
+    status_file = os.path.join(args.output, SERVICE_STATUS)
+
+    # Scan state, in-flight jobs & completed job history
+    state = {'seen': {}, 'done': set()}
+    in_flight = {}
+    history = []
+    n_failed = 0
+
+    # Start pre-warmed workers
+    executor = futures.ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=worker_init
+    )
+
+    # Workers are started on demand, so start them all up front
+    futures.wait([executor.submit(int) for _ in range(args.workers)])
+
+    # Message
+    print('Watching: ' + args.watch)
+
+    try:
+        while True:
+
+            # Dispatch new runs
+            ready, pending = service_scan(args.watch, state)
+            for path in ready:
+                job = executor.submit(worker_job, path, args)
+                in_flight[job] = (path, time.time())
+
+            # Collect finished jobs
+            done, _ = futures.wait(
+                list(in_flight),
+                timeout=args.poll,
+                return_when=futures.FIRST_COMPLETED
+            )
+            if not in_flight:
+                time.sleep(args.poll)
+
+            # Record latency from dispatch to completion
+            for job in done:
+                path, submitted = in_flight.pop(job)
+                try:
+                    timing = job.result()
+                    timing['latency'] = time.time() - submitted
+                    timing['queued'] = timing['start'] - submitted
+                    history.append(timing)
+                    print('Done: ' + path + ' (' +
+                          '{:.2f}'.format(timing['latency']) + ' s)')
+                except Exception as error:
+                    n_failed += 1
+                    print('Failed: ' + path + ' (' + str(error) + ')')
+            del history[:-SERVICE_HISTORY]
+
+            # Status
+            latency = [timing['latency'] for timing in history]
+            status = {
+                'time': time.time(),
+                'queue_depth': sum(
+                    not job.running() and not job.done() for job in in_flight
+                ),
+                'in_flight': len(in_flight),
+                'pending': pending,
+                'completed': len(state['done']) - len(in_flight) - n_failed,
+                'failed': n_failed,
+                'mean_latency': float(np.mean(latency)) if latency else None,
+                'jobs': history,
+            }
+            with open(status_file + '.tmp', 'w') as fid:
+                json.dump(status, fid, indent=2)
+            os.replace(status_file + '.tmp', status_file)
+
+            # Exit once everything present has been processed
+            if args.once and not in_flight and not pending and not ready:
+                break
+
+    # Stop cleanly on Ctrl+C
+    except KeyboardInterrupt:
+        print('Stopping')
+
+    # Shut down workers
+    finally:
+        executor.shutdown(wait=True)
+
+# Done
+#
@@ -0,0 +1,460 @@
+# session.py
+#
+# tsvarana session files, for reloading results without recomputing.
+#
+# A session is a directory holding one uncompressed .npy file per array,
+# plus a JSON file with the varana settings and the list of array files.
+# Arrays are opened as read-only memory maps, so only the parts that are
+# accessed get read from disk.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import numpy as np
+
+# Session format version
+SESSION_VERSION = 1
+
+# Name of the metadata file within a session directory
+SESSION_META = 'session.json'
+
+# Name of the state file within a checkpoint directory
+CHECKPOINT_META = 'checkpoint.json'
+
+# Prefixes of array files within a checkpoint directory
+CHECKPOINT_ARRAYS = ('variance_', 'regressor_', 'data_', 'intervals_')
+
+# ============
+# SESSION_SAVE
+# ============
+
+
+def session_save(varana, path, affine=None):
+    '''
+    Save varana settings and results to a session directory. The session
+    is written to a new directory, then moved into place, so an existing
+    session is replaced whole, and stays loadable until it is.
+
+    Inputs
+        varana      [object] As created by tsvarana.classes.varana
+        path        [string] Session directory, created if needed
+        affine      [array ] NIFTI affine, for exporting results. The
+                             affine of a loaded session if None
+    '''
+
+    # New directory, next to the session
+    path = os.path.abspath(path)
+    new = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+    os.makedirs(new)
+
+    # Write, removing the new directory if interrupted
+    try:
+        session_write(
+            varana,
+            new,
+            getattr(varana, 'affine', None) if affine is None else affine
+        )
+    except BaseException:
+        shutil.rmtree(new)
+        raise
+
+    # Replace any earlier session, open memory maps of it stay readable
+    if os.path.exists(path):
+        os.rename(path, new + '.old')
+        os.rename(new, path)
+        shutil.rmtree(new + '.old')
+    else:
+        os.rename(new, path)
+
+
+def session_write(varana, path, affine):
+    '''
+    Write varana settings and results to an empty directory, see
+    session_save
+
+    Inputs
+        varana      [object] As created by tsvarana.classes.varana
+        path        [string] Empty directory
+        affine      [array ] NIFTI affine, or None
+    '''
+
+    # Settings
+    meta = {
+        'version': SESSION_VERSION,
+        'spatial_unit': varana.spatial_unit,
+        'slice_axis': int(varana.slice_axis),
+        'time_axis': int(varana.time_axis),
+        'var_threshold': float(varana.var_threshold),
+        'window': getattr(varana, 'window', None),
+        'masked': getattr(varana, 'masked', False),
+        'pyramid': getattr(varana, 'pyramid', 0),
+        'labels': None,
+        'segment': getattr(varana, 'segment', 0),
+        'segment_median': getattr(varana, 'segment_median', 'sketch'),
+        'run_axis': getattr(varana, 'run_axis', None),
+        'summary_axis': [int(i) for i in varana.summary_axis],
+        'n_runs': getattr(varana, 'n_runs', None),
+        'n_iter': None,
+        'variance': [],
+        'regressor': [],
+        'data_scrub': None,
+        'affine': None if affine is None else np.asarray(
+            affine,
+            dtype=float
+        ).tolist(),
+    }
+
+    # Iterations per run, batch mode only
+    if getattr(varana, 'n_iter', None) is not None:
+        meta['n_iter'] = [int(n) for n in varana.n_iter]
+
+    # One file per iteration
+    for data_type in ('variance', 'regressor'):
+        for counter, data in enumerate(getattr(varana, data_type)):
+            filename = data_type + '_' + str(counter + 1).zfill(3) + '.npy'
+            np.save(os.path.join(path, filename), data)
+            meta[data_type].append(filename)
+
+    # Label image, label unit only
+    if getattr(varana, 'labels', None) is not None:
+        meta['labels'] = 'labels.npy'
+        np.save(os.path.join(path, meta['labels']), varana.labels)
+
+    # Scrubbed data, if scrubbing was performed
+    if hasattr(varana, 'data_scrub'):
+        meta['data_scrub'] = 'data_scrub.npy'
+        np.save(os.path.join(path, meta['data_scrub']), varana.data_scrub)
+
+    # Write metadata last, so incomplete sessions cannot be loaded
+    with open(os.path.join(path, SESSION_META), 'w') as fid:
+        json.dump(meta, fid, indent=2)
+
+# ============
+# SESSION_LOAD
+# ============
+
+
+def session_load(varana, path):
+    '''
+    Load varana settings and results from a session directory. Arrays are
+    memory-mapped read-only, and read from disk on access. The NIFTI
+    affine is restored as varana.affine, None if it was not saved.
+
+    Inputs
+        varana      [object] As created by tsvarana.classes.varana
+        path        [string] Session directory
+    '''
+
+    # Read metadata
+    with open(os.path.join(path, SESSION_META), 'r') as fid:
+        meta = json.load(fid)
+
+    # Check version
+    if meta['version'] != SESSION_VERSION:
+        raise TypeError(
+            'Error: unsupported session version ' + str(meta['version'])
+        )
+
+    # Settings
+    varana.spatial_unit = meta['spatial_unit']
+    varana.slice_axis = meta['slice_axis']
+    varana.time_axis = meta['time_axis']
+    varana.var_threshold = meta['var_threshold']
+    varana.window = meta.get('window')
+    varana.masked = meta.get('masked', False)
+    varana.pyramid = meta.get('pyramid', 0)
+    varana.segment = meta.get('segment', 0)
+    varana.segment_median = meta.get('segment_median', 'sketch')
+    varana.labels = None
+    if meta.get('labels') is not None:
+        varana.labels = np.load(os.path.join(path, meta['labels']))
+    varana.affine = None
+    if meta.get('affine') is not None:
+        varana.affine = np.array(meta['affine'])
+    varana.run_axis = meta['run_axis']
+    varana.summary_axis = tuple(meta['summary_axis'])
+    varana.n_runs = meta['n_runs']
+    varana.n_iter = meta['n_iter']
+    if varana.n_iter is not None:
+        varana.n_iter = np.array(varana.n_iter)
+
+    # Memory-mapped results
+    for data_type in ('variance', 'regressor'):
+        setattr(varana, data_type, [
+            np.load(os.path.join(path, filename), mmap_mode='r')
+            for filename in meta[data_type]
+        ])
+
+    # Scrubbed data
+    if meta['data_scrub'] is not None:
+        varana.data_scrub = np.load(
+            os.path.join(path, meta['data_scrub']),
+            mmap_mode='r'
+        )
+    elif hasattr(varana, 'data_scrub'):
+        del varana.data_scrub
+
+# =================
+# CHECKPOINT_CONFIG
+# =================
+
+
+def checkpoint_config(config):
+    '''
+    Settings as stored in a checkpoint, with the label image replaced by a
+    digest of its contents
+
+    Inputs
+        config      [object] tsvarana.pipeline.varana_config
+    Outputs
+        settings    [list  ] JSON-serialisable settings
+    '''
+
+    # Label image digest
+    labels = getattr(config, 'labels', None)
+    if labels is not None:
+        labels = np.ascontiguousarray(labels)
+        config = config._replace(labels=hashlib.sha1(
+            str(labels.shape).encode() + str(labels.dtype).encode() +
+            labels.tobytes()
+        ).hexdigest())
+
+    # Return
+    return list(config)
+
+# ===================
+# CHECKPOINT_IDENTITY
+# ===================
+
+
+def checkpoint_identity(data):
+    '''
+    Identity of the input data of a checkpointed run, a digest of its
+    shape, type and contents. The contents are read one entry of the first
+    axis at a time
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+    Outputs
+        identity    [string] Hexadecimal digest
+    '''
+
+    # Shape & type
+    digest = hashlib.sha1(
+        str(tuple(data.shape)).encode() + str(data.dtype).encode()
+    )
+
+    # Contents
+    for block in data:
+        digest.update(np.ascontiguousarray(block).tobytes())
+
+    # Return
+    return digest.hexdigest()
+
+# ================
+# CHECKPOINT_CLEAR
+# ================
+
+
+def checkpoint_clear(path):
+    '''
+    Remove the state and array files of a checkpoint, so a new run does
+    not pick up files of an earlier one. Other files are kept
+
+    Inputs
+        path        [string] Checkpoint directory
+    '''
+
+    # Nothing to clear
+    if not os.path.isdir(path):
+        return
+
+    # Remove
+    for entry in os.scandir(path):
+        if entry.name == CHECKPOINT_META or (
+                entry.name.startswith(CHECKPOINT_ARRAYS) and
+                entry.name.endswith(('.npy', '.npz'))):
+            os.remove(entry.path)
+
+# ===============
+# CHECKPOINT_SAVE
+# ===============
+
+
+def checkpoint_save(path, config, counter, var_iter, reg_iter, data, active,
+                    n_iter, intervals=None, identity=None):
+    '''
+    Save the state of an iterative scrub after a completed iteration.
+
+    Per-iteration arrays are written for every iteration since the last
+    saved checkpoint, and the scrubbed data is written under a new name
+    for every iteration. The state file is replaced last, so an
+    interrupted save leaves the previous checkpoint intact.
+
+    Inputs
+        path        [string] Checkpoint directory, created if needed
+        config      [object] tsvarana.pipeline.varana_config
+        counter     [scalar] Number of completed iterations
+        var_iter    [list  ] Voxelwise variance, one per iteration
+        reg_iter    [list  ] Voxelwise regressor, one per iteration
+        data        [array ] Scrubbed data after the last iteration
+        active      [array ] Runs still being scrubbed
+        n_iter      [array ] Iterations per run
+        intervals   [tuple ] Replacement intervals of a lazy scrub, see
+                             tsvarana.view.scrubview
+        identity    [string] Input data identity, see checkpoint_identity
+    '''
+
+    # Create directory
+    os.makedirs(path, exist_ok=True)
+
+    # Iterations saved by the last checkpoint
+    meta_file = os.path.join(path, CHECKPOINT_META)
+    saved = 0
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as fid:
+            saved = json.load(fid)['counter']
+
+    # Per-iteration arrays since then
+    for data_type, data_list in (('variance', var_iter),
+                                 ('regressor', reg_iter)):
+        for k in range(saved, counter):
+            np.save(
+                os.path.join(
+                    path,
+                    data_type + '_' + str(k + 1).zfill(3) + '.npy'
+                ),
+                data_list[k]
+            )
+
+    # Scrubbed data for this iteration, saved in memory order so it is
+    # restored with the same layout and reductions round identically
+    data_file = 'data_' + str(counter).zfill(3) + '.npy'
+    axes = [int(i) for i in np.argsort(np.negative(data.strides),
+                                       kind='stable')]
+    np.save(os.path.join(path, data_file), np.transpose(data, axes))
+
+    # Replacement intervals for this iteration
+    if intervals is not None:
+        intervals_file = 'intervals_' + str(counter).zfill(3) + '.npz'
+        np.savez(
+            os.path.join(path, intervals_file),
+            voxel=intervals[0],
+            start=intervals[1],
+            length=intervals[2],
+            fill=intervals[3]
+        )
+
+    # State, replaced atomically
+    meta = {
+        'version': SESSION_VERSION,
+        'config': checkpoint_config(config),
+        'input': identity,
+        'counter': counter,
+        'data': data_file,
+        'axes': axes,
+        'intervals': None if intervals is None else intervals_file,
+        'active': [bool(a) for a in active],
+        'n_iter': [int(n) for n in n_iter],
+    }
+    with open(meta_file + '.tmp', 'w') as fid:
+        json.dump(meta, fid, indent=2)
+    os.replace(meta_file + '.tmp', meta_file)
+
+    # Scrubbed data from earlier iterations is no longer needed
+    for entry in os.scandir(path):
+        if entry.name.startswith(('data_', 'intervals_')) and \
+                entry.name not in (data_file, meta['intervals']):
+            os.remove(entry.path)
+
+# ===============
+# CHECKPOINT_LOAD
+# ===============
+
+
+def checkpoint_load(path, config, identity=None):
+    '''
+    Load the state of an iterative scrub from a checkpoint directory.
+
+    Inputs
+        path        [string] Checkpoint directory
+        config      [object] tsvarana.pipeline.varana_config, which must
+                             match the checkpointed settings
+        identity    [string] Input data identity, which must match the
+                             checkpointed input, see checkpoint_identity
+    Outputs
+        state       [tuple ] counter, var_iter, reg_iter, data, active,
+                             n_iter and intervals as passed to
+                             checkpoint_save, or None if there is no
+                             checkpoint
+    '''
+
+    # No checkpoint yet
+    meta_file = os.path.join(path, CHECKPOINT_META)
+    if not os.path.exists(meta_file):
+        return None
+
+    # Read state
+    with open(meta_file, 'r') as fid:
+        meta = json.load(fid)
+
+    # Settings must match
+    if meta['config'] != checkpoint_config(config):
+        raise TypeError(
+            'Error: checkpoint settings do not match, ' + str(meta['config'])
+        )
+
+    # Input data must match
+    if meta.get('input') != identity:
+        raise TypeError('Error: checkpoint input data does not match.')
+
+    # Completed iterations, memory-mapped
+    counter = meta['counter']
+    var_iter, reg_iter = [
+        [
+            np.load(
+                os.path.join(path, data_type + '_' + str(k + 1).zfill(3) +
+                             '.npy'),
+                mmap_mode='r'
+            )
+            for k in range(counter)
+        ]
+        for data_type in ('variance', 'regressor')
+    ]
+
+    # Scrubbed data, in memory as it is updated in place, with its
+    # original axis order
+    data = np.load(os.path.join(path, meta['data']))
+    data = np.transpose(data, np.argsort(meta['axes']))
+
+    # Replacement intervals
+    intervals = None
+    if meta['intervals'] is not None:
+        with np.load(os.path.join(path, meta['intervals'])) as npz:
+            intervals = tuple(
+                npz[name] for name in ('voxel', 'start', 'length', 'fill')
+            )
+
+    # Return
+    return (
+        counter,
+        var_iter,
+        reg_iter,
+        data,
+        np.array(meta['active'], dtype=bool),
+        np.array(meta['n_iter'], dtype=int),
+        intervals,
+    )
+
+# Done
+#
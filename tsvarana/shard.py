@@ -0,0 +1,551 @@
+# shard.py
+#
+# tsvarana shard-and-merge processing, for splitting a single run across
+# many independent tasks of an HPC job array.
+#
+# The spatial domain is split into slabs along the slice axis, so every
+# slice lies entirely within one shard. Shards only exchange small global
+# quantities, via the shard directory:
+#   - the mean intensity of the data, used for normalisation
+#   - for the volume unit, per-timepoint sums of variance across the slab
+#
+# Processing runs in rounds. Each round is one array job, where every shard
+# thresholds and scrubs the previous iteration and computes the variance of
+# the next one, followed by one merge. Iteration k is thresholded in round
+# k + 1, once the merge of round k has made its global quantities available.
+# Scrubbing has converged when the merge finds no timepoints flagged by any
+# shard, and the final merge writes the outputs of default_routine.
+#
+# Typical workflow
+#   python -m tsvarana --data <nifti> --shard_manifest <dir> --shards <int>
+#   repeat until the merge reports convergence
+#       python -m tsvarana --shard_run <dir> --shard_index <int>  (array job)
+#       python -m tsvarana --shard_merge <dir> --output <basename>
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import copy
+import json
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+
+# Project dependencies
+import tsvarana
+from tsvarana.core import (
+    variance_calc,
+    threshold_test,
+    scrub
+)
+from tsvarana.utils import parse_spatial_unit
+
+# Name of the manifest & state files within a shard directory
+SHARD_MANIFEST = 'manifest.json'
+SHARD_STATE = 'state.json'
+
+# =========
+# UTILITIES
+# =========
+
+
+def shard_read(shard_dir):
+    '''
+    Read shard manifest and processing state
+
+    Inputs
+        shard_dir   [string] Shard directory
+    Outputs
+        manifest    [dict  ] Input file, settings & slab ranges
+        state       [dict  ] Current round & merged global quantities
+    '''
+
+    # Manifest
+    with open(os.path.join(shard_dir, SHARD_MANIFEST), 'r') as fid:
+        manifest = json.load(fid)
+
+    # State
+    with open(os.path.join(shard_dir, SHARD_STATE), 'r') as fid:
+        state = json.load(fid)
+
+    # Return
+    return manifest, state
+
+
+def shard_write(path, content):
+    '''
+    Write a JSON file atomically, so concurrent readers never see a
+    partially written file
+
+    Inputs
+        path        [string] JSON file
+        content     [dict  ] File content
+    '''
+
+    # Write to a temporary file, then move into place
+    with open(path + '.tmp', 'w') as fid:
+        json.dump(content, fid, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def shard_path(shard_dir, index, name, counter=None):
+    '''
+    Path of a file belonging to one shard
+
+    Inputs
+        shard_dir   [string] Shard directory
+        index       [scalar] Shard index
+        name        [string] File name, without extension
+        counter     [scalar] If specified, iteration number
+    Outputs
+        path        [string] File path
+    '''
+
+    # File name
+    if counter is not None:
+        name = name + '_' + str(counter).zfill(3)
+
+    # Return
+    return os.path.join(
+        shard_dir,
+        'shard_' + str(index).zfill(3),
+        name
+    )
+
+
+def shard_slicer(manifest, index):
+    '''
+    Index selecting one shard's slab along the slice axis
+
+    Inputs
+        manifest    [dict  ] Shard manifest
+        index       [scalar] Shard index
+    Outputs
+        slicer      [tuple ] Index into the full data array
+    '''
+
+    # Select slab along the slice axis only
+    slicer = [slice(None)] * len(manifest['shape'])
+    slicer[manifest['slice_axis']] = slice(*manifest['slabs'][index])
+
+    # Return
+    return tuple(slicer)
+
+# ==============
+# SHARD_MANIFEST
+# ==============
+
+
+def shard_manifest(args):
+    '''
+    Write a shard manifest, splitting the spatial domain of a run into slabs
+    along the slice axis.
+
+    Inputs
+      args.data           [string] A 4D NIFTI file
+      args.shard_manifest [string] Shard directory, created if needed
+      args.shards         [scalar] Number of shards
+      ...                          Settings as in default_routine
+    '''
+
+    # Read NIFTI header only
+    header = nib.load(args.data)
+    shape = header.shape
+
+    # Shards scrub every iteration
+    if args.masked:
+        raise TypeError(
+            'Error: sharded processing does not support masked mode.'
+        )
+
+    # Labels may span several shards
+    if args.spatial_unit == 'label':
+        raise TypeError(
+            'Error: sharded processing does not support the label unit.'
+        )
+
+    # The time axis cannot be split
+    if args.slice_axis == args.time_axis:
+        raise TypeError('Error: slice axis and time axis must differ.')
+
+    # Slabs along the slice axis, no more shards than slices
+    n_slices = shape[args.slice_axis]
+    edges = np.linspace(0, n_slices, min(args.shards, n_slices) + 1)
+    edges = edges.astype(int)
+    slabs = [[int(a), int(b)] for a, b in zip(edges[:-1], edges[1:])]
+
+    # Manifest
+    manifest = {
+        'data': os.path.abspath(args.data),
+        'shape': [int(n) for n in shape],
+        'affine': header.affine.tolist(),
+        'spatial_unit': args.spatial_unit,
+        'slice_axis': args.slice_axis,
+        'time_axis': args.time_axis,
+        'var_threshold': args.var_threshold,
+        'window': args.window,
+        'one_shot': args.one_shot,
+        'slabs': slabs,
+    }
+
+    # Initial state
+    state = {
+        'round': 0,
+        'converged': False,
+        'mean': [],
+        'flags': [],
+        'n_flagged': [],
+    }
+
+    # Write
+    for index in range(len(slabs)):
+        os.makedirs(
+            os.path.join(args.shard_manifest, 'shard_' + str(index).zfill(3)),
+            exist_ok=True
+        )
+    shard_write(os.path.join(args.shard_manifest, SHARD_MANIFEST), manifest)
+    shard_write(os.path.join(args.shard_manifest, SHARD_STATE), state)
+
+    # Message
+    print('Shards: ' + str(len(slabs)))
+
+# =========
+# SHARD_RUN
+# =========
+
+
+def shard_run(args):
+    '''
+    Process one shard for the current round.
+
+    Inputs
+      args.shard_run      [string] Shard directory
+      args.shard_index    [scalar] Shard index
+    '''
+
+    # Read manifest & state
+    manifest, state = shard_read(args.shard_run)
+    index = args.shard_index
+    counter = state['round']
+    time_axis = manifest['time_axis']
+
+    # Nothing left to do
+    if state['converged']:
+        print('Shards have converged')
+        return
+
+    # First round, read this shard's slab from the NIFTI file
+    if counter == 0:
+        header = nib.load(manifest['data'])
+        data = np.asarray(
+            header.dataobj[shard_slicer(manifest, index)],
+            dtype=float
+        )
+        n_flagged = None
+
+    # Later rounds, threshold & scrub the previous iteration
+    else:
+        data = np.load(
+            shard_path(args.shard_run, index, 'data', counter - 1) + '.npy'
+        )
+        raw = np.load(
+            shard_path(args.shard_run, index, 'variance', counter - 1) +
+            '.npy'
+        )
+
+        # Threshold test on normalised variance
+        if manifest['spatial_unit'] == 'volume':
+            # Merged per-timepoint flags, broadcast across the slab
+            flags = np.array(state['flags'][counter - 1], dtype=bool)
+            shape = [1] * data.ndim
+            shape[time_axis] = flags.size
+            regressor = np.broadcast_to(flags.reshape(shape), data.shape)
+        else:
+            # Slices lie within a single shard
+            summary_axis = parse_spatial_unit(
+                manifest['spatial_unit'],
+                data.ndim,
+                manifest['slice_axis'],
+                time_axis
+            )
+            regressor = threshold_test(
+                raw / state['mean'][counter - 1],
+                summary_axis,
+                manifest['var_threshold']
+            )
+
+        # Scrubbing
+        data = scrub(data, regressor, time_axis)
+        n_flagged = int(regressor.sum())
+        np.save(
+            shard_path(args.shard_run, index, 'regressor', counter - 1) +
+            '.npy',
+            regressor
+        )
+
+    # Unnormalised variance for this iteration, unless scrubbing is over
+    var_sum = None
+    if not (manifest['one_shot'] and counter > 0):
+        raw = variance_calc(
+            data,
+            time_axis,
+            data_mean=1,
+            window=manifest['window']
+        )
+        np.save(
+            shard_path(args.shard_run, index, 'variance', counter) + '.npy',
+            raw
+        )
+
+        # Per-timepoint partial sums for the volume unit
+        if manifest['spatial_unit'] == 'volume':
+            axes = tuple(i for i in range(raw.ndim) if i != time_axis)
+            var_sum = raw.sum(axis=axes).tolist()
+
+    # Data for this iteration
+    np.save(shard_path(args.shard_run, index, 'data', counter) + '.npy', data)
+
+    # Data from two rounds ago is no longer needed, the previous round is
+    # kept so this task can be re-run
+    if counter >= 2:
+        old = shard_path(args.shard_run, index, 'data', counter - 2) + '.npy'
+        if os.path.exists(old):
+            os.remove(old)
+
+    # Partial sums for the merge
+    stats = shard_path(args.shard_run, index, 'stats', counter) + '.json'
+    shard_write(stats, {
+        'sum': float(data.sum()),
+        'count': int(data.size),
+        'var_sum': var_sum,
+        'n_flagged': n_flagged,
+    })
+
+# ===========
+# SHARD_MERGE
+# ===========
+
+
+def shard_merge(args):
+    '''
+    Merge all shards for the current round. If scrubbing has converged,
+    write the outputs of default_routine, otherwise advance to the next
+    round.
+
+    Inputs
+      args.shard_merge    [string] Shard directory
+      args.output         [string] Basename for output files
+      args.max_size       [scalar] Maximum number of data values embedded
+                                   in the HTML report
+    '''
+
+    # Read manifest & state
+    manifest, state = shard_read(args.shard_merge)
+    counter = state['round']
+    n_shards = len(manifest['slabs'])
+
+    # Nothing left to do
+    if state['converged']:
+        print('Shards have converged')
+        return
+
+    # Read partial sums from every shard
+    stats = []
+    for index in range(n_shards):
+        path = shard_path(args.shard_merge, index, 'stats', counter) + '.json'
+        if not os.path.exists(path):
+            raise TypeError(
+                'Error: shard ' + str(index) + ' has not finished round ' +
+                str(counter) + '.'
+            )
+        with open(path, 'r') as fid:
+            stats.append(json.load(fid))
+
+    # Number of timepoints flagged in the previous iteration
+    if counter > 0:
+        n_flagged = sum(s['n_flagged'] for s in stats)
+        state['n_flagged'].append(n_flagged)
+        print('Iteration: ' + str(counter))
+        print('Bad timepoints: ' + str(n_flagged))
+
+    # Converged once an iteration flags nothing, or after one shot
+    if counter > 0 and (n_flagged == 0 or manifest['one_shot']):
+        state['converged'] = True
+        shard_write(os.path.join(args.shard_merge, SHARD_STATE), state)
+        shard_output(args, manifest, state)
+        return
+
+    # Global mean intensity
+    mean = sum(s['sum'] for s in stats) / sum(s['count'] for s in stats)
+    state['mean'].append(mean)
+
+    # Per-timepoint flags for the volume unit, from the mean normalised
+    # variance across all voxels
+    if manifest['spatial_unit'] == 'volume':
+        n_voxels = np.prod(manifest['shape']) // \
+            manifest['shape'][manifest['time_axis']]
+        var_sum = np.sum([s['var_sum'] for s in stats], axis=0)
+        flags = var_sum / n_voxels / mean > manifest['var_threshold']
+        state['flags'].append(flags.tolist())
+    else:
+        state['flags'].append(None)
+
+    # Advance
+    state['round'] = counter + 1
+    shard_write(os.path.join(args.shard_merge, SHARD_STATE), state)
+
+    # Message
+    print('Round ' + str(counter) + ' merged, run round ' +
+          str(counter + 1) + ' next')
+
+# ============
+# SHARD_OUTPUT
+# ============
+
+
+def shard_output(args, manifest, state):
+    '''
+    Assemble shards into a session directory, then write the outputs of
+    default_routine from it. Arrays are assembled slab by slab into
+    memory-mapped files, so the full data is never held in memory.
+
+    Inputs
+      args                [object] As in shard_merge
+      manifest            [dict  ] Shard manifest
+      state               [dict  ] Converged shard state
+    '''
+
+    # Session directory inside the shard directory
+    session = os.path.join(args.shard_merge, 'session')
+    os.makedirs(session, exist_ok=True)
+    shape = tuple(manifest['shape'])
+    n_iter = state['round']
+
+    # Assemble memory-mapped array from one file per shard
+    def assemble(filename, name, counter, dtype, scale=1):
+        target = np.lib.format.open_memmap(
+            os.path.join(session, filename),
+            mode='w+',
+            dtype=dtype,
+            shape=shape
+        )
+        for index in range(len(manifest['slabs'])):
+            source = np.load(
+                shard_path(args.shard_merge, index, name, counter) + '.npy',
+                mmap_mode='r'
+            )
+            if scale != 1:
+                source = source / scale
+            target[shard_slicer(manifest, index)] = source
+        target.flush()
+        return filename
+
+    # Session metadata, as written by tsvarana.session
+    summary_axis = parse_spatial_unit(
+        manifest['spatial_unit'],
+        len(shape),
+        manifest['slice_axis'],
+        manifest['time_axis']
+    )
+    meta = {
+        'version': tsvarana.session.SESSION_VERSION,
+        'spatial_unit': manifest['spatial_unit'],
+        'slice_axis': manifest['slice_axis'],
+        'time_axis': manifest['time_axis'],
+        'var_threshold': manifest['var_threshold'],
+        'window': manifest['window'],
+        'run_axis': None,
+        'summary_axis': [int(i) for i in summary_axis],
+        'n_runs': None,
+        'n_iter': None,
+        'variance': [
+            assemble(
+                'variance_' + str(k + 1).zfill(3) + '.npy',
+                'variance', k, float, scale=state['mean'][k]
+            )
+            for k in range(n_iter)
+        ],
+        'regressor': [
+            assemble(
+                'regressor_' + str(k + 1).zfill(3) + '.npy',
+                'regressor', k, bool
+            )
+            for k in range(n_iter)
+        ],
+        'data_scrub': assemble('data_scrub.npy', 'data', n_iter, float),
+        'affine': manifest['affine'],
+    }
+    shard_write(os.path.join(session, tsvarana.session.SESSION_META), meta)
+
+    # Load assembled session & write outputs
+    varana = tsvarana.classes.varana()
+    varana.load(session)
+    tsvarana.command.output_routine(
+        varana,
+        np.array(manifest['affine']),
+        args
+    )
+
+    # Message
+    print('Shards merged into ' + args.output)
+
+# ===========
+# SHARD_LOCAL
+# ===========
+
+
+def shard_local(args):
+    '''
+    Run shard-and-merge processing within this process, one shard at a
+    time, so only one slab is held in memory. Shards are kept in a
+    temporary directory next to the outputs, removed once done.
+
+    Inputs
+      args.shards         [scalar] Number of shards
+      ...                          As in default_routine
+    '''
+
+    # Temporary shard directory
+    shard_dir = tempfile.mkdtemp(
+        prefix='tsvarana_shards_',
+        dir=os.path.dirname(os.path.abspath(args.output))
+    )
+
+    # Every step reads & writes the same shard directory
+    local = copy.copy(args)
+    local.shard_manifest = shard_dir
+    local.shard_run = shard_dir
+    local.shard_merge = shard_dir
+
+    try:
+
+        # Write manifest
+        shard_manifest(local)
+
+        # Run rounds until converged
+        while True:
+            manifest, state = shard_read(shard_dir)
+            if state['converged']:
+                break
+            for index in range(len(manifest['slabs'])):
+                local.shard_index = index
+                shard_run(local)
+            shard_merge(local)
+
+        # Keep the assembled session
+        if args.session:
+            shutil.move(os.path.join(shard_dir, 'session'), args.session)
+
+    # Clean up
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+# Done
+#
@@ -0,0 +1,134 @@
+# test_aio.py
+#
+# test tsvarana asyncio interface.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import asyncio
+import argparse
+import threading
+import numpy as np
+import nibabel as nib
+import pytest
+from concurrent import futures
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions
+data = np.random.rand(10, 9, 4, 57) + 5
+data[:, :, 1:3, 18:23] += 3
+
+
+# Test jobs stream progress events and match blocking scrubbing
+def test_aio_scrub(tmp_path):
+    infile = str(tmp_path / 'data.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), infile)
+    expected = tsvarana.classes.varana('slice', var_threshold=0.05)
+    expected.scrub_iterative(data)
+
+    async def main():
+        async with tsvarana.aio.aio_runner() as runner:
+            job = await runner.submit(infile, expected)
+            events = [event async for event in job]
+            varana = tsvarana.classes.varana('slice', var_threshold=0.05)
+            await runner.scrub(varana, data)
+            return events, await job.result(), varana
+
+    events, result, varana = asyncio.run(main())
+    assert [event.stage for event in events] == \
+        ['load', 'compute'] + ['iteration'] * len(expected.regressor) + \
+        ['done']
+    assert events[-2].n_flagged == 0
+    assert np.array_equal(result.data_scrub, expected.data_scrub)
+    assert np.array_equal(varana.data_scrub, expected.data_scrub)
+
+
+# Test submitting waits for a free slot
+def test_aio_backpressure():
+
+    async def main():
+        async with tsvarana.aio.aio_runner(max_jobs=1) as runner:
+            first = await runner.submit(data, tsvarana.pipeline.varana_config(
+                var_threshold=0.05
+            ))
+            second = asyncio.ensure_future(runner.submit(
+                data,
+                tsvarana.pipeline.varana_config(var_threshold=0.05)
+            ))
+            await asyncio.sleep(0)
+            assert not second.done()
+            await first.result()
+            await (await second).result()
+
+    asyncio.run(main())
+
+
+# Test cancelled jobs stop after the current iteration
+def test_aio_cancel():
+    started = threading.Event()
+    gate = threading.Event()
+
+    # Engine holding its first iteration until released
+    def variance_gated(*args, **kwargs):
+        started.set()
+        gate.wait()
+        return tsvarana.core.variance_calc(*args, **kwargs)
+    tsvarana.engine.engine_register('gated', variance_calc=variance_gated)
+
+    async def main():
+        async with tsvarana.aio.aio_runner() as runner:
+            job = await runner.submit(data, tsvarana.pipeline.varana_config(
+                var_threshold=0.05,
+                engine='gated'
+            ))
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                started.wait
+            )
+            job.cancel()
+            gate.set()
+            with pytest.raises(asyncio.CancelledError):
+                await job.result()
+            return [event.stage async for event in job]
+
+    assert asyncio.run(main()) == ['compute', 'iteration', 'cancelled']
+    del tsvarana.engine.ENGINES['gated']
+
+
+# Test routine jobs save outputs, from a process pool
+def test_aio_routine(tmp_path):
+    infile = str(tmp_path / 'data.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), infile)
+    args = argparse.Namespace(
+        data=infile, spatial_unit='slice', labels=None, segment=0,
+        segment_median='sketch', slice_axis=2, time_axis=3,
+        var_threshold=0.05, one_shot=False, output=str(tmp_path / 'out'),
+        max_size=10000, session=None, cache=None, cache_size=1,
+        checkpoint=None, resume=False, lazy=False, window=None,
+        masked=False, pyramid=0, triage=False, engine='reference',
+        verify=0, index=None, max_memory=None, dry_run=False
+    )
+
+    async def main():
+        executor = futures.ProcessPoolExecutor(max_workers=1)
+        with executor:
+            async with tsvarana.aio.aio_runner(executor) as runner:
+                return await runner.routine(args)
+
+    varana = asyncio.run(main())
+    scrubbed = nib.load(str(tmp_path / 'out_scrubbed.nii.gz')).get_fdata()
+    assert np.allclose(scrubbed, varana.data_scrub)
+
+# Done
+#
@@ -0,0 +1,79 @@
+# test_batch.py
+#
+# test tsvarana batch processing of multiple runs.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate three dummy runs with (x,y,z,t) dimensions
+runs = [np.random.rand(6, 6, 5, 40) for _ in range(3)]
+
+# Add an artefact to a single slice of the second run
+runs[1][:, :, 2, 7] += 5
+
+
+# Test batch scrubbing matches scrubbing each run separately
+def test_batch_matches_single():
+
+    # Batch of runs, passed as a list
+    batch = tsvarana.classes.varana(spatial_unit='slice', var_threshold=0.3)
+    batch.scrub_iterative(runs)
+
+    # Loop runs
+    for data, run in zip(runs, batch.get_runs()):
+
+        # Process run on its own
+        single = tsvarana.classes.varana(
+            spatial_unit='slice',
+            var_threshold=0.3
+        )
+        single.scrub_iterative(data)
+
+        # Same number of iterations
+        assert len(run.variance) == len(single.variance)
+
+        # Same outputs
+        for a, b in zip(run.variance, single.variance):
+            assert np.allclose(a, b)
+        for a, b in zip(run.regressor, single.regressor):
+            assert np.array_equal(a, b)
+        assert np.allclose(run.data_scrub, single.data_scrub)
+
+
+# Test stacked batch with a trailing run axis
+def test_batch_run_axis():
+
+    # Stack runs along the last axis
+    data = np.stack(runs, axis=-1)
+
+    # Run scrubbing
+    batch = tsvarana.classes.varana(
+        spatial_unit='volume',
+        var_threshold=0.3,
+        run_axis=4
+    )
+    batch.scrub_iterative(data)
+
+    # Outputs are stacked with runs along the first axis
+    assert batch.data_scrub.shape == (3, 6, 6, 5, 40)
+    assert batch.variance[0].shape == (3, 6, 6, 5, 40)
+
+    # One iteration count per run
+    assert batch.n_iter.shape == (3,)
+
+# Done
+#
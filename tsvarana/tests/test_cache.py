@@ -0,0 +1,71 @@
+# test_cache.py
+#
+# test tsvarana input cache.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import numpy as np
+import nibabel as nib
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions
+data = np.random.rand(6, 7, 5, 20)
+
+
+# Test cached data matches the NIFTI file
+def test_cache_load(tmp_path):
+
+    # Save data
+    infile = str(tmp_path / 'data.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), infile)
+    cache_dir = str(tmp_path / 'cache')
+
+    # First load fills the cache, second load reads from it
+    for _ in range(2):
+        cached, header = tsvarana.cache.cache_load(infile, 3, cache_dir)
+        assert cached.shape == data.shape
+        assert np.array_equal(cached, header.get_fdata())
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Cache entries are time-major
+    entry = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    assert np.load(entry, mmap_mode='r').shape == (20, 6, 7, 5)
+
+
+# Test least recently used entries are evicted
+def test_cache_evict(tmp_path):
+
+    # Save two inputs
+    cache_dir = str(tmp_path / 'cache')
+    for name in ('a.nii', 'b.nii'):
+        nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path / name))
+
+    # Cache only has room for one entry
+    for name in ('a.nii', 'b.nii'):
+        tsvarana.cache.cache_load(
+            str(tmp_path / name),
+            3,
+            cache_dir,
+            max_size=data.nbytes * 1.5
+        )
+
+    # Only the most recent entry is kept
+    assert os.listdir(cache_dir) == [
+        tsvarana.cache.cache_key(str(tmp_path / 'b.nii'), 3) + '.npy'
+    ]
+
+# Done
+#
@@ -0,0 +1,100 @@
+# test_checkpoint.py
+#
+# test tsvarana checkpointing of iterative scrubbing.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import numpy as np
+import pytest
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with artefacts
+data = np.random.rand(8, 8, 6, 60)
+data[:, :, 3, 10] += 2
+data[:, :, :, 30] += 1.5
+
+
+# Test resuming an interrupted scrub gives identical results
+def test_checkpoint_resume(tmp_path, monkeypatch):
+
+    # Uninterrupted run
+    varana = tsvarana.classes.varana(spatial_unit='volume', var_threshold=0.3)
+    varana.scrub_iterative(data)
+    assert len(varana.variance) > 1
+
+    # Interrupt after the first checkpoint
+    checkpoint_save = tsvarana.pipeline.checkpoint_save
+
+    def preempt(*args, **kwargs):
+        checkpoint_save(*args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(tsvarana.pipeline, 'checkpoint_save', preempt)
+    interrupted = tsvarana.classes.varana(
+        spatial_unit='volume',
+        var_threshold=0.3
+    )
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.scrub_iterative(data, checkpoint=str(tmp_path))
+    monkeypatch.undo()
+
+    # Resume
+    interrupted.scrub_iterative(data, checkpoint=str(tmp_path), resume=True)
+
+    # Identical results
+    assert len(interrupted.variance) == len(varana.variance)
+    for a, b in zip(interrupted.variance, varana.variance):
+        assert np.array_equal(a, b)
+    for a, b in zip(interrupted.regressor, varana.regressor):
+        assert np.array_equal(a, b)
+    assert np.array_equal(interrupted.data_scrub, varana.data_scrub)
+
+
+# Test checkpoints with different settings are rejected
+def test_checkpoint_settings(tmp_path):
+
+    # Checkpointed run
+    varana = tsvarana.classes.varana(spatial_unit='volume', var_threshold=0.3)
+    varana.scrub_iterative(data, checkpoint=str(tmp_path))
+
+    # Resume with another threshold
+    varana.var_threshold = 0.5
+    with pytest.raises(TypeError):
+        varana.scrub_iterative(data, checkpoint=str(tmp_path), resume=True)
+
+
+# Test reused directories hold no files of earlier runs, and checkpoints
+# of other input data are rejected
+def test_checkpoint_input(tmp_path):
+
+    # Checkpointed run, then a run of other data needing fewer iterations
+    varana = tsvarana.classes.varana(spatial_unit='volume', var_threshold=0.3)
+    varana.scrub_iterative(data, checkpoint=str(tmp_path))
+    clean = np.random.rand(8, 8, 6, 60)
+    varana.scrub_iterative(clean, checkpoint=str(tmp_path))
+    assert len(varana.variance) < 3
+    assert sorted(
+        name for name in os.listdir(str(tmp_path))
+        if name.startswith('variance_')
+    ) == ['variance_' + str(k + 1).zfill(3) + '.npy'
+          for k in range(len(varana.variance))]
+
+    # Resume with the earlier data
+    with pytest.raises(TypeError):
+        varana.scrub_iterative(data, checkpoint=str(tmp_path), resume=True)
+
+# Done
+#
@@ -0,0 +1,147 @@
+# test_engine.py
+#
+# test tsvarana engines against the reference engine.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import pytest
+import numpy as np
+from hypothesis import given, settings, strategies as st
+from hypothesis.extra import numpy as hnp
+
+# Project dependencies
+import tsvarana
+
+# ==========
+# STRATEGIES
+# ==========
+
+
+@st.composite
+def runs(draw):
+    '''
+    Random data with 2 to 4 dimensions, a random time axis, and a random
+    regressor of flagged timepoints, including fully flagged timecourses
+    '''
+
+    # Shape & time axis
+    shape = draw(hnp.array_shapes(min_dims=2, max_dims=4, max_side=7))
+    time_axis = draw(st.integers(0, len(shape) - 1))
+
+    # Positive data
+    data = draw(hnp.arrays(
+        float,
+        shape,
+        elements=st.floats(0.1, 100, allow_nan=False)
+    ))
+
+    # Flag pattern
+    regressor = draw(hnp.arrays(bool, shape))
+
+    # Return
+    return data, time_axis, regressor
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with artefacts
+data = np.random.rand(6, 6, 5, 40)
+data[:, :, 2, 10] += 2
+data[:, :, :, 25] += 1.5
+
+
+# Test vectorized variance matches the reference
+@settings(max_examples=50, deadline=None)
+@given(runs())
+def test_variance_property(run):
+    data, time_axis, _ = run
+    engine = tsvarana.engine.engine_get('vectorized')
+    assert np.allclose(
+        engine.variance_calc(data, time_axis),
+        tsvarana.core.variance_calc(data, time_axis),
+        rtol=tsvarana.engine.ENGINE_RTOL,
+        atol=tsvarana.engine.ENGINE_ATOL
+    )
+
+
+# Test vectorized threshold test matches the reference, for every
+# combination of summary axes
+@settings(max_examples=50, deadline=None)
+@given(runs(), st.data())
+def test_threshold_property(run, draw):
+    data, time_axis, _ = run
+    summary_axis = tuple(draw.draw(st.sets(
+        st.integers(0, data.ndim - 1).filter(lambda i: i != time_axis)
+    )))
+    engine = tsvarana.engine.engine_get('vectorized')
+    assert np.array_equal(
+        engine.threshold_test(data, summary_axis, 50),
+        tsvarana.core.threshold_test(data, summary_axis, 50)
+    )
+
+
+# Test vectorized scrubbing matches the reference, including windows at
+# the edges of the run
+@settings(max_examples=50, deadline=None)
+@given(runs())
+def test_scrub_property(run):
+    data, time_axis, regressor = run
+    engine = tsvarana.engine.engine_get('vectorized')
+    assert np.array_equal(
+        engine.scrub(data, regressor, time_axis),
+        tsvarana.core.scrub(data, regressor, time_axis)
+    )
+
+
+# Test verified vectorized scrubbing matches the reference engine
+def test_engine_pipeline():
+    for spatial_unit in ('voxel', 'slice', 'volume'):
+        reference = tsvarana.classes.varana(spatial_unit, var_threshold=0.3)
+        reference.scrub_iterative(data)
+        vectorized = tsvarana.classes.varana(
+            spatial_unit,
+            var_threshold=0.3,
+            engine='vectorized',
+            verify=20
+        )
+        vectorized.scrub_iterative(data)
+        assert len(vectorized.regressor) == len(reference.regressor)
+        for a, b in zip(vectorized.regressor, reference.regressor):
+            assert np.array_equal(a, b)
+        assert np.allclose(vectorized.data_scrub, reference.data_scrub)
+
+
+# Test verification catches an engine that differs from the reference
+def test_engine_verify():
+    tsvarana.engine.engine_register(
+        'broken',
+        scrub=lambda data, regressor, time_axis: data.copy()
+    )
+    varana = tsvarana.classes.varana(
+        var_threshold=0.3,
+        engine='broken',
+        verify=data.size
+    )
+    with pytest.raises(TypeError):
+        varana.scrub_oneshot(data)
+    del tsvarana.engine.ENGINES['broken']
+
+
+# Test verification samples are reproducible, and leave the global random
+# state untouched
+def test_engine_sample():
+    state = np.random.get_state()[1].copy()
+    a = tsvarana.engine.engine_sample(data.shape, 3, 20, seed=0)
+    b = tsvarana.engine.engine_sample(data.shape, 3, 20, seed=0)
+    assert all(np.array_equal(i, j) for i, j in zip(a, b))
+    assert np.array_equal(np.random.get_state()[1], state)
+
+# Done
+#
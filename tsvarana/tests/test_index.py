@@ -0,0 +1,75 @@
+# test_index.py
+#
+# test tsvarana results index.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with artefacts
+data = np.random.rand(6, 6, 5, 40)
+data[:, :, 2, 10] += 2
+data[:, :, :, 25] += 1.5
+
+
+# Test runs added to the index can be queried back
+def test_index_query(tmp_path):
+
+    # Process & index two runs from different scanners
+    path = str(tmp_path / 'qc.db')
+    for scanner, spatial_unit in (('A', 'volume'), ('B', 'slice')):
+        varana = tsvarana.classes.varana(spatial_unit, var_threshold=0.3)
+        varana.scrub_iterative(data)
+        tsvarana.index.index_add(
+            path,
+            varana,
+            {'data': 'run_' + scanner, 'spatial_unit': spatial_unit},
+            timing={'compute': 1.5},
+            tags={'scanner': scanner}
+        )
+
+    # Runs from one scanner with flagged volumes
+    columns, rows = tsvarana.index.index_query(
+        path,
+        'SELECT runs.data, runs.n_volumes, runs.n_iter FROM runs '
+        'JOIN tags ON tags.run_id = runs.id '
+        'WHERE tags.key = ? AND tags.value = ? AND runs.n_volumes > ?',
+        ('scanner', 'B', 1)
+    )
+    assert columns == ['data', 'n_volumes', 'n_iter']
+    assert rows == [('run_B', 2, len(varana.regressor))]
+
+    # Per-iteration counts match the regressors
+    _, rows = tsvarana.index.index_query(
+        path,
+        'SELECT n_flagged FROM iterations WHERE run_id = 2 ORDER BY iteration'
+    )
+    assert [row[0] for row in rows] == [int(r.sum()) for r in varana.regressor]
+
+    # Per-slice summary variance of the first iteration
+    _, rows = tsvarana.index.index_query(
+        path,
+        'SELECT variance FROM units WHERE run_id = 2 ORDER BY unit'
+    )
+    summary = np.mean(varana.variance[0], axis=(0, 1))
+    assert np.allclose(
+        [tsvarana.index.index_units(row[0]) for row in rows],
+        summary,
+        rtol=1e-6
+    )
+
+# Done
+#
@@ -0,0 +1,112 @@
+# test_label.py
+#
+# test tsvarana label-image spatial units.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import tempfile
+import numpy as np
+from hypothesis import given, settings, strategies as st
+from hypothesis.extra import numpy as hnp
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with an artefact in
+# two slices
+data = np.random.rand(10, 10, 4, 40) + 5
+data[:, :, 1:3, 15] += 3
+
+# One label per slice, numbered from 1
+slice_labels = np.broadcast_to(np.arange(1, 5), (10, 10, 4)).copy()
+
+
+# Test label means match a loop over labels, for random data & time axes
+@settings(max_examples=50, deadline=None)
+@given(
+    hnp.arrays(
+        float,
+        hnp.array_shapes(min_dims=2, max_dims=4, max_side=6),
+        elements=st.floats(0, 10)
+    ),
+    st.data()
+)
+def test_label_mean(variance, draw):
+    time_axis = draw.draw(st.integers(0, variance.ndim - 1))
+    summary_axis = tuple(i for i in range(variance.ndim) if i != time_axis)
+    labels = draw.draw(hnp.arrays(
+        int,
+        tuple(variance.shape[i] for i in summary_axis),
+        elements=st.integers(0, 4)
+    ))
+    means, _ = tsvarana.core.label_mean(variance, labels, summary_axis)
+    q_variance = np.moveaxis(variance, time_axis, -1)
+    for label in range(means.shape[0]):
+        voxels = labels == label
+        if voxels.any():
+            assert np.allclose(means[label], q_variance[voxels].mean(0))
+        else:
+            assert np.isnan(means[label]).all()
+
+
+# Test one label per slice matches the slice unit, also for batches
+def test_label_slice():
+    for run_axis in (None, 0):
+        batch = data if run_axis is None else np.stack([data, data[::-1]])
+        by_slice = tsvarana.classes.varana(
+            'slice',
+            var_threshold=0.05,
+            run_axis=run_axis
+        )
+        by_slice.scrub_iterative(batch)
+        by_label = tsvarana.classes.varana(
+            'label',
+            var_threshold=0.05,
+            run_axis=run_axis,
+            labels=slice_labels
+        )
+        by_label.scrub_iterative(batch)
+        assert len(by_label.regressor) == len(by_slice.regressor)
+        for a, b in zip(by_label.regressor, by_slice.regressor):
+            assert np.array_equal(a, b)
+        assert np.array_equal(by_label.data_scrub, by_slice.data_scrub)
+
+
+# Test background voxels are never flagged
+def test_label_background():
+    labels = slice_labels.copy()
+    labels[:, :, 1] = 0
+    varana = tsvarana.classes.varana('label', var_threshold=0.05,
+                                     labels=labels)
+    varana.detect(data)
+    regressor = varana.get_regressor_final()
+    assert not regressor[:, :, 1].any()
+    assert regressor[:, :, 2, 15].all()
+
+
+# Test labels are saved with sessions & checkpoints, and plotted
+def test_label_session():
+    with tempfile.TemporaryDirectory() as tmp:
+        varana = tsvarana.classes.varana('label', var_threshold=0.05,
+                                         labels=slice_labels)
+        varana.scrub_iterative(data, checkpoint=os.path.join(tmp, 'ckpt'))
+        varana.save(os.path.join(tmp, 'session'))
+        loaded = tsvarana.classes.varana()
+        loaded.load(os.path.join(tmp, 'session'))
+        assert np.array_equal(loaded.labels, slice_labels)
+        tsvarana.plot.plot_report(loaded)
+        tsvarana.plot.plot_diagnostic(loaded)
+
+# Done
+#
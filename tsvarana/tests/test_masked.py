@@ -0,0 +1,99 @@
+# test_masked.py
+#
+# test tsvarana flag-excluding iterations.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import warnings
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with decaying artefacts
+data = np.random.rand(6, 6, 5, 80) + 1
+data[..., 20:30] += 4 * np.exp(-np.arange(10) / 3)
+data[:, :, 2, 50:53] += 3
+
+
+# Test masked iterations flag each timepoint once, and scrub once from
+# the union of flags
+def test_masked_union():
+
+    # Masked mode
+    varana = tsvarana.classes.varana('slice', var_threshold=0.1, masked=True)
+    varana.scrub_iterative(data)
+
+    # First iteration matches plain detection
+    legacy = tsvarana.classes.varana('slice', var_threshold=0.1)
+    legacy.detect(data)
+    assert np.allclose(varana.variance[0], legacy.variance[0])
+    assert np.array_equal(varana.regressor[0], legacy.regressor[0])
+
+    # Each timepoint is flagged by one iteration at most, and the last
+    # iteration flags nothing new
+    flags = varana.get_regressor_final()
+    assert flags.max() == 1
+    assert not varana.regressor[-1].any()
+
+    # Single scrub of the original data
+    assert np.array_equal(
+        varana.data_scrub,
+        tsvarana.core.scrub(data, flags.astype(bool), 3)
+    )
+
+
+# Test masked batches match masked runs processed separately, and lazy
+# views match scrubbed data
+def test_masked_batch():
+
+    # Batch of runs with different artefacts
+    runs = [data, data[..., ::-1].copy(), np.random.rand(6, 6, 5, 80) + 1]
+    batch = tsvarana.classes.varana(
+        'volume',
+        var_threshold=0.05,
+        masked=True,
+        lazy=True
+    )
+    batch.scrub_iterative(runs)
+
+    # Loop runs
+    for run_data, run in zip(runs, batch.get_runs()):
+        single = tsvarana.classes.varana(
+            'volume',
+            var_threshold=0.05,
+            masked=True
+        )
+        single.scrub_iterative(run_data)
+        assert len(run.regressor) == len(single.regressor)
+        for a, b in zip(run.regressor, single.regressor):
+            assert np.array_equal(a, b)
+        assert np.allclose(run.data_scrub[...], single.data_scrub)
+
+
+# Test voxels and runs with every timepoint excluded give NaN variance,
+# without warnings
+def test_masked_excluded():
+    batch = np.stack([data, data])
+    mask = np.zeros(batch.shape, dtype=bool)
+    mask[0, 0, 0, 0] = True
+    mask[1] = True
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        variance = tsvarana.core.variance_masked(batch, 4, mask, run_axis=0)
+    assert np.isnan(variance[0, 0, 0, 0]).all()
+    assert np.isfinite(variance[0, 1:]).all()
+    assert np.isnan(variance[1]).all()
+
+# Done
+#
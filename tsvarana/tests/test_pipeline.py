@@ -0,0 +1,83 @@
+# test_pipeline.py
+#
+# test tsvarana functional pipeline.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Frozen configuration, with arbitrary parameters
+config = tsvarana.pipeline.varana_config(
+    spatial_unit='slice',
+    slice_axis=2,
+    time_axis=3,
+    var_threshold=0.1
+)
+
+# Generate dummy runs with (x,y,z,t) dimensions
+runs = [np.random.rand(10, 10, 10, 100) for _ in range(4)]
+
+
+# Test pipeline results match the varana class
+def test_pipeline_matches_class():
+
+    # Pipeline
+    result = tsvarana.pipeline.pipeline_iterative(runs[0], config)
+
+    # Class
+    varana = tsvarana.classes.varana(
+        spatial_unit='slice',
+        var_threshold=0.1
+    )
+    varana.scrub_iterative(runs[0])
+
+    # Same outputs
+    assert len(result.variance) == len(varana.variance)
+    assert np.array_equal(result.data_scrub, varana.data_scrub)
+
+
+# Test results are immutable
+def test_pipeline_immutable():
+
+    # Run detection
+    result = tsvarana.pipeline.pipeline_oneshot(runs[0], config)
+
+    # Arrays are read-only
+    with pytest.raises(ValueError):
+        result.data_scrub[0, 0, 0, 0] = 0
+    with pytest.raises(ValueError):
+        result.variance[0][0, 0, 0, 0] = 0
+
+
+# Test one configuration shared across threads
+def test_pipeline_threads():
+
+    # Fan runs out over a thread pool
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(
+            lambda data: tsvarana.pipeline.pipeline_iterative(data, config),
+            runs
+        ))
+
+    # Same as processing sequentially
+    for data, result in zip(runs, results):
+        expected = tsvarana.pipeline.pipeline_iterative(data, config)
+        assert np.array_equal(result.data_scrub, expected.data_scrub)
+
+# Done
+#
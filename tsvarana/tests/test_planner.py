@@ -0,0 +1,80 @@
+# test_planner.py
+#
+# test tsvarana memory-budget planner.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import argparse
+import numpy as np
+import nibabel as nib
+import pytest
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Shape of a typical run, with (x,y,z,t) dimensions
+shape = (96, 96, 60, 400)
+
+
+# Test the planner picks the fastest strategy that fits the budget
+def test_plan_select():
+
+    # Estimate strategies
+    candidates = tsvarana.planner.plan_estimate(shape, seconds=1e-7)
+    memory = [c['memory'] for c in candidates]
+
+    # Unlimited memory keeps the whole run in memory
+    assert tsvarana.planner.plan_select(candidates)['strategy'] == 'memory'
+
+    # Memory-mapped input needs less memory
+    plan = tsvarana.planner.plan_select(candidates, memory[0] - 1)
+    assert plan['strategy'] == 'cache'
+
+    # Tighter budgets need more shards
+    plan = tsvarana.planner.plan_select(candidates, memory[1] - 1)
+    assert plan['strategy'] == 'shard'
+    assert plan['memory'] < memory[1]
+    assert memory[2:] == sorted(memory[2:], reverse=True)
+
+    # Nothing fits
+    with pytest.raises(TypeError):
+        tsvarana.planner.plan_select(candidates, 1)
+
+
+# Test shards are not planned with options they do not support
+def test_plan_unsupported(tmp_path, capsys):
+
+    # Small run on disk
+    infile = str(tmp_path / 'data.nii')
+    nib.save(nib.Nifti1Image(np.random.rand(16, 16, 8, 30), np.eye(4)),
+             infile)
+    args = argparse.Namespace(
+        data=infile, spatial_unit='slice', slice_axis=2, time_axis=3,
+        one_shot=False, plan_iterations=5, max_memory=None, masked=False,
+        triage=False, index=None, checkpoint=None, resume=False, lazy=False,
+        engine='reference', verify=0, pyramid=0, segment=0
+    )
+
+    # Shards are planned by default
+    tsvarana.planner.plan_routine(args)
+    assert 'shard  shards' in capsys.readouterr().out
+
+    # Not with checkpoints, and the option is named
+    args.checkpoint = str(tmp_path / 'checkpoint')
+    tsvarana.planner.plan_routine(args)
+    out = capsys.readouterr().out
+    assert 'shard  shards' not in out
+    assert '--checkpoint' in out
+
+# Done
+#
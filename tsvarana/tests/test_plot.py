@@ -0,0 +1,100 @@
+# test_plot.py
+#
+# test tsvarana plotting functions.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Variance analysis instance, with arbitrary parameters
+varana = tsvarana.classes.varana()
+varana.slice_axis = 2
+varana.time_axis = 3
+varana.var_threshold = 0.1
+
+# Generate dummy data with (x,y,z,t) dimensions
+data = np.random.rand(10, 10, 10, 100)
+
+
+# Test voxel-wise carpet binning
+def test_carpet_bin():
+
+    # Bin voxels into rows
+    carpet = tsvarana.utils.carpet_bin(data, 3, 50)
+
+    # One row per bin, one column per timepoint
+    assert carpet.shape == (50, 100)
+
+    # Equally-sized bins preserve the overall mean
+    assert np.isclose(carpet.mean(), data.mean())
+
+
+# Test voxel-wise plotting
+def test_plot_voxel():
+
+    # Run detection
+    varana.spatial_unit = 'voxel'
+    varana.detect(data)
+
+    # Plot diagnostics & regressors
+    assert tsvarana.plot.plot_diagnostic(varana) is not None
+    assert tsvarana.plot.plot_regressor(varana) is not None
+
+
+# Test min-max decimation keeps spikes
+def test_decimate_minmax():
+
+    # Timecourse with a single spike
+    y = np.zeros(2000)
+    y[1234] = 10
+
+    # Decimate
+    x, y_dec = tsvarana.utils.decimate_minmax(y, 100)
+
+    # Two samples per bucket, spike survives
+    assert x.shape == (200,)
+    assert y_dec.shape == (200,)
+    assert y_dec.max() == 10
+
+
+# Test size-bounded report
+def test_plot_report():
+
+    # Run detection
+    varana.spatial_unit = 'slice'
+    varana.detect(data)
+
+    # Report, with a tight output size budget
+    grid = tsvarana.plot.plot_report(varana, max_size=500)
+
+    # One figure for variance and one for regressors
+    assert len(grid.children) == 2
+
+    # Images fit the budget
+    source = grid.children[0][0].renderers[0].data_source
+    for key in ('variance_1', 'regressor_1'):
+        assert source.data[key][0].size <= 250
+
+    # Lines and their shared time column fit the budget
+    varana.spatial_unit = 'volume'
+    varana.detect(data)
+    grid = tsvarana.plot.plot_report(varana, max_size=90)
+    source = grid.children[0][0].renderers[0].data_source
+    assert set(source.data) == {'x', 'variance_1', 'regressor_1'}
+    assert sum(len(column) for column in source.data.values()) <= 90
+
+# Done
+#
@@ -0,0 +1,76 @@
+# test_pyramid.py
+#
+# test tsvarana coarse-to-fine voxel variance.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+from hypothesis import given, settings, strategies as st
+from hypothesis.extra import numpy as hnp
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions and odd spatial sizes, with
+# a clustered artefact and a single-voxel artefact
+data = np.random.rand(15, 13, 7, 60) + 5
+data[2:6, 3:8, 1:3, 20] += 3
+data[11, 0, 6, 45] += 4
+
+
+# Test the threshold test matches full resolution, with most of the data
+# cleared at coarse resolution
+def test_pyramid_detection():
+    for levels in (1, 2, 3, 5):
+        full = tsvarana.classes.varana('voxel', var_threshold=0.1)
+        full.scrub_iterative(data)
+        pyramid = tsvarana.classes.varana(
+            'voxel',
+            var_threshold=0.1,
+            pyramid=levels,
+            verify=50
+        )
+        pyramid.scrub_iterative(data)
+        assert len(pyramid.regressor) == len(full.regressor)
+        for a, b in zip(pyramid.regressor, full.regressor):
+            assert np.array_equal(a, b)
+        assert np.array_equal(pyramid.data_scrub, full.data_scrub)
+    assert (pyramid.variance[0] > 0).mean() < 0.5
+
+
+# Test the bound holds for random data, shapes & time axes
+@settings(max_examples=50, deadline=None)
+@given(
+    hnp.arrays(
+        float,
+        hnp.array_shapes(min_dims=2, max_dims=4, max_side=9),
+        elements=st.floats(0.5, 10)
+    ),
+    st.data()
+)
+def test_pyramid_property(data, draw):
+    time_axis = draw.draw(st.integers(0, data.ndim - 1))
+    threshold = draw.draw(st.floats(0.001, 2))
+    levels = draw.draw(st.integers(1, 4))
+    assert np.array_equal(
+        tsvarana.pyramid.variance_pyramid(
+            data,
+            time_axis,
+            threshold,
+            levels
+        ) > threshold,
+        tsvarana.core.variance_calc(data, time_axis) > threshold
+    )
+
+# Done
+#
@@ -0,0 +1,70 @@
+# test_review.py
+#
+# test tsvarana interactive review.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import tempfile
+import numpy as np
+from bokeh import events
+from bokeh.document import Document
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions
+data = np.random.rand(10, 9, 4, 57) + 5
+data[:, :, 1:3, 18:23] += 3
+
+
+# Test tiles are exact under budget, and sampled & max-pooled over budget
+def test_review_tile():
+    carpet = np.reshape(np.moveaxis(data, 3, 0), [57, -1]).T
+    tile = tsvarana.review.review_tile(data, 3, (5.5, 40), (10, 30))
+    assert np.array_equal(tile['image'][0], carpet[5:40, 10:30])
+    assert (tile['x'], tile['y'], tile['dw'], tile['dh']) == \
+        ([10], [5], [20], [35])
+    tile = tsvarana.review.review_tile(data, 3, (0, 360), (0, 57), 50, 10)
+    assert tile['image'][0].shape == (50, 10)
+    assert np.array_equal(tile['image'][0][0], np.maximum.reduceat(
+        carpet[0],
+        np.linspace(0, 57, 11).astype(int)[:-1]
+    ))
+    assert np.allclose(
+        tsvarana.review.review_slice(data, 2, 3, 1),
+        data[:, :, 1].mean(axis=(0, 1))
+    )
+
+
+# Test the review document follows zoom, clicks & selections
+def test_review_document():
+    varana = tsvarana.classes.varana('slice', var_threshold=0.05)
+    varana.scrub_iterative(data)
+    with tempfile.TemporaryDirectory() as tmp:
+        varana.save(tmp)
+        doc = Document()
+        tsvarana.review.review_document(doc, tmp)
+        controls, carpet, slice_figure, voxel_figure = doc.roots[0].children
+        carpet._trigger_event(
+            events.RangesUpdate(carpet, x0=10, x1=30, y0=5, y1=50)
+        )
+        source = carpet.renderers[0].data_source
+        assert source.data['image'][0].shape == (45, 20)
+        carpet._trigger_event(events.Tap(carpet, x=20, y=201))
+        assert controls.children[2].value == 1
+        assert voxel_figure.title.text == 'Voxel (5, 5, 1)'
+        controls.children[1].value = 'regressor'
+        assert source.data['image'][0].max() == 1
+
+# Done
+#
@@ -0,0 +1,128 @@
+# test_segment.py
+#
+# test tsvarana temporal segmentation.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import tempfile
+import numpy as np
+from hypothesis import given, settings, strategies as st
+from hypothesis.extra import numpy as hnp
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with artefacts crossing
+# segment boundaries and at the start & end of the run
+data = np.random.rand(10, 9, 4, 57) + 5
+data[:, :, 1:3, 18:23] += 3
+data[3, 4, 2, 0:2] += 5
+data[5, 5, 0, 55:] += 5
+
+
+# Test the median sketch matches numpy, including repeated values
+@settings(max_examples=50, deadline=None)
+@given(
+    hnp.arrays(
+        float,
+        hnp.array_shapes(min_dims=2, max_dims=4, max_side=9),
+        elements=st.one_of(st.integers(0, 3), st.floats(-5, 5))
+    ),
+    st.data()
+)
+def test_segment_median(data, draw):
+    time_axis = draw.draw(st.integers(0, data.ndim - 1))
+    length = draw.draw(st.integers(1, data.shape[time_axis]))
+    bins = draw.draw(st.integers(2, 16))
+    median_img, data_mean = tsvarana.segment.segment_median(
+        data,
+        time_axis,
+        length,
+        bins
+    )
+    expected = np.median(np.moveaxis(data, time_axis, 0), axis=0)
+    assert np.array_equal(median_img, expected.ravel())
+    assert np.isclose(data_mean, data.mean())
+
+
+# Test intervals found a segment at a time scrub as the whole run
+@settings(max_examples=50, deadline=None)
+@given(
+    hnp.arrays(bool, st.tuples(st.integers(1, 30), st.integers(1, 5))),
+    st.data()
+)
+def test_segment_intervals(flags, draw):
+    block = np.random.rand(*flags.shape)
+    length = draw.draw(st.integers(1, flags.shape[0]))
+    scrubbed = block.copy()
+    state = None
+    for start, stop in tsvarana.segment.segment_bounds(len(block), length):
+        intervals, state = tsvarana.segment.segment_intervals(
+            block[start:stop],
+            flags[start:stop],
+            start,
+            len(block),
+            state
+        )
+        whole = np.isnan(intervals[3])
+        intervals[3][whole] = np.median(block, axis=0)[intervals[0][whole]]
+        tsvarana.segment.segment_apply(scrubbed, intervals)
+    assert np.array_equal(scrubbed, tsvarana.core.scrub(block, flags, 0))
+
+
+# Test segmented scrubbing matches the whole run in memory
+def test_segment_pipeline():
+    for unit in ('voxel', 'slice'):
+        for window in (None, 5):
+            full = tsvarana.classes.varana(unit, var_threshold=0.05,
+                                           window=window)
+            full.scrub_iterative(data)
+            for length in (1, 10, 100):
+                with tempfile.TemporaryDirectory() as tmp:
+                    segmented = tsvarana.classes.varana(
+                        unit,
+                        var_threshold=0.05,
+                        window=window,
+                        segment=length
+                    )
+                    segmented.scrub_iterative(data, scratch=tmp)
+                    assert len(segmented.regressor) == len(full.regressor)
+                    for a, b in zip(segmented.regressor, full.regressor):
+                        assert np.array_equal(a, b)
+                    for a, b in zip(segmented.variance, full.variance):
+                        assert np.allclose(a, b)
+                    assert np.array_equal(segmented.data_scrub,
+                                          full.data_scrub)
+
+
+# Test per-segment medians match the whole run for a single segment
+def test_segment_local():
+    full = tsvarana.classes.varana('slice', var_threshold=0.05)
+    full.scrub_oneshot(data)
+    for length in (20, 57):
+        with tempfile.TemporaryDirectory() as tmp:
+            segmented = tsvarana.classes.varana(
+                'slice',
+                var_threshold=0.05,
+                segment=length,
+                segment_median='segment'
+            )
+            segmented.scrub_oneshot(data, scratch=tmp)
+            assert segmented.regressor[0].any()
+            if length == 57:
+                assert np.array_equal(segmented.regressor[0],
+                                      full.regressor[0])
+                assert np.array_equal(segmented.data_scrub, full.data_scrub)
+
+# Done
+#
@@ -0,0 +1,73 @@
+# test_service.py
+#
+# test tsvarana watch-folder service functions.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+import nibabel as nib
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+
+# Test files are only dispatched once they stop changing
+def test_service_scan(tmp_path):
+
+    # Scan state
+    state = {'seen': {}, 'done': set()}
+
+    # New file, not yet known to be complete
+    path = str(tmp_path / 'run.nii.gz')
+    with open(path, 'wb') as fid:
+        fid.write(b'0')
+    with open(str(tmp_path / 'notes.txt'), 'w') as fid:
+        fid.write('0')
+    ready, pending = tsvarana.service.service_scan(str(tmp_path), state)
+    assert ready == [] and pending == 1
+
+    # Unchanged file is ready
+    ready, pending = tsvarana.service.service_scan(str(tmp_path), state)
+    assert ready == [path] and pending == 0
+
+    # Dispatched files are not picked up again
+    ready, pending = tsvarana.service.service_scan(str(tmp_path), state)
+    assert ready == [] and pending == 0
+
+
+# Test data buffers are reused for the same geometry
+def test_worker_buffer():
+
+    # Same shape, same buffer
+    a = tsvarana.service.worker_buffer((4, 4, 4, 10))
+    b = tsvarana.service.worker_buffer((4, 4, 4, 10))
+    assert a is b
+
+    # Buffers are evicted beyond the limit
+    for n in range(tsvarana.service.WORKER_BUFFERS):
+        tsvarana.service.worker_buffer((4, 4, 4, 11 + n))
+    assert tsvarana.service.worker_buffer((4, 4, 4, 10)) is not a
+
+
+# Test gzipped runs are read whole into the buffer
+def test_worker_load(tmp_path):
+    data = np.random.rand(4, 4, 3, 12).astype(np.float32)
+    path = str(tmp_path / 'run.nii.gz')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    loaded, affine = tsvarana.service.worker_load(path)
+    assert loaded is tsvarana.service.worker_buffer(data.shape)
+    assert np.array_equal(loaded, data)
+    assert np.array_equal(affine, np.eye(4))
+
+# Done
+#
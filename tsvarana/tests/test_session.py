@@ -0,0 +1,81 @@
+# test_session.py
+#
+# test tsvarana session files.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import os
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Variance analysis instance, with arbitrary parameters
+varana = tsvarana.classes.varana()
+varana.spatial_unit = 'slice'
+varana.slice_axis = 2
+varana.time_axis = 3
+varana.var_threshold = 0.1
+
+# Generate dummy data with (x,y,z,t) dimensions
+data = np.random.rand(10, 10, 10, 100)
+
+
+# Test save & load round trip
+def test_session_roundtrip(tmp_path):
+
+    # Run scrubbing & save
+    varana.scrub_iterative(data)
+    varana.save(str(tmp_path / 'session'))
+
+    # Load into a fresh instance
+    loaded = tsvarana.classes.varana()
+    loaded.load(str(tmp_path / 'session'))
+
+    # Settings are restored
+    assert loaded.spatial_unit == varana.spatial_unit
+    assert loaded.var_threshold == varana.var_threshold
+    assert loaded.summary_axis == varana.summary_axis
+
+    # Results are memory-mapped and identical
+    assert isinstance(loaded.data_scrub, np.memmap)
+    assert np.array_equal(loaded.data_scrub, varana.data_scrub)
+    assert len(loaded.variance) == len(varana.variance)
+    for a, b in zip(loaded.regressor, varana.regressor):
+        assert np.array_equal(a, b)
+
+    # Loaded sessions can be plotted
+    assert tsvarana.plot.plot_report(loaded) is not None
+
+
+# Test saving over a session replaces it whole, and keeps the affine
+def test_session_replace(tmp_path):
+    path = str(tmp_path / 'session')
+    long_run = tsvarana.classes.varana('slice', var_threshold=0.01)
+    long_run.scrub_iterative(data)
+    long_run.save(path)
+    short_run = tsvarana.classes.varana('slice', var_threshold=10)
+    short_run.scrub_iterative(data)
+    assert len(short_run.variance) < len(long_run.variance)
+    short_run.save(path, affine=np.diag([2, 2, 3, 1]))
+    assert sorted(os.listdir(str(tmp_path))) == ['session']
+    assert sorted(
+        name for name in os.listdir(path) if name.startswith('variance_')
+    ) == ['variance_001.npy']
+    loaded = tsvarana.classes.varana()
+    loaded.load(path)
+    assert len(loaded.variance) == 1
+    assert np.array_equal(loaded.affine, np.diag([2, 2, 3, 1]))
+
+# Done
+#
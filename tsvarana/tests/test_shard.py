@@ -0,0 +1,97 @@
+# test_shard.py
+#
+# test tsvarana shard-and-merge processing.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import argparse
+import numpy as np
+import nibabel as nib
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with artefacts
+data = np.random.rand(8, 8, 7, 60)
+data[:, :, 3, 10] += 2
+data[:, :, :, 30] += 1.5
+
+
+# Test sharded scrubbing matches processing the whole run
+def test_shard_matches_single(tmp_path):
+
+    # Save data
+    infile = str(tmp_path / 'data.nii')
+    nib.save(nib.Nifti1Image(data, np.eye(4)), infile)
+
+    # Loop spatial units
+    for spatial_unit in ('slice', 'volume'):
+
+        # Write manifest
+        shard_dir = str(tmp_path / spatial_unit)
+        output = shard_dir + '_out'
+        tsvarana.shard.shard_manifest(argparse.Namespace(
+            data=infile,
+            shard_manifest=shard_dir,
+            shards=3,
+            spatial_unit=spatial_unit,
+            slice_axis=2,
+            time_axis=3,
+            var_threshold=0.3,
+            window=None,
+            masked=False,
+            one_shot=False
+        ))
+
+        # Run rounds until converged
+        while not tsvarana.shard.shard_read(shard_dir)[1]['converged']:
+            for index in range(3):
+                tsvarana.shard.shard_run(argparse.Namespace(
+                    shard_run=shard_dir,
+                    shard_index=index
+                ))
+            tsvarana.shard.shard_merge(argparse.Namespace(
+                shard_merge=shard_dir,
+                output=output,
+                max_size=10000
+            ))
+
+        # Merging again after convergence changes nothing
+        state = tsvarana.shard.shard_read(shard_dir)[1]
+        tsvarana.shard.shard_merge(argparse.Namespace(
+            shard_merge=shard_dir,
+            output=output,
+            max_size=10000
+        ))
+        assert tsvarana.shard.shard_read(shard_dir)[1] == state
+
+        # Process whole run
+        varana = tsvarana.classes.varana(
+            spatial_unit=spatial_unit,
+            var_threshold=0.3
+        )
+        varana.scrub_iterative(data)
+
+        # Same iterations & scrubbed data
+        merged = tsvarana.classes.varana()
+        merged.load(shard_dir + '/session')
+        assert len(merged.regressor) == len(varana.regressor)
+        for a, b in zip(merged.regressor, varana.regressor):
+            assert np.array_equal(a, b)
+        assert np.allclose(
+            nib.load(output + '_scrubbed.nii.gz').get_fdata(),
+            varana.data_scrub
+        )
+
+# Done
+#
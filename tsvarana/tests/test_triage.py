@@ -0,0 +1,69 @@
+# test_triage.py
+#
+# test tsvarana sampling-based triage.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import pytest
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate clean dummy data with (x,y,z,t) dimensions
+clean = np.random.rand(20, 20, 6, 50) + 10
+
+# Add an artefact to a single slice
+dirty = clean.copy()
+dirty[:, :, 2, 30] += 5
+
+
+# Test triage status against the full pipeline
+def test_triage_status():
+
+    # Clean run
+    varana = tsvarana.classes.varana('slice', var_threshold=0.1)
+    assert varana.triage(clean, seed=0) == 'clean'
+
+    # Artefact well above the threshold
+    assert varana.triage(dirty, seed=0) == 'dirty'
+    varana.detect(dirty)
+    assert varana.get_regressor()[0].any()
+
+    # Threshold at the estimate of the same sample
+    estimate = varana.triage_result.estimate.max()
+    varana.var_threshold = estimate
+    assert varana.triage(dirty, seed=0) == 'uncertain'
+
+    # Sampling every voxel is exact
+    assert varana.triage(dirty, n_voxels=400, seed=0) != 'uncertain'
+
+
+# Test escalation to the full pipeline
+def test_triage_escalate():
+
+    # Clean runs are not processed
+    varana = tsvarana.classes.varana('volume', var_threshold=0.02)
+    varana.triage(clean, escalate=True, seed=0)
+    assert not hasattr(varana, 'regressor')
+
+    # Dirty runs are scrubbed
+    varana.triage(dirty, escalate=True, seed=0)
+    assert varana.get_regressor_final()[..., 30].all()
+
+    # Voxel units cannot be triaged
+    with pytest.raises(TypeError):
+        tsvarana.classes.varana('voxel').triage(clean)
+
+# Done
+#
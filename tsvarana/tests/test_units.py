@@ -0,0 +1,83 @@
+# test_units.py
+#
+# test tsvarana multi-unit runs.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with an artefact in two
+# slices and a smaller one in a few voxels
+data = np.random.rand(10, 9, 4, 57) + 5
+data[:, :, 1:3, 18:23] += 3
+data[2:5, 2:5, 0, 40:42] += 4
+
+
+# Test incremental median updates match the median of the whole data
+def test_units_median():
+    for window in (None, 5):
+        median_img = tsvarana.core.median_calc(data, 3, window)
+        changed = np.zeros((10, 9, 4, 1), dtype=bool)
+        changed[:, :, 1:3] = True
+        scrubbed = data.copy()
+        scrubbed[:, :, 1:3, 18:23] = 5
+        assert np.array_equal(
+            tsvarana.core.median_update(scrubbed, 3, median_img, changed,
+                                        window),
+            tsvarana.core.median_calc(scrubbed, 3, window)
+        )
+
+
+# Test shared detection & scrubbing match separate runs of each unit
+def test_units_shared():
+    for engine in ('reference', 'vectorized'):
+        for iterative in (False, True):
+            varana = tsvarana.classes.varana(var_threshold=0.05,
+                                             engine=engine)
+            runs = varana.detect_units(data, iterative=iterative)
+            assert tuple(runs) == ('voxel', 'slice', 'volume')
+            for unit, run in runs.items():
+                single = tsvarana.classes.varana(unit, var_threshold=0.05,
+                                                 engine=engine)
+                if iterative:
+                    single.scrub_iterative(data)
+                    assert np.array_equal(run.data_scrub, single.data_scrub)
+                else:
+                    single.detect(data)
+                assert run.spatial_unit == unit
+                assert len(run.regressor) == len(single.regressor)
+                for a, b in zip(run.regressor, single.regressor):
+                    assert np.array_equal(a, b)
+                for a, b in zip(run.variance, single.variance):
+                    assert np.array_equal(a, b)
+
+
+# Test batches of runs converge per run, as in separate runs
+def test_units_batch():
+    batch = [data, data[::-1] + 1]
+    runs = tsvarana.classes.varana(var_threshold=0.05).detect_units(
+        batch,
+        units=('slice', 'volume'),
+        iterative=True
+    )
+    for unit, run in runs.items():
+        single = tsvarana.classes.varana(unit, var_threshold=0.05)
+        single.scrub_iterative(batch)
+        assert np.array_equal(run.n_iter, single.n_iter)
+        assert np.array_equal(run.data_scrub, single.data_scrub)
+
+# Done
+#
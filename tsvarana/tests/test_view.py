@@ -0,0 +1,87 @@
+# test_view.py
+#
+# test tsvarana lazy scrubbed data view.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import numpy as np
+import nibabel as nib
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions & random regressors
+data = np.random.rand(5, 6, 4, 30)
+regressor = np.random.rand(5, 6, 4, 30) < 0.1
+regressor[0, 0, 0, :] = True
+
+
+# Test intervals reproduce scrub, along any time axis
+def test_scrub_intervals():
+
+    # Loop time axes
+    for time_axis in range(4):
+
+        # Reference & lazy scrubbing
+        data_scrub = tsvarana.core.scrub(data, regressor, time_axis)
+        view = tsvarana.view.scrubview(
+            data,
+            time_axis,
+            tsvarana.core.scrub_intervals(data, regressor, time_axis)
+        )
+
+        # Full array & partial reads
+        assert np.array_equal(view.materialize(), data_scrub)
+        assert np.array_equal(view[1:4, ::-2, 2], data_scrub[1:4, ::-2, 2])
+        assert np.array_equal(view[..., 7], data_scrub[..., 7])
+
+
+# Test composed intervals reproduce successive scrubs
+def test_scrubview_compose(tmp_path):
+
+    # Two successive scrubs
+    second = np.roll(regressor, 3, axis=3)
+    data_scrub = tsvarana.core.scrub(data, regressor, 3)
+    view = tsvarana.view.scrubview(data, 3).compose(
+        tsvarana.core.scrub_intervals(data, regressor, 3)
+    ).compose(
+        tsvarana.core.scrub_intervals(data_scrub, second, 3)
+    )
+    data_scrub = tsvarana.core.scrub(data_scrub, second, 3)
+    assert np.array_equal(np.asarray(view), data_scrub)
+
+    # Streamed NIFTI output
+    outfile = str(tmp_path / 'scrubbed.nii.gz')
+    view.to_nifti(outfile, np.eye(4), chunk=4)
+    assert np.array_equal(nib.load(outfile).get_fdata(), data_scrub)
+
+
+# Test lazy iterative scrubbing matches the default
+def test_lazy_iterative():
+
+    # Default & lazy
+    varana = tsvarana.classes.varana(spatial_unit='slice', var_threshold=0.1)
+    varana.scrub_iterative(data)
+    lazy = tsvarana.classes.varana(
+        spatial_unit='slice',
+        var_threshold=0.1,
+        lazy=True
+    )
+    lazy.scrub_iterative(data)
+
+    # Same scrubbed data
+    assert isinstance(lazy.get_data_scrub(), tsvarana.view.scrubview)
+    assert np.array_equal(lazy.get_data_scrub()[...], varana.data_scrub)
+
+# Done
+#
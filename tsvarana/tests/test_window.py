@@ -0,0 +1,68 @@
+# test_window.py
+#
+# test tsvarana rolling median detection.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import pytest
+import numpy as np
+
+# Project dependencies
+import tsvarana
+
+# ====
+# TEST
+# ====
+
+# Generate dummy data with (x,y,z,t) dimensions, with a slow linear drift
+# and a single artefact
+data = np.random.rand(6, 6, 5, 100) + np.linspace(0, 5, 100)
+data[:, :, :, 40] += 3
+
+
+# Test the rolling median matches the median of each reflected window
+def test_median_rolling():
+    window = 9
+    median_img = tsvarana.core.median_rolling(data, 3, window)
+    padded = np.pad(data, ((0, 0),) * 3 + ((4, 4),), mode='symmetric')
+    for tp in (0, 3, 50, 99):
+        assert np.allclose(
+            median_img[..., tp],
+            np.median(padded[..., tp:tp + window], axis=3)
+        )
+
+    # Even windows have no middle timepoint
+    with pytest.raises(TypeError):
+        tsvarana.core.median_rolling(data, 3, 4)
+
+
+# Test the rolling median follows drift, so only the artefact is flagged
+def test_window_detection():
+
+    # The median of the whole run flags the start and end of the drift
+    varana = tsvarana.classes.varana('volume', var_threshold=0.3)
+    varana.detect(data)
+    flagged = np.nonzero(varana.get_regressor()[0][0, 0, 0])[0]
+    assert len(flagged) > 1
+
+    # The rolling median flags the artefact only, with either engine
+    for engine in ('reference', 'vectorized'):
+        varana = tsvarana.classes.varana(
+            'volume',
+            var_threshold=0.3,
+            window=11,
+            engine=engine,
+            verify=10
+        )
+        varana.detect(data)
+        flagged = np.nonzero(varana.get_regressor()[0][0, 0, 0])[0]
+        assert list(flagged) == [40]
+
+# Done
+#
@@ -0,0 +1,182 @@
+# triage.py
+#
+# tsvarana sampling-based triage.
+#
+# Estimates the mean normalised variance of every slice or volume from a
+# random sample of voxels, stratified by slice, instead of every voxel.
+# Confidence bounds on each estimate decide whether the run is
+#   - clean      no unit exceeds the threshold, at any timepoint
+#   - dirty      at least one unit exceeds the threshold
+#   - uncertain  the sample cannot tell, and the full pipeline is needed
+#
+# Bounds are normal approximations, with a finite population correction
+# and a Bonferroni correction across all units and timepoints. The mean
+# intensity used for normalisation is also estimated from the sample, and
+# treated as exact.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import collections
+import numpy as np
+from scipy.stats import norm
+
+# Project dependencies
+from tsvarana.core import median_rolling
+
+# Default number of voxels sampled per slice
+TRIAGE_VOXELS = 200
+
+# Default family-wise error rate of the confidence bounds
+TRIAGE_ALPHA = 0.05
+
+# Triage results
+#   status       [string] 'clean', 'dirty' or 'uncertain'
+#   estimate     [array ] Mean normalised variance, (unit, time)
+#   lower        [array ] Lower confidence bound, (unit, time)
+#   upper        [array ] Upper confidence bound, (unit, time)
+#   n_voxels     [scalar] Number of voxels sampled
+varana_triage = collections.namedtuple(
+    'varana_triage',
+    [
+        'status',
+        'estimate',
+        'lower',
+        'upper',
+        'n_voxels',
+    ]
+)
+
+# =============
+# TRIAGE_SAMPLE
+# =============
+
+
+def triage_sample(data, slice_axis, time_axis, n_voxels, seed=None):
+    '''
+    Draw a random sample of voxel timeseries, with the same number of
+    voxels from every slice
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        slice_axis  [scalar] Axis along which the slice dimension is defined
+        time_axis   [scalar] Axis along which time is encoded
+        n_voxels    [scalar] Number of voxels per slice, at most all of them
+        seed        [scalar] Random seed
+    Outputs
+        sample      [array ] Sampled timeseries, (slice, voxel, time)
+        fraction    [scalar] Fraction of each slice sampled
+    '''
+
+    # Random generator
+    rng = np.random.default_rng(seed)
+
+    # Time along the last axis, slices along the first
+    q_data = np.moveaxis(data, time_axis, -1)
+    slice_q = slice_axis - (slice_axis > time_axis)
+    q_data = np.moveaxis(q_data, slice_q, 0)
+
+    # Voxels within a slice
+    in_slice = q_data.shape[1:-1]
+    n_slice = int(np.prod(in_slice))
+    n_voxels = min(n_voxels, n_slice)
+
+    # Sample without replacement within each slice
+    sample = np.empty((q_data.shape[0], n_voxels, q_data.shape[-1]))
+    for s in range(q_data.shape[0]):
+        flat = np.sort(rng.choice(n_slice, n_voxels, replace=False))
+        sample[s] = q_data[s][np.unravel_index(flat, in_slice)]
+
+    # Return
+    return sample, n_voxels / n_slice
+
+# ==========
+# TRIAGE_RUN
+# ==========
+
+
+def triage_run(data, config, n_voxels=TRIAGE_VOXELS, alpha=TRIAGE_ALPHA,
+               seed=None):
+    '''
+    Triage a single run, by testing the mean normalised variance of every
+    slice or volume against the threshold on a sample of voxels
+
+    Inputs
+        data        [array ] N-dimensional voxelwise data array
+        config      [object] tsvarana.pipeline.varana_config, with the
+                             'slice' or 'volume' spatial unit
+        n_voxels    [scalar] Number of voxels sampled per slice
+        alpha       [scalar] Family-wise error rate of the bounds
+        seed        [scalar] Random seed
+    Outputs
+        triage      [object] varana_triage
+    '''
+
+    # Units average many voxels, single voxels cannot be bounded
+    if config.spatial_unit not in ('slice', 'volume'):
+        raise TypeError(
+            'Error: triage supports the slice and volume units only.'
+        )
+
+    # Sample, (slice, voxel, time)
+    sample, fraction = triage_sample(
+        data,
+        config.slice_axis,
+        config.time_axis,
+        n_voxels,
+        seed=seed
+    )
+    n_slices, n_sampled, _ = sample.shape
+
+    # Median timepoint, or rolling median around each timepoint
+    if config.window is None:
+        median_img = np.median(sample, axis=2, keepdims=True)
+    else:
+        median_img = median_rolling(sample, 2, config.window)
+
+    # Normalised variance, as in tsvarana.core.variance_calc, with the mean
+    # intensity estimated from the sample
+    vw_variance = ((sample - median_img) / 2) ** 2 / sample.mean()
+
+    # Per-slice means & variance of the means, with finite population
+    # correction
+    estimate = vw_variance.mean(axis=1)
+    if n_sampled > 1:
+        spread = vw_variance.var(axis=1, ddof=1) / n_sampled * (1 - fraction)
+    else:
+        spread = np.full(estimate.shape, np.inf)
+
+    # Volume means, from equal-sized strata
+    if config.spatial_unit == 'volume':
+        estimate = estimate.mean(axis=0, keepdims=True)
+        spread = spread.sum(axis=0, keepdims=True) / n_slices ** 2
+
+    # Bounds, corrected for the number of units & timepoints tested
+    z = norm.ppf(1 - alpha / (2 * estimate.size))
+    lower = estimate - z * np.sqrt(spread)
+    upper = estimate + z * np.sqrt(spread)
+
+    # Decide
+    if (lower > config.var_threshold).any():
+        status = 'dirty'
+    elif (upper <= config.var_threshold).all():
+        status = 'clean'
+    else:
+        status = 'uncertain'
+
+    # Return
+    return varana_triage(
+        status=status,
+        estimate=estimate,
+        lower=lower,
+        upper=upper,
+        n_voxels=n_slices * n_sampled
+    )
+
+# Done
+#
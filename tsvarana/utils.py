@@ -12,6 +12,9 @@
 # Libraries
 import numpy as np
 
+# Project dependencies
+from tsvarana.core import label_mean
+
 # =========
 # UTILITIES
 # =========
@@ -23,7 +26,7 @@ def parse_spatial_unit(spatial_unit, data_ndim, slice_axis, time_axis):
     along which variance will be averaged
 
     Input
-        spatial_unit       [string] voxel, slice, volume
+        spatial_unit       [string] voxel, slice, volume, label
         data_ndim          [scalar] number of data axes
         slice_dir          [scalar] axis along which slices are defined
         time_axis          [scalar] axis along which time is stores
@@ -43,8 +46,9 @@ def parse_spatial_unit(spatial_unit, data_ndim, slice_axis, time_axis):
             np.arange(data_ndim) != time_axis,
         )
 
-    elif spatial_unit == 'volume':
-        # Keep all axes that are not the time axis
+    elif spatial_unit in ('volume', 'label'):
+        # Keep all axes that are not the time axis, labels are averaged
+        # over their voxels within these axes
         summary_axis = np.arange(data_ndim) != time_axis
 
     # Turn to tuple indices
@@ -64,14 +68,155 @@ def regressor_final(reg_iter):
         regressor   [array] Logical sum of reg_iter
     '''
 
-    # Stack along first axis
-    regressor = np.stack(reg_iter, axis=0)
-
-    # Logical sum across iterations
-    regressor = np.sum(regressor.astype(bool), axis=0)
+    # Logical sum across iterations, accumulated one iteration at a time
+    # rather than stacked, so memory use does not grow with iterations
+    regressor = np.zeros(np.shape(reg_iter[0]), dtype=int)
+    for reg in reg_iter:
+        regressor += np.asarray(reg).astype(bool)
 
     # Return
     return regressor
 
+
+def carpet_bin(data, time_axis, n_rows):
+    '''
+    Average voxels into a fixed number of bins for each timepoint, in a
+    single pass over the data. Voxels are binned in storage order, so each
+    bin covers a contiguous spatial block
+
+    Input
+        data        [array ] N-dimensional voxelwise data array
+        time_axis   [scalar] axis along which time is stored
+        n_rows      [scalar] maximum number of voxel bins
+    Output
+        carpet      [array ] (bin, time) array of voxel means
+    '''
+
+    # Arrange as (voxel, time)
+    data = np.moveaxis(data, time_axis, -1)
+    data = np.reshape(data, [-1, data.shape[-1]])
+
+    # Bin edges, no more bins than voxels
+    edges = np.linspace(0, data.shape[0], min(n_rows, data.shape[0]) + 1)
+    edges = np.unique(edges.astype(int))
+
+    # Sum within bins and divide by the number of voxels in each
+    carpet = np.add.reduceat(data, edges[:-1], axis=0, dtype=float)
+    carpet = carpet / np.diff(edges)[:, np.newaxis]
+
+    # Return
+    return carpet
+
+
+def summary_calc(data, spatial_unit, summary_axis, time_axis, n_rows=200,
+                 labels=None):
+    '''
+    Summarise voxelwise variance or regressors for plotting, taking the mean
+    across the summary axes once so all figures can share the result
+
+    Input
+        data          [array ] N-dimensional voxelwise data array
+        spatial_unit  [string] voxel, slice, volume, label
+        summary_axis  [tuple ] axis indices
+        time_axis     [scalar] axis along which time is stored
+        n_rows        [scalar] maximum number of voxel bins, voxel unit only
+        labels        [array ] label image, label unit only
+    Output
+        summary       [array ] (time,) array for volumes,
+                               (slice, time) array for slices,
+                               (voxel bin, time) array for voxels,
+                               (label, time) array for labels, without
+                               the background label 0, and zero for labels
+                               with no voxels
+    '''
+
+    # Voxels are binned into a fixed number of rows
+    if spatial_unit == 'voxel':
+        return carpet_bin(data, time_axis, n_rows)
+
+    # Labels are averaged in a single pass
+    if spatial_unit == 'label':
+        summary = label_mean(data, labels, summary_axis)[0][1:]
+        return np.nan_to_num(summary)
+
+    # Mean across summary axes, with time as the last axis
+    summary = np.mean(data, axis=summary_axis, keepdims=True)
+    summary = np.moveaxis(summary, time_axis, -1)
+    summary = np.reshape(summary, [-1, summary.shape[-1]]).astype(float)
+
+    # Volumes are a single row
+    if spatial_unit == 'volume':
+        summary = summary[0]
+
+    # Return
+    return summary
+
+
+def decimate_minmax(y, n_buckets):
+    '''
+    Min-max decimation of timecourses. Time is split into buckets and only
+    the minimum and maximum of each bucket are kept, so single-timepoint
+    spikes survive decimation
+
+    Input
+        y           [array ] (..., time) array of timecourses
+        n_buckets   [scalar] number of time buckets
+    Output
+        x           [array ] timepoint (TR) of each retained sample
+        y           [array ] (..., 2 * n_buckets) decimated timecourses
+    '''
+
+    # Number of timepoints
+    n_timepoints = y.shape[-1]
+
+    # Short timecourses are kept in full
+    if n_timepoints <= 2 * n_buckets:
+        return np.arange(n_timepoints) + 1, y
+
+    # Bucket edges
+    edges = np.linspace(0, n_timepoints, n_buckets + 1).astype(int)[:-1]
+
+    # Minimum & maximum per bucket, interleaved
+    y_min = np.minimum.reduceat(y, edges, axis=-1)
+    y_max = np.maximum.reduceat(y, edges, axis=-1)
+    y = np.stack([y_min, y_max], axis=-1).reshape(y.shape[:-1] + (-1,))
+
+    # Both samples of a bucket sit at its first timepoint
+    x = np.repeat(edges, 2) + 1
+
+    # Return
+    return x, y
+
+
+def image_pyramid(y, max_size):
+    '''
+    Image pyramid of a 2D array, built by repeated 2x2 max pooling until the
+    image holds no more than max_size values. Max pooling keeps isolated
+    high-variance samples visible at coarse levels
+
+    Input
+        y           [array ] 2D array
+        max_size    [scalar] maximum number of values in the coarsest level
+    Output
+        levels      [list  ] pyramid levels, from full resolution to coarsest
+    '''
+
+    # Full resolution
+    levels = [y]
+
+    # Halve each axis longer than one sample, until under budget
+    while y.size > max(max_size, 1) and y.size > 1:
+        for axis in range(2):
+            if y.shape[axis] > 1:
+                y = np.maximum.reduceat(
+                    y,
+                    np.arange(0, y.shape[axis], 2),
+                    axis=axis
+                )
+        levels.append(y)
+
+    # Return
+    return levels
+
 # Done
 #
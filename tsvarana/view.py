@@ -0,0 +1,204 @@
+# view.py
+#
+# tsvarana lazy scrubbed data view.
+#
+# Ivan Alvarez
+# University of California, Berkeley
+
+# =========
+# LIBRARIES
+# =========
+
+# Libraries
+import gzip
+import numpy as np
+import nibabel as nib
+
+# =========
+# SCRUBVIEW
+# =========
+
+
+class scrubview():
+    '''
+    Lazy view of scrubbed data.
+
+    Holds the original data, which may be memory-mapped, and the list of
+    replacement intervals found by tsvarana.core.scrub_intervals. Intervals
+    are applied on top of the original data only for the elements being
+    read, in the order they were added, so later iterations override
+    earlier ones. The original data must not be modified while the view is
+    in use.
+    '''
+
+    def __init__(self, data, time_axis, intervals=None):
+        '''
+        Parameters
+            data : array
+                Original N-dimensional voxelwise data array
+            time_axis : integer
+                Axis along which time is stored
+            intervals : tuple
+                (voxel, start, length, fill) arrays, as returned by
+                tsvarana.core.scrub_intervals
+        '''
+
+        # Set parameters
+        self.data = data
+        self.time_axis = time_axis
+        if intervals is None:
+            intervals = (
+                np.zeros(0, dtype=int),
+                np.zeros(0, dtype=int),
+                np.zeros(0, dtype=int),
+                np.zeros(0),
+            )
+        self.intervals = intervals
+
+        # Replaced samples, expanded on first use
+        self.replaced = None
+
+        # Array-like attributes
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = data.dtype
+
+    def compose(self, intervals):
+        '''
+        Return a new view, with further intervals applied after the
+        intervals of this view
+
+        Inputs
+            intervals [tuple] (voxel, start, length, fill) arrays
+        '''
+        return scrubview(
+            self.data,
+            self.time_axis,
+            tuple(
+                np.concatenate([a, b])
+                for a, b in zip(self.intervals, intervals)
+            )
+        )
+
+    def samples(self):
+        '''
+        Return coordinates and fill values of every replaced sample, keeping
+        only the last replacement of samples replaced more than once.
+        Intervals are fixed once the view is created, so samples are
+        expanded once and reused by every read
+
+        Outputs
+            coords  [tuple ] One index array per data axis
+            fill    [array ] Fill value of each sample
+        '''
+
+        # Already expanded
+        if self.replaced is not None:
+            return self.replaced
+
+        # Expand intervals into samples
+        voxel, start, length, fill = self.intervals
+        offset = np.arange(length.sum()) - np.repeat(
+            np.cumsum(length) - length,
+            length
+        )
+        time = np.repeat(start, length) + offset
+        voxel = np.repeat(voxel, length)
+        fill = np.repeat(fill, length)
+
+        # Keep the last replacement of each sample
+        n_timepoints = self.shape[self.time_axis]
+        linear = voxel * n_timepoints + time
+        _, last = np.unique(linear[::-1], return_index=True)
+        last = len(linear) - 1 - last
+
+        # Voxel coordinates, over all axes except time
+        spatial = list(self.shape)
+        spatial.pop(self.time_axis)
+        coords = list(np.unravel_index(voxel[last], spatial))
+        coords.insert(self.time_axis, time[last])
+
+        # Store & return
+        self.replaced = (tuple(coords), fill[last])
+        return self.replaced
+
+    def __getitem__(self, key):
+        '''
+        Read scrubbed data, supporting integer, slice and Ellipsis indices
+        '''
+
+        # One index per axis
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + \
+                key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # Original data
+        out = np.array(self.data[key])
+
+        # Position of every replaced sample in the output
+        coords, fill = self.samples()
+        keep = np.ones(fill.shape, dtype=bool)
+        position = []
+        for axis, k in enumerate(key):
+            selected = np.atleast_1d(np.arange(self.shape[axis])[k])
+            lookup = np.full(self.shape[axis], -1)
+            lookup[selected] = np.arange(selected.size)
+            p = lookup[coords[axis]]
+            keep &= p >= 0
+            if not isinstance(k, (int, np.integer)):
+                position.append(p)
+
+        # Apply replacements that fall inside the selection
+        out[tuple(p[keep] for p in position)] = fill[keep]
+
+        # Return
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        '''
+        Materialise as a NumPy array
+        '''
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+    def materialize(self):
+        '''
+        Return the full scrubbed data as a NumPy array
+        '''
+        return self[...]
+
+    def to_nifti(self, path, affine, chunk=16):
+        '''
+        Stream scrubbed data to a NIFTI file, a few entries of the last axis
+        at a time, without materialising the full array
+
+        Inputs
+            path    [string] NIFTI file, gzipped if ending in .gz
+            affine  [array ] NIFTI affine
+            chunk   [scalar] Number of entries of the last axis per chunk
+        '''
+
+        # Header
+        header = nib.Nifti1Header()
+        header.set_data_shape(self.shape)
+        header.set_data_dtype(self.dtype)
+        header.set_qform(affine, code=1)
+        header.set_sform(affine, code=1)
+        header.set_data_offset(352)
+        header.set_slope_inter(1, 0)
+
+        # Write header, padding up to the data offset & data in Fortran order
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wb') as fid:
+            header.write_to(fid)
+            fid.write(b'\x00' * (352 - fid.tell()))
+            for i in range(0, self.shape[-1], chunk):
+                block = self[..., i:i + chunk].astype(self.dtype)
+                fid.write(block.tobytes(order='F'))
+
+# Done
+#